@@ -0,0 +1,148 @@
+// Tile source for DeepZoom images whose tiles are stored in a single pack
+// file (.dzp), as written by makePlateMontageDZI.py -k.
+// The descriptor is read from the .dzi file next to the pack. Tiles are read
+// from the pack with HTTP Range requests, so the server has to support them.
+//
+// Pack layout (little-endian):
+// "DZPACK01", encoded tiles, index, footer
+// index - 12 bytes per tile, level by level and row by row:
+//         offset (uint64) and length (uint32) of the tile; length 0 for a missing tile
+// footer - 24 bytes: "DZPINDEX", offset of the index (uint64), number of entries (uint64)
+
+var PACK_FOOTER_SIZE = 24;
+var PACK_ENTRY_SIZE = 12;
+
+// reads bytes start to end (inclusive) of a file; a negative start reads the last -start bytes
+function fetchPackRange(url, start, end, success, error) {
+  OpenSeadragon.makeAjaxRequest({
+    url: url,
+    headers: { Range: "bytes=" + (start < 0 ? start : start + "-" + end) },
+    responseType: "arraybuffer",
+    success: function (request) {
+      var data = request.response;
+      // servers without Range support send the entire file
+      if (request.status == 200) {
+        data = start < 0 ? data.slice(data.byteLength + start) : data.slice(start, end + 1);
+      }
+      success(data);
+    },
+    error: function (request) {
+      error("Unable to read " + url + " (" + request.status + ")");
+    }
+  });
+}
+
+function DZPackTileSource(url) {
+  var source = this;
+
+  OpenSeadragon.EventSource.call(this);
+
+  // safe defaults until the descriptor and the index are loaded
+  this.packUrl = url;
+  this.ready = false;
+  this.aspectRatio = 1;
+  this.dimensions = new OpenSeadragon.Point(10, 10);
+  this._tileWidth = 0;
+  this._tileHeight = 0;
+  this._levelRects = {};
+  this.tileOverlap = 0;
+  this.minLevel = 0;
+  this.maxLevel = 0;
+
+  function fail(message) {
+    source.raiseEvent("open-failed", { message: message, source: url });
+  }
+
+  OpenSeadragon.makeAjaxRequest({
+    url: url.replace(/\.dzp$/, ".dzi"),
+    success: function (request) {
+      var image = OpenSeadragon.parseXml(request.responseText).documentElement;
+      var size = image.getElementsByTagName("Size")[0];
+      var width = parseInt(size.getAttribute("Width"), 10);
+      var height = parseInt(size.getAttribute("Height"), 10);
+
+      source.fileFormat = image.getAttribute("Format");
+      source.tileOverlap = parseInt(image.getAttribute("Overlap"), 10);
+      source._tileWidth = source._tileHeight = parseInt(image.getAttribute("TileSize"), 10);
+      source.dimensions = new OpenSeadragon.Point(width, height);
+      source.aspectRatio = width / height;
+      source.maxLevel = Math.ceil(Math.log(Math.max(width, height)) / Math.log(2));
+
+      // first index entry and number of columns of every level
+      source.levelStart = [];
+      source.levelColumns = [];
+      source.levelRows = [];
+      var entries = 0;
+      for (var level = 0; level <= source.maxLevel; level++) {
+        var scale = Math.pow(0.5, source.maxLevel - level);
+        var columns = Math.ceil(Math.ceil(width * scale) / source._tileWidth);
+        var rows = Math.ceil(Math.ceil(height * scale) / source._tileHeight);
+        source.levelStart.push(entries);
+        source.levelColumns.push(columns);
+        source.levelRows.push(rows);
+        entries += columns * rows;
+      }
+
+      fetchPackRange(url, -PACK_FOOTER_SIZE, 0, function (footer) {
+        var view = new DataView(footer);
+        var offset = view.getUint32(8, true) + view.getUint32(12, true) * 4294967296;
+        var count = view.getUint32(16, true) + view.getUint32(20, true) * 4294967296;
+        if (count != entries) {
+          fail("Pack " + url + " does not match its descriptor");
+          return;
+        }
+
+        fetchPackRange(url, offset, offset + count * PACK_ENTRY_SIZE - 1, function (index) {
+          source.index = new DataView(index);
+          source.ready = true;
+          source.raiseEvent("ready", { tileSource: source });
+        }, fail);
+      }, fail);
+    },
+    error: function (request) {
+      fail("Unable to read the descriptor of " + url);
+    }
+  });
+}
+
+OpenSeadragon.extend(DZPackTileSource.prototype, OpenSeadragon.DziTileSource.prototype, {
+
+  // offset and length of a tile in the pack
+  getTileEntry: function (level, x, y) {
+    var position = (this.levelStart[level] + y * this.levelColumns[level] + x) * PACK_ENTRY_SIZE;
+    return {
+      offset: this.index.getUint32(position, true) + this.index.getUint32(position + 4, true) * 4294967296,
+      length: this.index.getUint32(position + 8, true)
+    };
+  },
+
+  // every tile comes from the pack; the Range header tells them apart
+  getTileUrl: function (level, x, y) {
+    return this.packUrl;
+  },
+
+  getTileAjaxHeaders: function (level, x, y) {
+    var entry = this.getTileEntry(level, x, y);
+    return { Range: "bytes=" + entry.offset + "-" + (entry.offset + entry.length - 1) };
+  },
+
+  tileExists: function (level, x, y) {
+    return level >= this.minLevel && level <= this.maxLevel &&
+      x < this.levelColumns[level] && y < this.levelRows[level] &&
+      this.getTileEntry(level, x, y).length > 0;
+  }
+});
+
+// Item of the tileSources option of a viewer for the pyramid <name>.dzi:
+// tiles come from the <name>_files folder, or from the <name>.dzp pack
+// if the page is opened with ?pack, e.g. index.html?pack
+function dzTileSource(name, options) {
+  var item = OpenSeadragon.extend({}, options);
+  if (/[?&]pack(=|&|$)/.test(window.location.search)) {
+    item.tileSource = new DZPackTileSource(name + ".dzp");
+    item.loadTilesWithAjax = true;
+  } else {
+    item.tileSource = name + ".dzi";
+  }
+  return item;
+}
@@ -1,5 +1,6 @@
 #!/bin/bash
 
-# Run the site using a command-line server
-# https://www.npmjs.com/package/http-server
-http-server -p 1313
+# Run the site using the tile server from the scripts folder;
+# it serves tiles from _files folders and from .dzp packs alike
+SITE_DIR="$(dirname "$0")"
+python3 "$SITE_DIR/../scripts/serveDZI.py" -p 1313 "$SITE_DIR"
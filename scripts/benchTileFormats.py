@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Compares tile formats and encoder settings of makePlateMontageDZI.py
+# on the tiles of an existing pyramid.
+#
+# Tiles of the full resolution level of a DZI are decoded and encoded again
+# with every combination of format (-F), quality (-q) and encoder effort (-E),
+# using the encoder of makePlateMontageDZI.py. For every combination, the
+# script reports the encoding time and the size per tile, and the PSNR of
+# the encoded tiles against the tiles of the pyramid (inf for lossless).
+# The quality does not apply to PNG; its efforts are the PNG profiles.
+#
+# The pyramid should have lossless (PNG) tiles, e.g. made from the demo
+# dataset with:
+# ./makePlateMontageDZI.py -p 2 2 -w 4 4 -c 0 -f dzi -o /tmp/bench ../demodata2x2
+# ./benchTileFormats.py /tmp/bench/dzi.dzi
+
+
+import os, argparse, io, math, time
+from PIL import Image
+import numpy as np
+
+from makePlateMontageDZI import DeepZoomImageDescriptor, ImageCreator, IMAGE_FORMATS, ENCODER_EFFORTS
+
+
+def loadTiles(inPath, inCount):
+    # Full resolution tiles of a DZI, at most inCount of them spread evenly over the level
+    locDescriptor = DeepZoomImageDescriptor()
+    locDescriptor.open(inPath)
+    locLevel = locDescriptor.num_levels - 1
+    locDir = os.path.join(os.path.splitext(inPath)[0] + '_files', str(locLevel))
+
+    locFiles = sorted(os.listdir(locDir))
+    if inCount > 0 and len(locFiles) > inCount:
+        locFiles = [locFiles[i * len(locFiles) // inCount] for i in range(inCount)]
+
+    locTiles = []
+    for locFile in locFiles:
+        with Image.open(os.path.join(locDir, locFile)) as locIm:
+            locTiles.append(locIm.copy())
+
+    return(locDescriptor, locTiles)
+
+def benchEncoder(inTiles, inFormat, inQuality, inEffort):
+    # Encodes all tiles; returns the mean encoding time (s) and size (bytes)
+    # per tile, and the PSNR (dB) of the encoded tiles
+    locCreator = ImageCreator(tile_format=inFormat, image_quality=inQuality, encoder_effort=inEffort)
+    locCreator.descriptor = DeepZoomImageDescriptor(tile_format=inFormat)
+
+    locTime = 0.
+    locBytes = 0
+    locSqErr = 0.
+    locPixels = 0
+    for locTile in inTiles:
+        locStart = time.perf_counter()
+        locData = locCreator.encode_tile(locTile)
+        locTime += time.perf_counter() - locStart
+        locBytes += len(locData)
+
+        locDecoded = np.asarray(Image.open(io.BytesIO(locData)).convert(locTile.mode), dtype=np.float64)
+        locSqErr += np.sum((locDecoded - np.asarray(locTile, dtype=np.float64)) ** 2)
+        locPixels += locDecoded.size
+
+    locMSE = locSqErr / locPixels
+    locPSNR = math.inf if locMSE == 0 else 10 * math.log10(255 ** 2 / locMSE)
+    return(locTime / len(inTiles), locBytes / len(inTiles), locPSNR)
+
+
+def parseArguments():
+        parser = argparse.ArgumentParser(description='Compare encode time, size and PSNR of tile formats on the tiles of a DZI.')
+
+        parser.add_argument(
+                'dzi',
+                help='DZI file of a pyramid with lossless tiles')
+
+        parser.add_argument(
+                '-n',
+                '--ntiles',
+                help='Number of full resolution tiles to encode, 0 for all, default 200',
+                type=int,
+                default=200)
+
+        parser.add_argument(
+                '-F',
+                '--format',
+                help='Tile formats to compare, default all',
+                type=str,
+                nargs='+',
+                choices=list(IMAGE_FORMATS),
+                default=list(IMAGE_FORMATS))
+
+        parser.add_argument(
+                '-q',
+                '--imquality',
+                help='Image qualities (0.1 - 1) to compare, as in makePlateMontageDZI.py, default 0.8',
+                type=float,
+                nargs='+',
+                default=[0.8])
+
+        parser.add_argument(
+                '-E',
+                '--effort',
+                help='Encoder efforts to compare, default all',
+                type=str,
+                nargs='+',
+                choices=ENCODER_EFFORTS,
+                default=list(ENCODER_EFFORTS))
+
+        return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parseArguments()
+
+    descriptor, tiles = loadTiles(args.dzi, args.ntiles)
+    print("%d tiles of %dx%d pixels, level %d of %s\n" % (
+        len(tiles), descriptor.tile_size, descriptor.tile_size, descriptor.num_levels - 1, args.dzi))
+
+    print("%-6s %7s %-9s %10s %12s %9s" % ("format", "quality", "effort", "ms/tile", "bytes/tile", "PSNR dB"))
+    for locFormat in args.format:
+        for locQuality in args.imquality:
+            for locEffort in args.effort:
+                locTime, locBytes, locPSNR = benchEncoder(tiles, locFormat, locQuality, locEffort)
+                print("%-6s %7.2f %-9s %10.2f %12.0f %9.2f" % (
+                    locFormat, locQuality, locEffort, locTime * 1000, locBytes, locPSNR))
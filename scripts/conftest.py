@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Fixtures of the tests of the scripts: a small synthetic plate of 16-bit
+# FOV images, runs of makePlateMontageDZI.py on it and servers of tiles
+
+import filecmp
+import os
+import socket
+import subprocess
+import sys
+import time
+import types
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# Geometry of the synthetic plate: 3x2 wells of 2x2 FOVs of 96x80 pixels;
+# the large well labels cover parts of FOVs and of the padding between them
+PLATE = (3, 2)
+WELL = (2, 2)
+FOV = (96, 80)
+
+
+def writePlate(folder, channels=(0, 1), missing=(), seed=0):
+    # FOVs named by the A01f00d0.TIFF convention: noise on a gradient that
+    # differs in every FOV, with intensities around the default -I range;
+    # FOVs in missing, e.g. ('B', 2, 3), are not written
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:FOV[1], 0:FOV[0]]
+    for row in 'ABCDEFGHIJKLMNOP'[:PLATE[1]]:
+        for col in range(1, PLATE[0] + 1):
+            for fov in range(WELL[0] * WELL[1]):
+                for ch in channels:
+                    base = rng.uniform(300, 2500) + (x * rng.uniform(-10, 10) + y * rng.uniform(-10, 10))
+                    pixels = np.clip(base + rng.normal(0, 300, FOV[::-1]), 0, 65535).astype(np.uint16)
+                    if (row, col, fov) not in missing:
+                        Image.fromarray(pixels).save(os.path.join(folder, '%s%02df%02dd%d.TIFF' % (row, col, fov, ch)))
+    return folder
+
+
+def plateArgs(folder, *args):
+    # Arguments of makePlateMontageDZI.py for the synthetic plate in folder
+    return ['-p', str(PLATE[0]), str(PLATE[1]), '-w', str(WELL[0]), str(WELL[1]),
+            '-m', str(FOV[0]), str(FOV[1])] + [str(a) for a in args] + [str(folder)]
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def fetchURL(url, headers=None, method='GET'):
+    # Status, headers and body of a response, also of error responses
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+@pytest.fixture
+def fetch():
+    # Fetches a URL: fetch(url, headers=None, method='GET') gives the status,
+    # the headers and the body of the response
+    return fetchURL
+
+
+def differentFiles(first, second):
+    # Files of the folder first that are missing in second or differ from
+    # them, relative to first
+    different = []
+    for root, _, names in os.walk(first):
+        for name in names:
+            path = os.path.join(root, name)
+            other = os.path.join(second, os.path.relpath(path, first))
+            if not os.path.isfile(other) or not filecmp.cmp(path, other, shallow=False):
+                different.append(os.path.relpath(path, first))
+    return sorted(different)
+
+
+@pytest.fixture
+def different_files():
+    # Compares folders, e.g. the _files folders of pyramids:
+    # different_files(first, second) lists the files of first that are
+    # missing in second or differ from them
+    return differentFiles
+
+
+@pytest.fixture
+def plate(tmp_path):
+    # Synthetic plate with channels 0 and 1; FOV 3 of well B02 is missing
+    folder = writePlate(str(tmp_path / 'plate'), missing=[('B', 2, 3)])
+    return types.SimpleNamespace(folder=folder, args=lambda *args: plateArgs(folder, *args))
+
+
+@pytest.fixture
+def run_montage():
+    # Runs makePlateMontageDZI.py with the given arguments
+    def run(args, check=True):
+        result = subprocess.run([sys.executable, '-W', 'ignore', os.path.join(SCRIPTS, 'makePlateMontageDZI.py')] + list(args),
+                                cwd=SCRIPTS, capture_output=True, text=True)
+        if check:
+            assert result.returncode == 0, result.stdout + result.stderr
+        return result
+    return run
+
+
+@pytest.fixture
+def server():
+    # Starts a script that serves tiles on a free port, given as {port} in
+    # its arguments, and returns its URL once it answers; stopped at the end
+    processes = []
+
+    def start(script, args, path=''):
+        port = freePort()
+        process = subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(SCRIPTS, script)] +
+                                   [str(a).format(port=port) for a in args],
+                                   cwd=SCRIPTS, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        url = 'http://127.0.0.1:%d/' % port
+        for _ in range(600):
+            assert process.poll() is None, 'server exited with %d' % process.returncode
+            try:
+                fetchURL(url + path)
+                return url
+            except OSError:
+                time.sleep(0.1)
+        raise TimeoutError(url)
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait(30)
@@ -32,7 +32,35 @@
 # -p 24 16 -w 4 4
 
 
-import os, argparse
+import argparse
+import copy
+import csv
+import fcntl
+import hashlib
+import io
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import warnings
+import xml.dom.minidom
+import zlib
+
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import urlparse
+
 from PIL import Image, ImageDraw, ImageFont
 import imageio
 import numpy as np
@@ -49,19 +77,6 @@ import numpy as np
 ## Copyright (c) 2008, Kapil Thangavelu <kapil.foss@gmail.com>
 ## All rights reserved.
 
-import io
-import math
-import os
-import shutil
-from urllib.parse import urlparse
-import sys
-import time
-import urllib.request
-import warnings
-import xml.dom.minidom
-
-from collections import deque
-
 
 NS_DEEPZOOM = "http://schemas.microsoft.com/deepzoom/2008"
 
@@ -78,7 +93,58 @@ RESIZE_FILTERS = {
 IMAGE_FORMATS = {
     "jpg": "jpg",
     "png": "png",
+    "webp": "webp",
+}
+
+# Trade-off of tile encoders between encoding time and size of the tiles
+ENCODER_EFFORTS = ("fastest", "balanced", "smallest")
+DEFAULT_ENCODER_EFFORT = "balanced"
+
+# JPEG: optimal Huffman tables computed for every tile
+JPEG_OPTIMIZE = {"fastest": False, "balanced": False, "smallest": True}
+
+# WebP: compression method, 0 (fast) to 6 (slow, smaller tiles)
+WEBP_METHODS = {"fastest": 0, "balanced": 4, "smallest": 6}
+
+# Lossless WebP: effort of the compression, 0 to 100, in place of the quality;
+# 100 is very slow for a small gain
+WEBP_LOSSLESS_EFFORTS = {"fastest": 0, "balanced": 50, "smallest": 90}
+
+# PNG: (row filter, zlib level, zlib strategy) of the encodings to try; the
+# smallest one is kept. Encodings without a row filter are made by Pillow,
+# which picks the filter of every row as libpng does; the up filter is
+# applied to all rows with numpy, which is faster. Run-length matching suits
+# tiles of noisy images with flat padding between them.
+PNG_PROFILES = {
+    "fastest": (("up", 1, zlib.Z_RLE),),
+    "balanced": ((None, 1, zlib.Z_RLE),),
+    "smallest": ((None, 1, zlib.Z_RLE), (None, 9, zlib.Z_FILTERED)),
 }
+PNG_FILTER_UP = 2 # filter type of the up filter
+PNG_COLOR_TYPES = {"L": 0, "LA": 4, "RGB": 2, "RGBA": 6}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Pixels of a level that a resize filter reaches beyond a region of the
+# level above halved, and pixels of the level above around a region that it
+# reads; LANCZOS, the widest filter, reaches 3 pixels of the level
+RESIZE_REACH = 4
+RESIZE_MARGIN = 2 * RESIZE_REACH
+
+# How levels below the full resolution one are made:
+# resize - each level image is resized from the level above,
+# tiles - each tile is composed from the tiles of the level above.
+PYRAMID_MODES = ("resize", "tiles")
+
+# Number of decoded tiles kept while composing tiles of the level below
+TILE_CACHE_SIZE = 16
+
+# Number of recently saved tiles whose content is remembered, so that
+# identical tiles are linked to the saved tile instead of encoded again
+TILE_DEDUP_SIZE = 4096
+
+# Tiles of a level are split into this many chunks per worker process,
+# so that a few slow chunks do not leave the other workers idle
+CHUNKS_PER_CORE = 4
 
 # Path to the font file; required for adding overlay labels
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -100,11 +166,26 @@ class DeepZoomImageDescriptor(object):
         self.tile_format = tile_format
         self._num_levels = None
 
-
+    def open(self, source):
+        """Intialize descriptor from an existing descriptor file."""
+        doc = xml.dom.minidom.parse(source)
+        image = doc.getElementsByTagName("Image")[0]
+        size = doc.getElementsByTagName("Size")[0]
+        self.width = int(size.getAttribute("Width"))
+        self.height = int(size.getAttribute("Height"))
+        self.tile_size = int(image.getAttribute("TileSize"))
+        self.tile_overlap = int(image.getAttribute("Overlap"))
+        self.tile_format = image.getAttribute("Format")
+        self._num_levels = None
 
     def save(self, destination):
         """Save descriptor file."""
         file = open(destination, "wb")
+        file.write(self.to_xml())
+        file.close()
+
+    def to_xml(self):
+        """Contents of the descriptor file."""
         doc = xml.dom.minidom.Document()
         image = doc.createElementNS(NS_DEEPZOOM, "Image")
         image.setAttribute("xmlns", NS_DEEPZOOM)
@@ -116,9 +197,7 @@ class DeepZoomImageDescriptor(object):
         size.setAttribute("Height", str(self.height))
         image.appendChild(size)
         doc.appendChild(image)
-        descriptor = doc.toxml(encoding="UTF-8")
-        file.write(descriptor)
-        file.close()
+        return doc.toxml(encoding="UTF-8")
 
     @classmethod
     def remove(self, filename):
@@ -181,6 +260,14 @@ class ImageCreator(object):
         image_quality=0.8,
         resize_filter=None,
         copy_metadata=False,
+        pyramid="resize",
+        cores=1,
+        dedup=True,
+        pack=False,
+        encoder_effort=DEFAULT_ENCODER_EFFORT,
+        writers=4,
+        sync="none",
+        profile=False,
     ):
         self.tile_size = int(tile_size)
         self.tile_format = tile_format
@@ -189,21 +276,136 @@ class ImageCreator(object):
 
         if not tile_format in IMAGE_FORMATS:
             self.tile_format = DEFAULT_IMAGE_FORMAT
+        if not encoder_effort in ENCODER_EFFORTS:
+            encoder_effort = DEFAULT_ENCODER_EFFORT
+        self.encoder_effort = encoder_effort
         self.resize_filter = resize_filter
         self.copy_metadata = copy_metadata
+        self.level_cache = None # (level, image) of the last level returned by get_image
+
+        if not pyramid in PYRAMID_MODES:
+            pyramid = PYRAMID_MODES[0]
+        self.pyramid = pyramid
+        self.tile_cache = OrderedDict()
+
+        self.cores = max(1, int(cores))
+        self.pool = None
+
+        self.dedup = dedup
+        self.tile_files = OrderedDict() # content key -> location of a saved tile in the store
+
+        self.pack = pack
+        self.store = None
+        self.writers = max(1, int(writers))
+        if not sync in SYNC_POLICIES:
+            sync = SYNC_POLICIES[0]
+        self.sync = sync
+        self.resumed = None # tile -> location of intact tiles of an interrupted run, see resume
+        self.done = set() # (level, column, row) of tiles kept in the open store
+
+        self.encode_stats = EncodeStats()
+        self.write_stats = WriteStats()
+        self.profile = StageProfile(profile) # stages of making the pyramid, without writing
+
+    def __getstate__(self):
+        """Leaves out images, the pool and the tile store when sent to worker processes."""
+        state = self.__dict__.copy()
+        for key in ("image", "level_cache", "strip_levels", "pool", "store", "resumed"):
+            state.pop(key, None)
+        state["done"] = set()
+        state["tile_cache"] = OrderedDict()
+        state["tile_files"] = OrderedDict()
+        state["encode_stats"] = EncodeStats()
+        state["write_stats"] = WriteStats()
+        state["profile"] = StageProfile(self.profile.enabled)
+        return state
+
+    def open_pool(self):
+        """Starts worker processes for saving tiles; returns False if the pool already runs."""
+        if self.pool is not None:
+            return False
+        if self.cores > 1:
+            # workers must report shared memory to the tracker of this process,
+            # otherwise each of them starts its own and warns about leaks
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(self.cores)
+        return True
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def new_store(self, destination, in_place=False):
+        """Store of the tiles: a pack next to destination or its _files folder.
+
+        A store that updates a published image in place keeps no checkpoint
+        log, and its tile files replace the old ones atomically."""
+        checkpoint = None if in_place else _get_checkpoint_path(destination)
+        if self.pack:
+            return TilePack(destination, self.sync, checkpoint)
+        return TileFolder(destination, self.descriptor.tile_format,
+                          TileWriter(self.writers, self.sync, checkpoint, atomic=in_place))
+
+    def open_store(self, destination, append=False, in_place=False):
+        """Opens the store of the tiles; tiles found by resume are kept and not saved again."""
+        resumed, self.resumed = self.resumed, None
+        self.store = self.new_store(destination, in_place)
+        self.store.open(self.descriptor, append, resumed)
+        self.done = set(resumed or ())
+
+    def close_store(self):
+        self.store.close()
+        self.write_stats.merge(self.store.write_stats)
+        self.store = None
+        self.done = set()
+
+    def resume(self, width, height, destination, check="size"):
+        """Finds the tiles that an interrupted run saved intact to destination.
+
+        Every store keeps a checkpoint log of the tiles it wrote; check is
+        one of RESUME_CHECKS. The next create or start_streamed of an image of
+        the same size keeps these tiles and skips them. Returns their
+        (level, column, row)."""
+        self.descriptor = DeepZoomImageDescriptor(
+            width=width,
+            height=height,
+            tile_size=self.tile_size,
+            tile_overlap=self.tile_overlap,
+            tile_format=self.tile_format,
+        )
+        self.resumed = self.new_store(destination).load_checkpoint(check)
+        return set(self.resumed)
 
     def get_image(self, level):
-        """Returns the bitmap image at the given level."""
+        """Returns the bitmap image at the given level.
+
+        If the image of the level above was the last one requested, the level
+        is resized from it rather than from the full resolution source. Going
+        through the levels from the top thus costs about 4/3 of a single
+        resize of the source."""
         assert (
             0 <= level and level < self.descriptor.num_levels
         ), "Invalid pyramid level"
         width, height = self.descriptor.get_dimensions(level)
         # don't transform to what we already have
         if self.descriptor.width == width and self.descriptor.height == height:
+            self.level_cache = (level, self.image)
             return self.image
-        if (self.resize_filter is None) or (self.resize_filter not in RESIZE_FILTERS):
-            return self.image.resize((width, height), Image.ANTIALIAS)
-        return self.image.resize((width, height), RESIZE_FILTERS[self.resize_filter])
+        source = self.image
+        if self.level_cache is not None and self.level_cache[0] == level + 1:
+            source = self.level_cache[1]
+        if isinstance(source, np.ndarray):
+            # an image on the pixels of the array, e.g. a memory-mapped file, without copying them
+            source = Image.fromarray(source)
+        with self.profile.stage("resize level %d" % level, width * height * len(source.getbands())):
+            if (self.resize_filter is None) or (self.resize_filter not in RESIZE_FILTERS):
+                level_image = source.resize((width, height), DEFAULT_RESIZE_FILTER)
+            else:
+                level_image = source.resize((width, height), RESIZE_FILTERS[self.resize_filter])
+        self.level_cache = (level, level_image)
+        return level_image
 
     def tiles(self, level):
         """Iterator for all tiles in the given level. Returns (column, row) of a tile."""
@@ -218,9 +420,14 @@ class ImageCreator(object):
         # Open the source image for DZI tiling from a file
         #self.image = Image.open(safe_open(source))
 
-        # The source image for DZI tiling is a PIL.Image objects
+        # The source image for DZI tiling is a PIL.Image object, or a 2-D
+        # uint8 array such as a numpy.memmap; tiles are cropped from array
+        # views of it, and worker processes map the file of a memmap
         self.image = source
-        width, height = self.image.size
+        if isinstance(source, np.ndarray):
+            height, width = source.shape
+        else:
+            width, height = source.size
 
         self.descriptor = DeepZoomImageDescriptor(
             width=width,
@@ -231,37 +438,636 @@ class ImageCreator(object):
         )
 
         # Create tiles
-        image_files = _get_or_create_path(_get_files_path(destination))
+        self.open_store(destination)
+
+        # Start from the top so that every level is resized from the one above
+        self.level_cache = None
+        max_level = self.descriptor.num_levels - 1
+        if self.pyramid == "tiles":
+            levels = [max_level]
+        else:
+            levels = reversed(range(self.descriptor.num_levels))
+
+        owns_pool = self.open_pool()
+        try:
+            for level in levels:
+
+                if (DEB):
+                    print("Pyramid level %d" % level)
+
+                level_image = self.get_image(level)
+                self.save_tiles(level, list(self.tiles(level)), level_image)
+
+            # the source is not needed once the levels are tiled
+            self.level_cache = None
+            self.image = None
+
+            if self.pyramid == "tiles":
+                self.create_from_tiles(max_level)
+        finally:
+            if owns_pool:
+                self.close_pool()
+
+        self.close_store()
 
-        # Parallelization?
-        for level in range(self.descriptor.num_levels):
+        # Create descriptor
+        self.descriptor.save(destination)
+
+    def save_tile(self, tile, level, column, row):
+        """Saves a single tile in the tile store.
+
+        A tile with the same pixels as a recently saved one, e.g. empty
+        padding, is linked to the saved tile instead of being encoded again."""
+        key = _tile_key(tile) if self.dedup else None
+        if key is not None and key in self.tile_files:
+            if self.store.link(self.tile_files[key], level, column, row):
+                self.tile_files.move_to_end(key)
+                return
+
+        location = self.store.write(level, column, row, self.encode_tile(tile))
+
+        if key is not None:
+            self.tile_files[key] = location
+            if len(self.tile_files) > TILE_DEDUP_SIZE:
+                self.tile_files.popitem(last=False)
+
+    def encode_tile(self, tile):
+        """Returns the tile encoded in the tile format."""
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        tile_file = io.BytesIO()
+
+        if self.descriptor.tile_format == "png" and tile.mode in PNG_COLOR_TYPES:
+            tile_file.write(_encode_png(tile, PNG_PROFILES[self.encoder_effort]))
+        elif self.descriptor.tile_format == "jpg":
+            jpeg_quality = int(self.image_quality * 100)
+            tile.save(tile_file, "JPEG", quality=jpeg_quality,
+                      optimize=JPEG_OPTIMIZE[self.encoder_effort])
+        elif self.descriptor.tile_format == "webp":
+            # quality 1 stores the tiles losslessly
+            webp_quality = int(self.image_quality * 100)
+            if webp_quality == 100:
+                tile.save(tile_file, "WEBP", lossless=True,
+                          quality=WEBP_LOSSLESS_EFFORTS[self.encoder_effort],
+                          method=WEBP_METHODS[self.encoder_effort])
+            else:
+                tile.save(tile_file, "WEBP", quality=webp_quality,
+                          method=WEBP_METHODS[self.encoder_effort])
+        else:
+            png_compress = round((1 - self.image_quality)*10)
+            tile.save(tile_file, "PNG", compress_level = png_compress)
+
+        data = tile_file.getvalue()
+        seconds = time.perf_counter() - start
+        self.encode_stats.add(seconds, len(data))
+        if self.profile.enabled:
+            self.profile.add("encode", seconds, time.thread_time() - cpu_start, len(data))
+        return data
+
+    def save_tiles(self, level, tiles, image=None, origin=(0, 0)):
+        """Saves a list of (column, row) tiles of a level.
+
+        Tiles are cropped from image, whose top left pixel lies at origin
+        (x, y) of the level, or composed from the tiles of the level above if
+        image is None.
+        With a worker pool, the tiles are split into balanced chunks and the
+        workers crop them from a copy of image in shared memory, or map the
+        file of an image that is a numpy.memmap. Tiles kept from an
+        interrupted run are skipped."""
+        if self.done:
+            tiles = [tile for tile in tiles if (level,) + tile not in self.done]
+
+        if self.pool is None or len(tiles) < 2:
+            if image is None:
+                self.compose_tiles(level, tiles)
+            else:
+                self.crop_tiles(level, tiles, image, origin)
+            return
+
+        chunks = _balanced_chunks(tiles, self.cores * CHUNKS_PER_CORE)
+
+        if image is None:
+            store = self.worker_store(level + 1)
+            self.save_results(self.pool.starmap(
+                _compose_tiles_worker,
+                [(self, store, level, chunk) for chunk in chunks],
+            ))
+            return
+
+        if isinstance(image, np.memmap) and isinstance(image.base, mmap.mmap):
+            image.flush()
+            store = self.worker_store()
+            self.save_results(self.pool.starmap(
+                _crop_tiles_worker,
+                [(self, store, level, chunk, (image.filename, image.offset), image.shape, origin) for chunk in chunks],
+            ))
+            return
+
+        array = np.asarray(image)
+        shape = array.shape
+
+        # shared memory on Linux lives in /dev/shm, which may be too small
+        # for the level; writing beyond its room would end with SIGBUS. The
+        # level then goes to a file in the temporary folder, or is cropped
+        # by this process
+        shm = path = None
+        if os.path.isdir("/dev/shm") and _free_space("/dev/shm") < array.nbytes:
+            if _free_space(tempfile.gettempdir()) < array.nbytes:
+                self.crop_tiles(level, tiles, image, origin)
+                return
+            handle, path = tempfile.mkstemp(prefix=".level_", suffix=".u8")
+            os.close(handle)
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        try:
+            with self.profile.stage("share", array.nbytes):
+                if shm is None:
+                    shared = np.memmap(path, dtype=np.uint8, mode="w+", shape=shape)
+                    shared[...] = array
+                    shared.flush()
+                else:
+                    shared = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                    shared[...] = array
+            del shared, array
+            store = self.worker_store()
+            source = shm.name if shm is not None else (path, 0)
+            self.save_results(self.pool.starmap(
+                _crop_tiles_worker,
+                [(self, store, level, chunk, source, shape, origin) for chunk in chunks],
+            ))
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            else:
+                _remove_file(path)
+
+    def worker_store(self, read_level=None):
+        """Store for the tiles saved by worker processes.
+
+        Workers write to a folder themselves, once the tiles queued by this
+        process are written; tiles for a pack are collected in a batch and
+        written by this process. read_level is the level whose tiles the
+        workers read."""
+        if self.store.shared:
+            self.store.flush()
+            return self.store
+        return _TileBatch(None if read_level is None else self.store.level_reader(read_level))
+
+    def save_results(self, results):
+        """Writes the tiles collected by worker processes to the store and adds up their stats."""
+        for batch, encode_stats, write_stats, profile in results:
+            if batch is not None:
+                batch.replay(self.store)
+            self.encode_stats.merge(encode_stats)
+            self.profile.merge(profile)
+            if write_stats is not None:
+                self.write_stats.merge(write_stats)
+
+    def crop_tiles(self, level, tiles, image, origin=(0, 0)):
+        """Crops tiles from image, whose top left pixel lies at origin of the level, and saves them."""
+        left, top = origin
+        for (column, row) in tiles:
 
             if (DEB):
-                print("Pyramid level %d" % level)
+                print("Pyramid col x row: %d %d" % (column, row))
+
+            x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+            with self.profile.stage("crop", (x2 - x1) * (y2 - y1)):
+                tile = _crop_image(image, (x1 - left, y1 - top, x2 - left, y2 - top))
+            self.save_tile(tile, level, column, row)
+
+    def compose_tiles(self, level, tiles):
+        """Composes tiles from the tiles of the level above and saves them."""
+        for (column, row) in tiles:
+            with self.profile.stage("compose") as timer:
+                tile = self.compose_tile(level, column, row)
+                timer.size = tile.size[0] * tile.size[1] * len(tile.getbands())
+            self.save_tile(tile, level, column, row)
+        self.tile_cache.clear()
+
+    def create_streamed(self, strips, width, height, destination):
+        """Creates Deep Zoom image from horizontal strips and saves it to destination.
+
+        Strips are full-width PIL.Image objects that arrive from top to bottom.
+        Every level keeps only the rows needed for its current row of tiles;
+        a lower level is fed with the 2x2 box reduction of the rows above it."""
+        owns_pool = self.open_pool()
+        try:
+            self.start_streamed(width, height, destination)
+            for strip in strips:
+                self.add_strip(strip)
+            self.finish_streamed()
+        finally:
+            if owns_pool:
+                self.close_pool()
+
+    def start_streamed(self, width, height, destination):
+        """Prepares a streamed Deep Zoom image; strips are then passed to add_strip."""
+        self.descriptor = DeepZoomImageDescriptor(
+            width=width,
+            height=height,
+            tile_size=self.tile_size,
+            tile_overlap=self.tile_overlap,
+            tile_format=self.tile_format,
+        )
 
-            level_dir = _get_or_create_path(os.path.join(image_files, str(level)))
-            level_image = self.get_image(level)
+        self.destination = destination
+        self.open_store(destination)
 
-            for (column, row) in self.tiles(level):
+        self.strip_levels = [_StripLevel(level) for level in range(self.descriptor.num_levels)]
 
-                if (DEB):
-                    print("Pyramid col x row: %d %d" % (column, row))
+    def add_strip(self, strip):
+        """Adds the next strip of the full resolution image."""
+        self.push_strip(self.descriptor.num_levels - 1, strip)
+
+    def finish_streamed(self):
+        """Saves the remaining tiles and the descriptor of a streamed Deep Zoom image."""
+        max_level = self.descriptor.num_levels - 1
+
+        # Rows held back for reduction are complete once the source is exhausted
+        for level in reversed(range(1, max_level + 1)):
+            carry = self.strip_levels[level].carry
+            if carry is not None:
+                self.strip_levels[level].carry = None
+                self.push_strip(level - 1, carry.reduce(2))
+
+        self.strip_levels = None
+
+        if self.pyramid == "tiles":
+            self.create_from_tiles(max_level)
+
+        self.close_store()
+
+        # Create descriptor
+        self.descriptor.save(self.destination)
+
+    def push_strip(self, level, strip):
+        """Appends a strip to a level, saves completed rows of tiles and feeds the level below."""
+        state = self.strip_levels[level]
+        level_width, level_height = self.descriptor.get_dimensions(level)
+        columns, rows = self.descriptor.get_num_tiles(level)
+
+        state.buffer = _stack_strips(state.buffer, strip)
+        buffer_bottom = state.top + state.buffer.size[1]
+
+        # Save all rows of tiles that the buffer covers completely
+        ready = []
+        while state.row < rows:
+            bounds = self.descriptor.get_tile_bounds(level, 0, state.row)
+            if bounds[3] > buffer_bottom:
+                break
+
+            if (DEB):
+                print("Pyramid level %d row %d" % (level, state.row))
+
+            ready.extend((column, state.row) for column in range(columns))
+            state.row += 1
+
+        if ready:
+            self.save_tiles(level, ready, state.buffer, (0, state.top))
+
+            # Drop rows that no remaining tile of this level overlaps
+            if state.row < rows:
+                next_top = self.descriptor.get_tile_bounds(level, 0, state.row)[1]
+            else:
+                next_top = buffer_bottom
+            state.buffer = state.buffer.crop((0, next_top - state.top, level_width, state.buffer.size[1]))
+            state.top = next_top
+
+        if level == 0 or self.pyramid == "tiles":
+            return
+
+        # Reduce pairs of rows; an odd row waits for the next strip
+        pending = _stack_strips(state.carry, strip)
+        pending_height = pending.size[1]
+        even_height = pending_height - pending_height % 2
+        if even_height < pending_height:
+            state.carry = pending.crop((0, even_height, level_width, pending_height))
+        else:
+            state.carry = None
+        if even_height > 0:
+            self.push_strip(level - 1, pending.crop((0, 0, level_width, even_height)).reduce(2))
+
+    def start_update(self, width, height, destination, streamed=False, in_place=False):
+        """Prepares replacing some tiles of an existing Deep Zoom image of the same size.
+
+        Regions of the full resolution image are passed to update_region;
+        finish_update then makes the affected tiles of the lower levels as
+        the image was made: resized with the resize filter, or composed if
+        its pyramid was composed from tiles or streamed, whose levels are
+        reduced with a 2x2 box filter. With in_place, destination is a
+        published image that viewers may read meanwhile; its descriptor is
+        left as it is."""
+        self.descriptor = DeepZoomImageDescriptor(
+            width=width,
+            height=height,
+            tile_size=self.tile_size,
+            tile_overlap=self.tile_overlap,
+            tile_format=self.tile_format,
+        )
 
+        self.destination = destination
+        self.in_place = in_place
+        self.open_store(destination, append=True, in_place=in_place)
+        self.update_regions = []
+        self.update_resized = self.pyramid == "resize" and not streamed
+
+    def get_region_tiles(self, level, region):
+        """Tiles (column, row) of a level, row by row, whose bounds intersect region (x1, y1, x2, y2)."""
+        columns, rows = self.descriptor.get_num_tiles(level)
+        x1, y1, x2, y2 = region
+        tiles = []
+        for row in range(max(0, (y1 - self.tile_overlap) // self.tile_size),
+                         min(rows, (y2 + self.tile_overlap - 1) // self.tile_size + 1)):
+            for column in range(max(0, (x1 - self.tile_overlap) // self.tile_size),
+                                min(columns, (x2 + self.tile_overlap - 1) // self.tile_size + 1)):
                 bounds = self.descriptor.get_tile_bounds(level, column, row)
-                tile = level_image.crop(bounds)
-                format = self.descriptor.tile_format
-                tile_path = os.path.join(level_dir, "%s_%s.%s" % (column, row, format))
-                tile_file = open(tile_path, "wb")
-
-                if self.descriptor.tile_format == "jpg":
-                    jpeg_quality = int(self.image_quality * 100)
-                    tile.save(tile_file, "JPEG", quality=jpeg_quality)
-                else:
-                    png_compress = round((1 - self.image_quality)*10)
-                    tile.save(tile_file, compress_level = png_compress)
+                if bounds[0] < x2 and x1 < bounds[2] and bounds[1] < y2 and y1 < bounds[3]:
+                    tiles.append((column, row))
+        return tiles
+
+    def get_update_bounds(self, region):
+        """Bounds of the full resolution tiles that change with region; update_region needs an image of them."""
+        level = self.descriptor.num_levels - 1
+        bounds = [self.descriptor.get_tile_bounds(level, column, row) for (column, row) in self.get_region_tiles(level, region)]
+        return (
+            min(b[0] for b in bounds),
+            min(b[1] for b in bounds),
+            max(b[2] for b in bounds),
+            max(b[3] for b in bounds),
+        )
+
+    def update_region(self, region, image, bounds):
+        """Replaces the full resolution tiles that intersect region.
+
+        image covers bounds, as returned by get_update_bounds for the region."""
+        level = self.descriptor.num_levels - 1
+        self.save_tiles(level, self.get_region_tiles(level, region), image, bounds[:2])
+        self.update_regions.append(region)
+
+    def finish_update(self):
+        """Makes the tiles of lower levels that depend on the updated regions."""
+        regions = self.update_regions
+        reach = RESIZE_REACH if self.update_resized else 0
+        for level in reversed(range(self.descriptor.num_levels - 1)):
+
+            # a pixel depends on a 2x2 block of the level above, and a
+            # resized one also on the pixels that the filter reaches
+            width, height = self.descriptor.get_dimensions(level)
+            regions = [(max(0, x1 // 2 - reach), max(0, y1 // 2 - reach),
+                        min(width, (x2 + 1) // 2 + reach), min(height, (y2 + 1) // 2 + reach))
+                       for (x1, y1, x2, y2) in regions]
+            region_tiles = []
+            tiles = set()
+            for region in regions:
+                region_tiles.append([tile for tile in self.get_region_tiles(level, region) if tile not in tiles])
+                tiles.update(region_tiles[-1])
+
+            if (DEB):
+                print("Pyramid level %d: updating %d tiles" % (level, len(tiles)))
+
+            if self.update_resized:
+                for region_tile_list in region_tiles:
+                    if region_tile_list:
+                        self.resize_tiles(level, region_tile_list)
+                self.tile_cache.clear()
+            else:
+                self.save_tiles(level, sorted(tiles, key=lambda tile: (tile[1], tile[0])))
+
+        self.update_regions = []
+        self.close_store()
 
         # Create descriptor
-        self.descriptor.save(destination)
+        if not self.in_place:
+            self.descriptor.save(self.destination)
+
+    def resize_tiles(self, level, tiles):
+        """Resizes the part of a level that tiles cover from the tiles of the level above and saves them."""
+        bounds = [self.descriptor.get_tile_bounds(level, column, row) for (column, row) in tiles]
+        bounds = (
+            min(b[0] for b in bounds),
+            min(b[1] for b in bounds),
+            max(b[2] for b in bounds),
+            max(b[3] for b in bounds),
+        )
+        self.save_tiles(level, tiles, self.resize_region(level, bounds), bounds[:2])
+
+    def resize_region(self, level, bounds):
+        """Returns the part bounds (x1, y1, x2, y2) of a level image, resized
+        from the tiles of the level above as get_image resizes the whole level.
+
+        The resize filter reads the level above up to RESIZE_MARGIN pixels
+        around the scaled bounds, or up to its edges; the pixels are the same
+        as those of the whole level but for rounding."""
+        child_level = level + 1
+        width, height = self.descriptor.get_dimensions(level)
+        child_width, child_height = self.descriptor.get_dimensions(child_level)
+        scale_x, scale_y = child_width / width, child_height / height
+        x1, y1, x2, y2 = bounds
+        region = (
+            max(0, int(x1 * scale_x) - RESIZE_MARGIN),
+            max(0, int(y1 * scale_y) - RESIZE_MARGIN),
+            min(child_width, int(math.ceil(x2 * scale_x)) + RESIZE_MARGIN),
+            min(child_height, int(math.ceil(y2 * scale_y)) + RESIZE_MARGIN),
+        )
+        source = self.paste_tiles(child_level, region)
+        box = (x1 * scale_x - region[0], y1 * scale_y - region[1],
+               min(x2 * scale_x, child_width) - region[0], min(y2 * scale_y, child_height) - region[1])
+        with self.profile.stage("resize level %d" % level, (x2 - x1) * (y2 - y1) * len(source.getbands())):
+            return source.resize((x2 - x1, y2 - y1), RESIZE_FILTERS.get(self.resize_filter, DEFAULT_RESIZE_FILTER), box=box)
+
+    def create_from_tiles(self, top_level):
+        """Creates all levels below top_level from the tiles already saved in the store."""
+        for level in reversed(range(top_level)):
+
+            if (DEB):
+                print("Pyramid level %d from tiles" % level)
+
+            # row by row, so that neighbouring tiles share their decoded children
+            columns, rows = self.descriptor.get_num_tiles(level)
+            tiles = [(column, row) for row in range(rows) for column in range(columns)]
+            self.save_tiles(level, tiles)
+
+    def compose_tile(self, level, column, row):
+        """Composes a tile from the tiles of the level above and halves it.
+
+        The tile with its overlap maps onto a region of the level above that
+        reaches into neighbours of the four child tiles. The region is pasted
+        from the non-overlapping parts of the child tiles and reduced with a
+        2x2 box filter, which matches reducing the whole level image."""
+        child_level = level + 1
+        child_width, child_height = self.descriptor.get_dimensions(child_level)
+        x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+        region = (2 * x1, 2 * y1, min(2 * x2, child_width), min(2 * y2, child_height))
+        return self.paste_tiles(child_level, region).reduce(2)
+
+    def paste_tiles(self, level, region):
+        """Returns the region (x1, y1, x2, y2) of a level image, pasted from
+        the non-overlapping parts of its tiles."""
+        columns, rows = self.descriptor.get_num_tiles(level)
+        composite = None
+        size = self.tile_size
+        for row in range(region[1] // size, min((region[3] - 1) // size + 1, rows)):
+            for column in range(region[0] // size, min((region[2] - 1) // size + 1, columns)):
+                tile = self.load_tile(level, column, row)
+                if composite is None:
+                    composite = Image.new(tile.mode, (region[2] - region[0], region[3] - region[1]))
+
+                # part of the region that lies in the tile without its overlap
+                core = (
+                    max(column * size, region[0]),
+                    max(row * size, region[1]),
+                    min((column + 1) * size, region[2]),
+                    min((row + 1) * size, region[3]),
+                )
+                tx, ty = self.descriptor.get_tile_bounds(level, column, row)[:2]
+                piece = tile.crop((core[0] - tx, core[1] - ty, core[2] - tx, core[3] - ty))
+                composite.paste(piece, (core[0] - region[0], core[1] - region[1]))
+
+        return composite
+
+    def load_tile(self, level, column, row):
+        """Returns a decoded tile, keeping the recently used ones in memory."""
+        key = (level, column, row)
+        if key in self.tile_cache:
+            self.tile_cache.move_to_end(key)
+            return self.tile_cache[key]
+
+        with Image.open(io.BytesIO(self.store.read(level, column, row))) as tile_file:
+            tile = tile_file.copy()
+
+        self.tile_cache[key] = tile
+        if len(self.tile_cache) > TILE_CACHE_SIZE:
+            self.tile_cache.popitem(last=False)
+        return tile
+
+
+def _crop_tiles_worker(creator, store, level, tiles, source, shape, origin):
+    """Saves tiles cropped from a level image; runs in a worker process.
+
+    source is the name of the shared memory with the image, or the
+    (path, offset) of a file that holds it, which is mapped read-only.
+    Returns the batch of tiles that the parent has to write, if any,
+    and the stats of the saved tiles."""
+    creator.store = store
+    left, top = origin
+    shm = None
+    if isinstance(source, tuple):
+        image = np.memmap(source[0], dtype=np.uint8, mode="r", shape=shape, offset=source[1])
+    else:
+        shm = shared_memory.SharedMemory(name=source)
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        for (column, row) in tiles:
+            x1, y1, x2, y2 = creator.descriptor.get_tile_bounds(level, column, row)
+            with creator.profile.stage("crop", (x2 - x1) * (y2 - y1)):
+                tile = _crop_image(image, (x1 - left, y1 - top, x2 - left, y2 - top))
+            creator.save_tile(tile, level, column, row)
+    finally:
+        del image
+        if shm is not None:
+            shm.close()
+    return _worker_results(creator, store)
+
+def _compose_tiles_worker(creator, store, level, tiles):
+    """Saves tiles composed from the tiles of the level above; runs in a worker process.
+
+    Returns the batch of tiles that the parent has to write, if any,
+    and the stats of the saved tiles."""
+    creator.store = store
+    creator.compose_tiles(level, tiles)
+    return _worker_results(creator, store)
+
+def _worker_results(creator, store):
+    """Batch of tiles for the parent, or None once the worker wrote its
+    tiles itself, and the encoding and writing stats and the profile of
+    the worker."""
+    if isinstance(store, _TileBatch):
+        return store, creator.encode_stats, None, creator.profile
+    store.close()
+    return None, creator.encode_stats, store.write_stats, creator.profile
+
+def _crop_image(image, box):
+    """Crops a PIL image, or copies the box from an array view of a 2-D uint8 array."""
+    if isinstance(image, np.ndarray):
+        x1, y1, x2, y2 = box
+        return Image.fromarray(np.ascontiguousarray(image[y1:y2, x1:x2]))
+    return image.crop(box)
+
+def _balanced_chunks(items, num_chunks):
+    """Splits a list into at most num_chunks contiguous chunks whose lengths differ by at most one."""
+    num_chunks = max(1, min(num_chunks, len(items)))
+    size, extra = divmod(len(items), num_chunks)
+    chunks = []
+    start = 0
+    for i in range(num_chunks):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def _png_filter_up(rows):
+    """Returns the rows of an image filtered with the PNG up filter and
+    prefixed with its filter type."""
+    height, width = rows.shape
+    filtered = np.empty((height, width + 1), dtype=np.uint8)
+    filtered[:, 0] = PNG_FILTER_UP
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:]) # modulo 256
+    return filtered
+
+def _encode_png(tile, encodings):
+    """Encodes an 8-bit image as PNG with every (row filter, zlib level,
+    zlib strategy) of encodings and returns the smallest result; Pillow
+    encodes those without a row filter, the only other one is "up"."""
+    width, height = tile.size
+    bpp = len(tile.getbands())
+    rows = None
+
+    best = None
+    for row_filter, level, strategy in encodings:
+        if row_filter is None:
+            tile_file = io.BytesIO()
+            tile.save(tile_file, "PNG", compress_level=level, compress_type=strategy)
+            data = tile_file.getvalue()
+        else:
+            if rows is None:
+                rows = np.asarray(tile).reshape(height, width * bpp)
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+            idat = compressor.compress(_png_filter_up(rows).tobytes()) + compressor.flush()
+            header = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[tile.mode], 0, 0, 0)
+            data = (PNG_SIGNATURE + _png_chunk(b"IHDR", header) + _png_chunk(b"IDAT", idat)
+                    + _png_chunk(b"IEND", b""))
+        if best is None or len(data) < len(best):
+            best = data
+    return best
+
+
+class _StripLevel(object):
+    """Rows of a single pyramid level that are kept while tiling a stream of strips."""
+
+    def __init__(self, level):
+        self.level = level
+        self.buffer = None # rows not yet covered by saved tiles
+        self.top = 0 # y coordinate of the first buffered row in the level
+        self.row = 0 # next row of tiles to save
+        self.carry = None # odd row waiting to be reduced with the next strip
+
+
+def _stack_strips(upper, lower):
+    """Joins two full-width strips vertically; either may be None."""
+    if upper is None or upper.size[1] == 0:
+        return lower
+    if lower is None or lower.size[1] == 0:
+        return upper
+    stacked = Image.new(upper.mode, (upper.size[0], upper.size[1] + lower.size[1]))
+    stacked.paste(upper, (0, 0))
+    stacked.paste(lower, (0, upper.size[1]))
+    return stacked
 
 
 def _get_or_create_path(path):
@@ -283,6 +1089,809 @@ def _clamp(val, min, max):
 ####
 
 
+####
+## Stores of the tiles of a pyramid: _files folders written by a pool of
+## threads and single-file packs, their checkpoint logs, and statistics
+## and profiles of encoding, writing and the stages of a run
+
+# ioctl of Linux that makes a file share the blocks of another one
+FICLONE = 0x40049409
+
+# Layout of a tile pack (.dzp), see TilePack
+PACK_MAGIC = b"DZPACK01"
+PACK_INDEX_MAGIC = b"DZPINDEX"
+PACK_FOOTER = struct.Struct("<8sQQ") # index magic, offset of the index, number of entries
+PACK_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+# A tile pack is rewritten without the bytes of replaced tiles and old
+# indexes once they are more than this fraction of the pack
+PACK_COMPACT_FRACTION = 0.5
+
+# Tile files are handed to the writer threads of a TileWriter in batches of
+# this many files, and a TilePack logs its tiles in batches of this many;
+# queueing blocks while this many batches per thread wait
+WRITE_BATCH_SIZE = 64
+WRITE_QUEUE_BATCHES = 2
+
+# When written tiles are forced to disk with fsync:
+# none - left to the operating system,
+# tiles - every tile file before it is closed,
+# close - all files once the tiles of a store are written (os.sync)
+SYNC_POLICIES = ("none", "tiles", "close")
+
+# How tiles in the checkpoint log of an interrupted run are checked before a
+# resumed run keeps them:
+# size - the file or the pack holds as many bytes as were written,
+# hash - the bytes also have the hash of the written tile
+RESUME_CHECKS = ("size", "hash")
+
+class TileFolder(object):
+    """Tiles saved as files <level>/<column>_<row>.<format> in the _files folder of a DZI.
+
+    Files are written by the threads of a TileWriter; tiles that are read
+    are waited for. The writer logs the written files in its checkpoint
+    log, from which an interrupted run is resumed."""
+
+    shared = True # worker processes write tiles themselves
+
+    def __init__(self, destination, tile_format, writer=None):
+        self.path = _get_files_path(destination)
+        self.tile_format = tile_format
+        self.writer = TileWriter() if writer is None else writer
+
+    @property
+    def write_stats(self):
+        return self.writer.stats
+
+    def open(self, descriptor, append=False, resumed=None):
+        """Creates the level folders; the checkpoint log is started anew unless tiles are resumed."""
+        if resumed is None and self.writer.checkpoint is not None:
+            _remove_file(self.writer.checkpoint)
+        for level in range(descriptor.num_levels):
+            _get_or_create_path(os.path.join(self.path, str(level)))
+
+    def load_checkpoint(self, check="size"):
+        """Returns the tiles of the checkpoint log whose files are intact, with their paths.
+
+        A link is intact if its source is and the file has the size (and
+        hash) of the source."""
+        base = os.path.dirname(self.writer.checkpoint)
+        records = OrderedDict() # path relative to the log -> its last record
+        for record in _read_checkpoint(self.writer.checkpoint):
+            records[record["path"]] = record
+
+        intact = set()
+        resumed = {}
+        for path, record in records.items():
+            if "link" in record:
+                if record["link"] not in intact:
+                    continue
+                record = records[record["link"]]
+            if _file_intact(os.path.join(base, path), record["size"], record["hash"], check):
+                intact.add(path)
+                level, name = os.path.split(os.path.relpath(os.path.join(base, path), self.path))
+                column, row = os.path.splitext(name)[0].split("_")
+                resumed[(int(level), int(column), int(row))] = os.path.join(base, path)
+        return resumed
+
+    def close(self):
+        """Waits until all tiles are written."""
+        self.writer.close()
+
+    def flush(self):
+        self.writer.flush()
+
+    def tile_path(self, level, column, row):
+        return os.path.join(self.path, str(level), "%s_%s.%s" % (column, row, self.tile_format))
+
+    def write(self, level, column, row, data):
+        """Queues an encoded tile; returns its location for link."""
+        tile_path = self.tile_path(level, column, row)
+        self.writer.write(tile_path, data)
+        return tile_path
+
+    def link(self, location, level, column, row):
+        """Queues a hard link (or copy) of a saved tile."""
+        self.writer.link(location, self.tile_path(level, column, row))
+        return True
+
+    def read(self, level, column, row):
+        tile_path = self.tile_path(level, column, row)
+        self.writer.wait(tile_path)
+        with open(tile_path, "rb") as tile_file:
+            return tile_file.read()
+
+    def level_reader(self, level):
+        return self
+
+
+class TileWriter(object):
+    """Writes tile files in batches with a pool of threads.
+
+    Writes and links are queued in order and handed to the threads in
+    batches of WRITE_BATCH_SIZE files. A thread opens one file at a time and
+    closes it, after an fsync with the tiles sync policy, before it opens
+    the next, so at most one file per thread is open. A link waits for the
+    batch that writes its source. Queueing blocks while WRITE_QUEUE_BATCHES
+    batches per thread wait, which bounds the memory of queued tiles.
+
+    Once a batch is written, the files are appended to the checkpoint log,
+    if there is one, with their size and hash; a link with its source.
+
+    An atomic writer writes every file under a temporary name and renames
+    it, so that readers find the old file or the new one.
+
+    Errors of the threads are raised by the next flush or close."""
+
+    def __init__(self, threads=4, sync="none", checkpoint=None, atomic=False):
+        self.threads = max(1, int(threads))
+        self.sync = sync
+        self.checkpoint = checkpoint
+        self.atomic = atomic
+        self.stats = WriteStats()
+        self.reset()
+
+    def reset(self):
+        self.executor = None
+        self.batch = [] # (source of a link or None, path, data)
+        self.batch_paths = set()
+        self.pending = {} # path -> future of the batch that writes it
+        self.slots = threading.BoundedSemaphore(self.threads * WRITE_QUEUE_BATCHES)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """Sent to worker processes without the threads and the queued files."""
+        state = self.__dict__.copy()
+        for key in ("executor", "batch", "batch_paths", "pending", "slots", "lock"):
+            state.pop(key)
+        state["stats"] = WriteStats()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+    def write(self, path, data):
+        self.queue((None, path, data))
+
+    def link(self, source, path):
+        self.queue((source, path, None))
+
+    def queue(self, item):
+        self.batch.append(item)
+        self.batch_paths.add(item[1])
+        if len(self.batch) >= WRITE_BATCH_SIZE:
+            self.submit()
+
+    def submit(self):
+        """Hands the queued files to the threads."""
+        if not self.batch:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+        with self.lock:
+            # forget written batches; errors are raised here
+            for path, future in list(self.pending.items()):
+                if future.done():
+                    del self.pending[path]
+                    future.result()
+            # batches that write the sources of links, unless this one does
+            depends = {self.pending[source] for source, path, data in self.batch
+                       if source is not None and source not in self.batch_paths and source in self.pending}
+
+        self.slots.acquire()
+        future = self.executor.submit(self.write_batch, self.batch, depends)
+        with self.lock:
+            for source, path, data in self.batch:
+                self.pending[path] = future
+        self.batch = []
+        self.batch_paths = set()
+
+    def write_batch(self, batch, depends):
+        """Writes the files of a batch; runs in a writer thread."""
+        try:
+            for future in depends:
+                future.result()
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            size = 0
+            for source, path, data in batch:
+                # never write through a link that other tiles share
+                target = path + ".tmp" if self.atomic else path
+                _remove_file(target)
+                if source is not None:
+                    if not _link_file(source, target):
+                        raise OSError("Cannot link or copy %s to %s" % (source, path))
+                else:
+                    with open(target, "wb") as tile_file:
+                        tile_file.write(data)
+                        if self.sync == "tiles":
+                            tile_file.flush()
+                            os.fsync(tile_file.fileno())
+                    size += len(data)
+                if self.atomic:
+                    os.replace(target, path)
+            if self.checkpoint is not None:
+                self.log_batch(batch)
+            with self.lock:
+                self.stats.add(len(batch), size, time.perf_counter() - start, time.thread_time() - cpu_start)
+        finally:
+            self.slots.release()
+
+    def log_batch(self, batch):
+        """Appends the written files of a batch to the checkpoint log, with paths relative to the log."""
+        base = os.path.dirname(self.checkpoint)
+        records = []
+        for source, path, data in batch:
+            if source is None:
+                records.append({"path": os.path.relpath(path, base), "size": len(data), "hash": _checkpoint_hash(data)})
+            else:
+                records.append({"path": os.path.relpath(path, base), "link": os.path.relpath(source, base)})
+        _append_checkpoint(self.checkpoint, records, self.sync == "tiles")
+
+    def wait(self, path):
+        """Waits until a queued file is written."""
+        if path in self.batch_paths:
+            self.submit()
+        with self.lock:
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+
+    def flush(self):
+        """Waits until all queued files are written."""
+        self.submit()
+        with self.lock:
+            futures = set(self.pending.values())
+            self.pending = {}
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Writes all queued files and stops the threads."""
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.sync == "close" and hasattr(os, "sync"):
+            os.sync()
+
+
+class TilePack(object):
+    """All tiles of a Deep Zoom image in a single file, <name>.dzp next to the DZI.
+
+    The file starts with PACK_MAGIC, followed by the encoded tiles, appended
+    as they are saved. Closing the pack appends the index, a PACK_ENTRY of
+    offset and length for every tile, level by level and row by row, and the
+    PACK_FOOTER that points at the index. A tile identical to a saved one is
+    an entry pointing at the same bytes; an entry of length 0 is a missing
+    tile. An update appends the new tiles, a new index and footer after the
+    old ones, which stay in the file as unreferenced bytes; the bytes of a
+    complete pack are never overwritten, so readers that map it are not
+    disturbed. An update that was interrupted left tiles after the last
+    footer, which the next update cuts off. Once the unreferenced bytes are
+    more than PACK_COMPACT_FRACTION of the pack, closing it rewrites the
+    pack without them, see compact_pack.
+
+    Saved tiles are logged with their location and hash in the checkpoint
+    log, if there is one, in batches of WRITE_BATCH_SIZE tiles, once their
+    bytes are flushed to the pack; a resumed run reopens the pack of an
+    interrupted one, which has no index yet, and appends the tiles that are
+    missing.
+
+    Only the process that opened the pack writes to it."""
+
+    shared = False
+
+    def __init__(self, destination, sync="none", checkpoint=None):
+        self.path = _get_pack_path(destination)
+        self.checkpoint = checkpoint
+        self.sync = sync
+        self.write_stats = WriteStats()
+        self.index = None # per level: PACK_ENTRY array of rows x columns
+        self.file = None # open for appending
+        self.records = [] # checkpoint records of the tiles written since the last flush
+        self.reader = None # open for reading
+        self.end = 0 # offset where the next tile is appended
+        self.unflushed = False
+
+    def __getstate__(self):
+        """Leaves out the open files when sent to worker processes."""
+        state = self.__dict__.copy()
+        state["file"] = None
+        state["reader"] = None
+        state["records"] = []
+        return state
+
+    def open(self, descriptor, append=False, resumed=None):
+        self.index = [np.zeros(descriptor.get_num_tiles(level)[::-1], dtype=PACK_ENTRY)
+                      for level in range(descriptor.num_levels)]
+
+        if resumed is not None and os.path.isfile(self.path):
+            self.file = open(self.path, "r+b")
+            for (level, column, row), location in resumed.items():
+                self.index[level][row, column] = location
+            self.end = self.file.seek(0, os.SEEK_END)
+            return
+
+        if append and os.path.isfile(self.path):
+            self.file = open(self.path, "r+b")
+            num_entries = sum(level.size for level in self.index)
+            try:
+                entries = read_pack_index(self.file)[1]
+            except ValueError:
+                end = _find_pack_end(self.file, num_entries)
+                if end is None:
+                    self.file.close()
+                    raise
+                self.file.truncate(end)
+                entries = read_pack_index(self.file)[1]
+            if entries.size != num_entries:
+                self.file.close()
+                raise ValueError("Tile pack %s does not match the image" % self.path)
+            start = 0
+            for level in self.index:
+                level.ravel()[:] = entries[start:start + level.size]
+                start += level.size
+
+            self.end = self.file.seek(0, os.SEEK_END)
+        else:
+            _get_or_create_path(os.path.dirname(os.path.abspath(self.path)))
+            # a new file, as the old one may be mapped by a tile server
+            _remove_file(self.path)
+            self.file = open(self.path, "wb")
+            self.file.write(PACK_MAGIC)
+            self.end = len(PACK_MAGIC)
+        if self.checkpoint is not None:
+            _remove_file(self.checkpoint)
+
+    def load_checkpoint(self, check="size"):
+        """Returns the tiles of the checkpoint log that are intact in the pack, with their locations."""
+        records = OrderedDict() # (level, column, row) -> its last record
+        for record in _read_checkpoint(self.checkpoint):
+            records[tuple(record["tile"])] = record
+
+        resumed = {}
+        if not records or not os.path.isfile(self.path):
+            return resumed
+        intact = set()
+        with open(self.path, "rb") as pack_file:
+            size = pack_file.seek(0, os.SEEK_END)
+            for tile, record in records.items():
+                location = tuple(record["at"])
+                if "hash" in record:
+                    if location[0] + location[1] > size:
+                        continue
+                    if check == "hash":
+                        pack_file.seek(location[0])
+                        if _checkpoint_hash(pack_file.read(location[1])) != record["hash"]:
+                            continue
+                    intact.add(location)
+                elif location not in intact:
+                    continue
+                resumed[tile] = location
+        return resumed
+
+    def close(self):
+        """Appends the index and the footer, which completes the pack."""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.file is None:
+            return
+        self.flush()
+        entries = np.concatenate([level.ravel() for level in self.index])
+        self.file.write(entries.tobytes())
+        self.file.write(PACK_FOOTER.pack(PACK_INDEX_MAGIC, self.end, entries.size))
+        if self.sync != "none":
+            # the tiles were synced with their batches for the tiles policy
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+        size = self.end + entries.nbytes + PACK_FOOTER.size
+        if _pack_dead_bytes(entries, self.end) > PACK_COMPACT_FRACTION * size:
+            compact_pack(self.path, self.sync)
+            # the logged locations are gone
+            if self.checkpoint is not None:
+                _remove_file(self.checkpoint)
+
+    def write(self, level, column, row, data):
+        """Appends an encoded tile; returns its location (offset, length) for link."""
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        self.file.write(data)
+        self.write_stats.add(1, len(data), time.perf_counter() - start, time.thread_time() - cpu_start)
+        location = (self.end, len(data))
+        self.index[level][row, column] = location
+        self.end += len(data)
+        self.unflushed = True
+        self.log_record({"tile": [level, column, row], "at": location, "hash": _checkpoint_hash(data)})
+        return location
+
+    def link(self, location, level, column, row):
+        self.index[level][row, column] = location
+        self.log_record({"tile": [level, column, row], "at": location})
+        return True
+
+    def log_record(self, record):
+        """Queues a record for the checkpoint log; a full batch is flushed."""
+        if self.checkpoint is None:
+            return
+        self.records.append(record)
+        if len(self.records) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def read(self, level, column, row):
+        offset, length = self.index[level][row, column].tolist()
+        if length == 0:
+            raise FileNotFoundError("No tile %d %d_%d in %s" % (level, column, row, self.path))
+        self.flush()
+        if self.reader is None:
+            self.reader = open(self.path, "rb")
+        self.reader.seek(offset)
+        return self.reader.read(length)
+
+    def flush(self):
+        """Flushes the written tiles, then logs them, so that the log never
+        has tiles whose bytes are not in the pack."""
+        if self.unflushed:
+            self.file.flush()
+            if self.sync == "tiles":
+                os.fsync(self.file.fileno())
+            self.unflushed = False
+        if self.records:
+            _append_checkpoint(self.checkpoint, self.records, self.sync == "tiles")
+            self.records = []
+
+    def level_reader(self, level):
+        """Copy of the pack for reading the tiles of a level in a worker process."""
+        self.flush()
+        reader = copy.copy(self)
+        reader.index = {level: self.index[level]}
+        return reader
+
+
+class _TileBatch(object):
+    """Tiles saved in a worker process for a store that only the parent writes to."""
+
+    shared = False
+
+    def __init__(self, reader=None):
+        self.reader = reader # store for reading tiles of the level above
+        self.tiles = [] # (level, column, row, encoded tile or index of the linked tile)
+
+    def write(self, level, column, row, data):
+        self.tiles.append((level, column, row, data))
+        return len(self.tiles) - 1
+
+    def link(self, location, level, column, row):
+        self.tiles.append((level, column, row, location))
+        return True
+
+    def read(self, level, column, row):
+        return self.reader.read(level, column, row)
+
+    def replay(self, store):
+        """Writes the tiles of the batch to store."""
+        locations = []
+        for (level, column, row, data) in self.tiles:
+            if isinstance(data, int):
+                location = locations[data]
+                if not store.link(location, level, column, row):
+                    location = store.write(level, column, row, self.tiles[data][3])
+            else:
+                location = store.write(level, column, row, data)
+            locations.append(location)
+
+
+class EncodeStats(object):
+    """Encoding time and size of every tile encoded by an ImageCreator."""
+
+    def __init__(self):
+        self.seconds = array("d")
+        self.sizes = array("Q")
+
+    def add(self, seconds, size):
+        self.seconds.append(seconds)
+        self.sizes.append(size)
+
+    def merge(self, other):
+        """Adds the tiles of other, e.g. those encoded by a worker process."""
+        self.seconds.extend(other.seconds)
+        self.sizes.extend(other.sizes)
+
+    def summary(self):
+        """Returns the number of tiles, their total size and encoding time,
+        and the mean, median, 95th percentile and maximum of the encoding
+        time (ms) and of the size (bytes) of a tile."""
+        summary = {"tiles": len(self.sizes), "bytes": sum(self.sizes), "seconds": sum(self.seconds)}
+        if self.sizes:
+            for name, values in (("ms", np.frombuffer(self.seconds) * 1000),
+                                 ("size", np.frombuffer(self.sizes, dtype=np.uint64))):
+                summary[name] = {
+                    "mean": float(np.mean(values)),
+                    "median": float(np.median(values)),
+                    "p95": float(np.percentile(values, 95)),
+                    "max": float(np.max(values)),
+                }
+        return summary
+
+
+class WriteStats(object):
+    """Number and size of the tile files written to a store, and the wall
+    and CPU time spent writing them."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.
+        self.cpu_seconds = 0.
+
+    def add(self, files, size, seconds, cpu_seconds=0.):
+        self.files += files
+        self.bytes += size
+        self.seconds += seconds
+        self.cpu_seconds += cpu_seconds
+
+    def merge(self, other):
+        self.add(other.files, other.bytes, other.seconds, other.cpu_seconds)
+
+
+class StageProfile(object):
+    """Number of calls, wall time, CPU time and bytes of every stage of a run,
+    e.g. reading image files, resizing a level or encoding tiles.
+
+    A stage is timed with the context manager returned by stage; its CPU
+    time is that of the calling thread. A disabled profile times nothing.
+    Profiles of worker processes are merged into that of the parent."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = OrderedDict() # name -> [calls, wall seconds, CPU seconds, bytes]
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("lock")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stage(self, name, size=0):
+        """Context manager that times a stage handling size bytes; the size can also be set on it."""
+        if not self.enabled:
+            return _NO_STAGE
+        return _StageTimer(self, name, size)
+
+    def add(self, name, seconds, cpu_seconds, size=0, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0., 0., 0])
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] += cpu_seconds
+            stage[3] += size
+
+    def merge(self, other):
+        for name, (calls, seconds, cpu_seconds, size) in other.stages.items():
+            self.add(name, seconds, cpu_seconds, size, calls)
+
+
+class _StageTimer(object):
+    """Times a stage of a StageProfile."""
+
+    def __init__(self, profile, name, size=0):
+        self.profile = profile
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add(self.name, time.perf_counter() - self.start,
+                         time.thread_time() - self.cpu_start, self.size)
+
+
+class _NoStageTimer(object):
+    """Stands in for _StageTimer in a disabled profile."""
+
+    size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_STAGE = _NoStageTimer()
+
+
+def read_pack_index(pack_file):
+    """Reads the footer and the index of an open tile pack.
+
+    Returns the offset of the index and its PACK_ENTRY array."""
+    pack_file.seek(0, os.SEEK_END)
+    size = pack_file.tell()
+    pack_file.seek(max(0, size - PACK_FOOTER.size))
+    index_offset, num_entries = read_pack_footer(pack_file.read(PACK_FOOTER.size), size)
+    pack_file.seek(index_offset)
+    entries = np.frombuffer(pack_file.read(num_entries * PACK_ENTRY.itemsize), dtype=PACK_ENTRY)
+    return index_offset, entries
+
+
+def _pack_dead_bytes(entries, end):
+    """Bytes of a pack up to end that no index entry points at; entries
+    that share bytes count them once."""
+    used = np.unique(entries[entries["length"] > 0])
+    return end - len(PACK_MAGIC) - int(used["length"].sum())
+
+
+def compact_pack(path, sync="none"):
+    """Rewrites a tile pack with only the tiles of its index.
+
+    The tiles are copied in the order of their offsets to a new file, which
+    then replaces the pack at once, so that readers that map the old one
+    are not disturbed. Entries that shared bytes share them in the new pack
+    as well. Returns the number of bytes saved."""
+    with open(path, "rb") as pack_file:
+        size = pack_file.seek(0, os.SEEK_END)
+        entries = read_pack_index(pack_file)[1].copy()
+        used = entries["length"] > 0
+        # every distinct (offset, length) once, and where each entry points to
+        locations, inverse = np.unique(entries[used], return_inverse=True)
+        offsets = np.cumsum(locations["length"], dtype=np.uint64) - locations["length"] + len(PACK_MAGIC)
+        entries["offset"][used] = offsets[inverse.ravel()]
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as compact_file:
+            compact_file.write(PACK_MAGIC)
+            for offset, length in locations.tolist():
+                pack_file.seek(offset)
+                compact_file.write(pack_file.read(length))
+            end = compact_file.tell()
+            compact_file.write(entries.tobytes())
+            compact_file.write(PACK_FOOTER.pack(PACK_INDEX_MAGIC, end, entries.size))
+            if sync != "none":
+                compact_file.flush()
+                os.fsync(compact_file.fileno())
+            saved = size - compact_file.tell()
+    os.replace(temp_path, path)
+    return saved
+
+
+def _find_pack_end(pack_file, num_entries):
+    """End of the last complete footer with num_entries index entries in an
+    open tile pack, or None; tiles after it were appended by an update that
+    was interrupted."""
+    pack_map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        footer = len(pack_map)
+        while True:
+            footer = pack_map.rfind(PACK_INDEX_MAGIC, 0, footer)
+            if footer < 0:
+                return None
+            end = footer + PACK_FOOTER.size
+            try:
+                if read_pack_footer(pack_map[footer:end], end)[1] == num_entries:
+                    return end
+            except (ValueError, struct.error):
+                pass
+    finally:
+        pack_map.close()
+
+
+def read_pack_footer(footer, size):
+    """Returns the offset of the index and the number of its entries from the footer of a pack of size bytes."""
+    if size < len(PACK_MAGIC) + PACK_FOOTER.size:
+        raise ValueError("Not a complete tile pack")
+    magic, index_offset, num_entries = PACK_FOOTER.unpack(footer)
+    if magic != PACK_INDEX_MAGIC or index_offset + num_entries * PACK_ENTRY.itemsize + PACK_FOOTER.size != size:
+        raise ValueError("Not a complete tile pack")
+    return index_offset, num_entries
+
+
+def _tile_key(tile):
+    """Key of the tile content; uniform tiles are recognised without hashing."""
+    extrema = tile.getextrema()
+    if len(tile.getbands()) == 1:
+        extrema = (extrema,)
+    if all(low == high for (low, high) in extrema):
+        return (tile.mode, tile.size, tuple(low for (low, high) in extrema))
+    return (tile.mode, tile.size, hashlib.blake2b(tile.tobytes(), digest_size=16).digest())
+
+def _checkpoint_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+def _append_checkpoint(path, records, sync=False):
+    """Appends JSON records, one per line, to a checkpoint log in a single write.
+
+    The log is opened for appending, so that processes can share it."""
+    log_file = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(log_file, "".join(json.dumps(record) + "\n" for record in records).encode())
+        if sync:
+            os.fsync(log_file)
+    finally:
+        os.close(log_file)
+
+def _read_checkpoint(path):
+    """Records of a checkpoint log; a line cut short by an interruption ends it."""
+    try:
+        with open(path) as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+    except FileNotFoundError:
+        return
+
+def _file_intact(path, size, hash, check):
+    """True if the file has the size and, for the hash check, the hash of the written data."""
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        if check == "hash":
+            with open(path, "rb") as tile_file:
+                return _checkpoint_hash(tile_file.read()) == hash
+    except OSError:
+        return False
+    return True
+
+def _link_file(source, destination):
+    """Links or copies an existing file; returns False if that is not possible."""
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        pass
+    try:
+        shutil.copyfile(source, destination)
+        return True
+    except OSError:
+        return False
+
+def _free_space(path):
+    """Bytes available to this process in the file system of path."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+def _clone_file(source, destination):
+    """Clones a file as a reflink, whose copy shares the blocks of the source,
+    e.g. on btrfs or XFS; returns False, leaving no copy, where the file
+    system cannot."""
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            pass
+    _remove_file(destination)
+    return False
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _get_pack_path(path):
+    return os.path.splitext(path)[0] + ".dzp"
+
+def _get_checkpoint_path(path):
+    return os.path.splitext(path)[0] + "_checkpoint.log"
+
+## end of section on the stores of tiles
+####
+
+
 def parseArguments():
         # Create argument parser
         parser = argparse.ArgumentParser()
@@ -349,17 +1958,34 @@ def parseArguments():
         parser.add_argument(
                 '-I',
                 '--imint',
-                help='Image intensities for rescaling. Provide two integers separated by a white space; default (250, 3000)',
+                help='Image intensities for rescaling. Provide two integers separated by a white space; repeat the option to set them for every channel in -c; default (250, 3000)',
+                nargs=2,
+                type=int,
+                action='append',
+                default=None)
+
+        parser.add_argument(
+                '-A',
+                '--autocontrast',
+                help='Choose the image intensities for rescaling of every channel instead of -I: the given lower and upper percentiles, e.g. 0.1 99.9, of the intensities of its images',
                 nargs=2,
+                type=float,
+                default=None)
+
+        parser.add_argument(
+                '-e',
+                '--every',
+                help='With -A, percentiles of every n-th image file of a channel, default 10; 1 reads all files',
                 type=int,
-                default=(250, 3000))
+                default=10)
 
         parser.add_argument(
                 '-c',
                 '--imch',
-                help='Channel of the image to process, default 0',
-                type=int,
-                default=0)
+                help='Channels of the image to process, e.g. -c 0,1,2 or -c 0 -c 1 -c 2; with more than one channel, output files are suffixed with _c0, _c1, ...; default 0',
+                type=str,
+                action='append',
+                default=None)
 
         parser.add_argument(
                 '-x',
@@ -368,13 +1994,34 @@ def parseArguments():
                 type=str,
                 default='TIFF')
 
+        parser.add_argument(
+                '-n',
+                '--names',
+                help='Regular expression for the names of image files, with the groups row (a letter, or a number from 1), col (from 1), fov (from 0) and ch; default the A01f00d0.TIFF convention with the extension -x',
+                type=str,
+                default=None)
+
         parser.add_argument(
                 '-r',
                 '--cores',
-                help='Number of cores for multiprocessing, default 4 (NOT USED)',
+                help='Number of worker processes for making the DeepZoom pyramid, default 4',
                 type=int,
                 default=4)
 
+        parser.add_argument(
+                '-R',
+                '--readers',
+                help='Number of threads reading image files, default 8',
+                type=int,
+                default=8)
+
+        parser.add_argument(
+                '-d',
+                '--readahead',
+                help='Number of wells to read ahead of the one being processed, default 2',
+                type=int,
+                default=2)
+
         parser.add_argument(
                 '-t',
                 '--tilesz',
@@ -385,92 +2032,703 @@ def parseArguments():
         parser.add_argument(
                 '-q',
                 '--imquality',
-                help='Image quality (0.1 - 1) for JPG or compression level for PNG, default 0.8.',
+                help='Image quality (0.1 - 1) for JPG and WebP (1 for lossless WebP), default 0.8; PNG tiles are lossless and use -E instead.',
                 type=float,
                 default=0.8)
 
+        parser.add_argument(
+                '-F',
+                '--format',
+                help='Format of the tiles, default png',
+                type=str,
+                choices=list(IMAGE_FORMATS),
+                default=DEFAULT_IMAGE_FORMAT)
+
+        parser.add_argument(
+                '-E',
+                '--effort',
+                help='Encoder setting: fastest encoding, smallest tiles or balanced, default balanced; for PNG, it sets the row filters and the zlib level and strategy. With -v, the encoding time and size of the tiles are reported.',
+                type=str,
+                choices=ENCODER_EFFORTS,
+                default=DEFAULT_ENCODER_EFFORT)
+
+        parser.add_argument(
+                '-P',
+                '--pyramid',
+                help='How lower pyramid levels are made: resize the level above (resize) or compose tiles from the tiles of the level above (tiles), default resize',
+                type=str,
+                choices=PYRAMID_MODES,
+                default='resize')
+
+        parser.add_argument(
+                '-N',
+                '--nodedup',
+                help='Encode every tile, also those identical to a tile saved before; by default, they are hard-linked to the saved file.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-k',
+                '--pack',
+                help='Store all tiles of a DZI in a single pack file, <outfile>.dzp, instead of the _files folder.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-W',
+                '--writers',
+                help='Number of threads per process writing tile files, default 4',
+                type=int,
+                default=4)
+
+        parser.add_argument(
+                '-Y',
+                '--sync',
+                help='When written tiles are forced to disk: never (none), every tile file (tiles) or once all tiles of a DZI are written (close), default none',
+                type=str,
+                choices=SYNC_POLICIES,
+                default='none')
+
+        parser.add_argument(
+                '-u',
+                '--update',
+                help='Only tile again the wells whose image files changed since the last run, according to the manifest saved next to the DZI files.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-z',
+                '--resume',
+                help='Continue an interrupted run with the same parameters: keep the tiles it saved, checked as set by -Z, and skip wells whose tiles are all kept. Not with -u.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-Z',
+                '--resumecheck',
+                help='How -z checks the saved tiles: by their size (size) or also by their hash (hash), default size',
+                type=str,
+                choices=RESUME_CHECKS,
+                default='size')
+
+        parser.add_argument(
+                '-s',
+                '--stream',
+                help='Build the pyramid one row of wells at a time to limit memory use; lower levels are reduced with a 2x2 box filter.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-a',
+                '--stats',
+                help='Save intensity statistics of the raw images of every well and FOV as CSV tables for the heatmap of the viewer next to the DZI files',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-T',
+                '--profile',
+                help='Time the stages of the run, from reading image files to writing tiles; prints a summary table and saves the report in <outfile>_profile.json in the output folder.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-M',
+                '--memmap',
+                help='Assemble the montage of the entire plate in memory-mapped files in this folder, e.g. on a local scratch disk, instead of in memory; for plates larger than the memory, together with -P tiles. Not with -s.',
+                type=str,
+                default=None)
+
+        parser.add_argument(
+                '-S',
+                '--serve',
+                help='Do not make the pyramid; serve the output folder with the viewer on this port and render tiles from the image files on request.',
+                type=int,
+                default=None)
+
+        parser.add_argument(
+                '-C',
+                '--cachesize',
+                help='Disk space in MB for tiles rendered with -S, kept in <outfile>_cache in the output folder; default 1024',
+                type=int,
+                default=1024)
+
         # Parse arguments
         args = parser.parse_args()
         args.platedim = tuple(args.platedim)
         args.welldim = tuple(args.welldim)
         args.imdim = tuple(args.imdim)
 
-        return args
-
-def processWell(inRow, inCol):
-    # create canvas for the montage
-    locImWell = Image.new(imMode, (imWellWidth, imWellHeight), bgEmptyWell)
+        # Channels of repeated -c options and of comma-separated lists
+        if args.imch is None:
+            args.imch = ['0']
+        try:
+            args.imch = [int(locCh) for locChs in args.imch for locCh in locChs.split(',')]
+        except ValueError:
+            parser.error('-c/--imch needs channel numbers, e.g. -c 0,1 or -c 0 -c 1')
+
+        # The streamed montage is never held as a whole
+        if args.memmap is not None and args.stream:
+            parser.error('-M/--memmap and -s/--stream exclude each other')
+
+        # Intensity range for every channel, unless chosen by -A
+        if args.autocontrast is not None:
+            if args.imint is not None:
+                parser.error('-A/--autocontrast and -I/--imint exclude each other')
+            if not 0 <= args.autocontrast[0] < args.autocontrast[1] <= 100:
+                parser.error('-A/--autocontrast needs percentiles with 0 <= lower < upper <= 100')
+            if args.every < 1:
+                parser.error('-e/--every has to be at least 1')
+        if args.imint is None:
+            args.imint = [(250, 3000)]
+        if len(args.imint) == 1:
+            args.imint = args.imint * len(args.imch)
+        elif len(args.imint) != len(args.imch):
+            parser.error('-I/--imint has to be given once, or once for every channel in -c')
+        args.imint = [tuple(locInt) for locInt in args.imint]
+
+        # Groups of the pattern of file names
+        if args.names is not None:
+            try:
+                locGroups = re.compile(args.names).groupindex
+            except re.error as e:
+                parser.error('-n/--names is not a valid regular expression: %s' % e)
+            if not {'row', 'col', 'fov', 'ch'} <= set(locGroups):
+                parser.error('-n/--names needs the groups (?P<row>...), (?P<col>...), (?P<fov>...) and (?P<ch>...)')
 
-    locIrow = inRow
-    locIcol = inCol
+        return args
 
-    # Read images of FOVs of a single well
-    # Assumption: image files are named according to a convetion xxxx_A01f00d1
-    # A01 - well
-    # f00 - fov
-    # d1 - channel
+def fovPath(inRow, inCol, inFov, inCh):
+    # Path of the image file of a FOV as found in the input folder;
+    # the name of the convention if it is missing
+    if imIndex is not None and (inRow, inCol, inFov, inCh) in imIndex.files:
+        return imIndex.files[(inRow, inCol, inFov, inCh)]
+#    return "%s%02df%02dd%d.%s" % (imDir + '/' + imCore + inRow, inCol, inFov, inCh, imExt)
+    return "%s%02df%02dd%d.%s" % (imDir + '/' + inRow, inCol, inFov, inCh, imExt)
+
+# Stages of the run timed with -T; set up in main
+imProfile = StageProfile()
+
+# Image files of the input folder; set up in main
+imIndex = None
+
+def readFOV(inPath):
+    # Handle errors if the image file is inaccessible/corrupt;
+    # returns None if the image cannot be used. Files that are not in the
+    # index of the input folder are missing and are not opened
+    if imIndex is not None and inPath not in imIndex.paths:
+        return None
+
+    try:
+        # the file is read before it is decoded, so that both are timed
+        with imProfile.stage('read') as locTimer:
+            with open(inPath, 'rb') as locFile:
+                locData = locFile.read()
+            locTimer.size = len(locData)
+
+        with imProfile.stage('decode', len(locData)):
+            locImFOV = imageio.imread(locData)
+    except FileNotFoundError:
+        return None
+    except (IOError, SyntaxError, IndexError, ValueError) as e:
+        print('Corrupted file:', inPath)
+        return None
+
+    return locImFOV
+
+def statFOV(inPath):
+    # os.stat of an image file; None if the file is missing
+    if imIndex is not None and inPath not in imIndex.paths:
+        return None
+
+    try:
+        with imProfile.stage('stat'):
+            return os.stat(inPath)
+    except OSError:
+        return None
+
+def fovRecord(inPath, inImFOV):
+    # Describes an image file for the plate manifest:
+    # [size, modification time in ns, hash of pixels]; None if the file is missing
+    locStat = statFOV(inPath)
+    if locStat is None:
+        return None
+
+    locHash = None
+    if inImFOV is not None:
+        with imProfile.stage('hash', inImFOV.nbytes):
+            locHash = hashlib.blake2b(digest_size=16)
+            locHash.update(("%s%s" % (inImFOV.dtype, inImFOV.shape)).encode())
+            locHash.update(np.ascontiguousarray(inImFOV))
+            locHash = locHash.hexdigest()
+
+    return [locStat.st_size, locStat.st_mtime_ns, locHash]
+
+def readFOVRecord(inPath, inStats=False):
+    # Reads a FOV image together with its manifest record and, if inStats
+    # is set, its fovHistogram (None for a missing image)
+    locImFOV = readFOV(inPath)
+    locHist = None
+    if inStats and locImFOV is not None:
+        with imProfile.stage('stats', locImFOV.nbytes):
+            locHist = fovHistogram(locImFOV)
+    return locImFOV, fovRecord(inPath, locImFOV), locHist
+
+def wellName(inRow, inCol):
+    # Name of a well, e.g. B02
+    return "%s%02d" % (inRow, inCol)
+
+# Percentiles in the intensity statistics of wells and FOVs
+statsPercentiles = (1, 50, 99)
+
+# Columns of the intensity statistics, as named in the tables of the viewer
+statsColumns = ['meas.mn', 'meas.sd', 'meas.min'] + ['meas.p%02d' % p for p in statsPercentiles] + ['meas.max', 'meas.sat']
+
+def fovHistogram(inImFOV):
+    # Histogram of the raw intensities of a FOV with a bin for every 16-bit
+    # value, and the number of saturated pixels, at the top of the range of
+    # the image type; other types are rounded and clipped to 16 bits
+    if inImFOV.dtype in (np.uint8, np.uint16):
+        locSatLevel = np.iinfo(inImFOV.dtype).max
+    else:
+        inImFOV = np.clip(np.rint(inImFOV), 0, imDepthIn).astype(np.uint16)
+        locSatLevel = imDepthIn
+
+    locHist = np.bincount(inImFOV.ravel(), minlength=imDepthIn + 1)
+    return locHist, int(locHist[locSatLevel])
+
+def histPercentiles(inCum, inPercentiles):
+    # Values at percentiles (nearest rank; 0 gives the minimum, 100 the
+    # maximum) of the pixels of a histogram, given by its cumulative sum
+    locN = int(inCum[-1])
+    locRanks = [max(1, math.ceil(p * locN / 100)) for p in inPercentiles]
+    return [int(q) for q in np.searchsorted(inCum, locRanks)]
+
+def histStats(inHist, inSaturated):
+    # Mean, SD, minimum, percentiles (nearest rank), maximum and saturated
+    # fraction of the pixels counted in a histogram, as in statsColumns
+    locCum = np.cumsum(inHist)
+    locN = int(locCum[-1])
+    locQuantiles = histPercentiles(locCum, (0,) + statsPercentiles + (100,))
+
+    # moments over the occupied bins, between the minimum and the maximum
+    locHist = inHist[locQuantiles[0]:locQuantiles[-1] + 1]
+    locValues = np.arange(locQuantiles[0], locQuantiles[-1] + 1, dtype=np.float64)
+    locMean = float(locHist @ locValues) / locN
+    locSD = math.sqrt(float(locHist @ (locValues - locMean) ** 2) / locN)
+
+    return [locMean, locSD] + locQuantiles + [inSaturated / locN]
+
+def wellStats(inHists):
+    # Intensity statistics of the raw FOV images of a well from their
+    # fovHistograms, for every channel: of the entire well, and of every FOV
+    # (None for missing ones); the histogram of the well is the sum of those
+    # of its FOVs
+    locStats = []
+    for locChHists in inHists:
+        locWellHist = np.zeros(imDepthIn + 1, dtype=np.int64)
+        locWellSaturated = 0
+        locFovStats = []
+        for locFovHist in locChHists:
+            if locFovHist is None:
+                locFovStats.append(None)
+                continue
+
+            locHist, locSaturated = locFovHist
+            locFovStats.append(histStats(locHist, locSaturated))
+            locWellHist += locHist
+            locWellSaturated += locSaturated
+
+        locFovs = sum(locFov is not None for locFov in locFovStats)
+        locStats.append({'well': histStats(locWellHist, locWellSaturated) if locFovs else None,
+                         'fovs': locFovStats})
+    return(locStats)
+
+def sampleHistograms(inChannels, inEvery, inThreads):
+    # Histograms of the raw intensities of every channel in inChannels, of
+    # every inEvery-th of its image files in the plate, read by a pool of
+    # threads and added up as they are read; memory is bounded by the bins
+    # of a histogram per channel whatever the number of files. Returns the
+    # histograms and the numbers of images read
+    locHists = np.zeros((len(inChannels), imDepthIn + 1), dtype=np.int64)
+    locImages = [0] * len(inChannels)
+    locLock = threading.Lock()
+
+    def locAdd(inIch, inPath):
+        locImFOV = readFOV(inPath)
+        if locImFOV is None:
+            return
+        locHist = fovHistogram(locImFOV)[0]
+        with locLock:
+            locHists[inIch] += locHist
+            locImages[inIch] += 1
+
+    with ThreadPoolExecutor(max_workers=max(1, inThreads)) as locExecutor:
+        locFutures = []
+        for locIch, locCh in enumerate(inChannels):
+            locFutures += [locExecutor.submit(locAdd, locIch, locPath) for locPath in sampleFiles(locCh, inEvery)]
+        for future in locFutures:
+            future.result()
+
+    return(locHists, locImages)
+
+def sampleFiles(inCh, inEvery):
+    # Paths of every inEvery-th image file of a channel, in the order of
+    # their wells, FOVs and channels
+    locKeys = sorted(key for key in imIndex.files if key[3] == inCh)
+    return([imIndex.files[key] for key in locKeys[::inEvery]])
+
+def sampleFingerprint(inPaths):
+    # Hash of the names, sizes and modification times of the sampled image
+    # files; the clipping intensities chosen from them hold while it is the same
+    locHash = hashlib.blake2b(digest_size=16)
+    for locPath in inPaths:
+        locStat = statFOV(locPath)
+        locHash.update(("%s %d %d\n" % (os.path.basename(locPath), locStat.st_size, locStat.st_mtime_ns)
+                        if locStat is not None else "%s\n" % os.path.basename(locPath)).encode())
+    return(locHash.hexdigest())
+
+def contrastLimits(inHist, inLow, inHigh):
+    # Clipping intensities at the percentiles inLow and inHigh of a
+    # histogram, at least 1 apart
+    locMin, locMax = histPercentiles(np.cumsum(inHist), (inLow, inHigh))
+    locMax = max(locMax, locMin + 1)
+    if locMax > imDepthIn:
+        locMin, locMax = imDepthIn - 1, imDepthIn
+    return((locMin, locMax))
+
+def saveContrast(inContrasts, inPaths):
+    # Saves the clipping intensities chosen by -A for every channel next to
+    # its DZI, as <name>_contrast.json
+    for locContrast, locPath in zip(inContrasts, inPaths):
+        locJsonPath = os.path.splitext(locPath)[0] + '_contrast.json'
+        with open(locJsonPath + '.tmp', 'w') as locFile:
+            json.dump(locContrast, locFile, indent=1)
+        os.replace(locJsonPath + '.tmp', locJsonPath)
+
+def loadContrast(inPath):
+    # Clipping intensities saved by saveContrast next to the DZI inPath;
+    # None if there are none
+    try:
+        with open(os.path.splitext(inPath)[0] + '_contrast.json') as locFile:
+            return(json.load(locFile))
+    except (IOError, ValueError):
+        return(None)
+
+def saveWellStats(inWells, inPaths):
+    # Saves the intensity statistics of every channel as CSV tables next to
+    # its DZI: <name>_stats.csv with a row per well, as read by the heatmap
+    # of the viewer, and <name>_fov_stats.csv with a row per FOV; NA stands
+    # for missing images. Returns the number of wells without statistics
+    def locFormat(inValues):
+        if inValues is None:
+            return ['NA'] * len(statsColumns)
+        return ['%.6g' % v if isinstance(v, float) else str(v) for v in inValues]
+
+    locMissing = 0
+    locTables = [([], []) for locPath in inPaths]
+    for locRow in plateRow:
+        for iCol in plateCol:
+            locWell = inWells.get(wellName(locRow, iCol+1))
+            if locWell is None:
+                locMissing += 1
+                continue
+
+            for (locWellRows, locFovRows), locStats in zip(locTables, locWell):
+                locFovs = sum(locFov is not None for locFov in locStats['fovs'])
+                locWellRows.append([locRow, iCol+1] + locFormat(locStats['well']) + [locFovs])
+                for locIfov, locFov in enumerate(locStats['fovs']):
+                    locFovRows.append([locRow, iCol+1, locIfov] + locFormat(locFov))
+
+    for locPath, (locWellRows, locFovRows) in zip(inPaths, locTables):
+        locBase = os.path.splitext(locPath)[0]
+        for locCsvPath, locHeader, locRows in (
+                (locBase + '_stats.csv', ['Row', 'Col'] + statsColumns + ['fovs'], locWellRows),
+                (locBase + '_fov_stats.csv', ['Row', 'Col', 'FOV'] + statsColumns, locFovRows)):
+            with open(locCsvPath + '.tmp', 'w', newline='') as locFile:
+                locWriter = csv.writer(locFile)
+                locWriter.writerow(locHeader)
+                locWriter.writerows(locRows)
+            os.replace(locCsvPath + '.tmp', locCsvPath)
+
+    return(locMissing)
+
+
+class PlateManifest(object):
+    """Input files of a run with the settings that shape the output.
+
+    Every file is described by fovRecord. The manifest is saved next to the
+    DZI files; comparing it with the files on disk tells which wells have to
+    be tiled again."""
+
+    def __init__(self, settings, files=None, wells=None):
+        self.settings = settings
+        self.files = files if files is not None else {} # path -> record
+        self.wells = wells if wells is not None else {} # well name -> wellStats of its images
 
-    for locIfov in wellFOVs:
+    @classmethod
+    def load(cls, path):
+        """Returns the manifest saved in path, or None if there is none."""
+        try:
+            with open(path) as manifest_file:
+                content = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+        return cls(content.get("settings"), content.get("files", {}), content.get("wells", {}))
 
-#        locImPath = "%s%02df%02dd%d.%s" % (imDir + '/' + imCore + locIrow, locIcol, locIfov, imCh, imExt)
-        locImPath = "%s%02df%02dd%d.%s" % (imDir + '/' + locIrow, locIcol, locIfov, imCh, imExt)
-        if(DEB):
-            print("\nChecking:", locImPath)
+    def save(self, path):
+        """Saves the manifest; it replaces the old one atomically."""
+        manifest_file = open(path + ".tmp", "w")
+        json.dump({"settings": self.settings, "files": self.files, "wells": self.wells}, manifest_file, sort_keys=True)
+        manifest_file.close()
+        os.replace(path + ".tmp", path)
 
-        # Handle errors if the image file is inaccessible/corrupt
-        flagFileExists = os.path.isfile(locImPath) and os.access(locImPath, os.R_OK)
-        flagFileOK = True
+    def record(self, path, record):
+        self.files[path] = record
 
-        try:
-            locImFOV = imageio.imread(locImPath)
-        except (IOError, SyntaxError, IndexError, ValueError) as e:
-            print('Corrupted file:', locImPath)
-            flagFileOK = False
+    def record_well(self, well, stats):
+        self.wells[well] = stats
 
 
-        if flagFileExists and flagFileOK:
-            if(DEB):
-                print("File exists and is readable")
+class PlateIndex(object):
+    """Image files of the input folder by well, FOV and channel.
 
-            # Image stats
-            if (DEB):
-                locImMean, locImSD, locImMin, locImMax = locImFOV.mean(), locImFOV.std(), locImFOV.min(), locImFOV.max()
-                print("Raw mean=%.2f\tsd=%.2f\tmin=%d\tmax=%d" % (locImMean, locImSD, locImMin, locImMax))
+    The folder is listed once, and the names of its files are parsed with a
+    regular expression; all later stages look files up here instead of
+    probing the file system for every FOV."""
 
-            # Clip intensities;
-            # has to be done before rescaling, to avoid overflow of uint16
-            locImFOVclip = np.clip(locImFOV, imIntMin, imIntMax)
+    def __init__(self, files=None, unexpected=None):
+        self.files = files if files is not None else {} # (row, col, fov, ch) -> path
+        self.unexpected = unexpected if unexpected is not None else [] # names of other files
+        self.paths = set(self.files.values())
 
-            # Rescale to max range of the input bit depth (working with integers!)
-            locImFOVresc = np.round((locImFOVclip - imIntMin) * imRescFac)
-            locImFOVresc = locImFOVresc.astype('uint16')
+    @classmethod
+    def scan(cls, folder, pattern, rows, columns, fovs):
+        """Indexes the files of folder that match pattern, with the groups
+        row, col, fov and ch, and are among the rows (letters), columns and
+        FOVs of the plate; files of all channels are indexed. Hidden files
+        are ignored."""
+        pattern = re.compile(pattern)
+        rows, columns, fovs = set(rows), set(columns), set(fovs)
+
+        files = {}
+        unexpected = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+
+                match = pattern.fullmatch(entry.name)
+                key = None
+                if match is not None:
+                    row = match.group('row')
+                    if row.isdigit():
+                        row = chr(64 + int(row))
+                    key = (row.upper(), int(match.group('col')), int(match.group('fov')), int(match.group('ch')))
+
+                if key is None or key in files or key[0] not in rows or key[1] not in columns or key[2] not in fovs:
+                    unexpected.append(entry.name)
+                else:
+                    files[key] = folder + '/' + entry.name
 
-            # convert to 8-bit
-            locIm8 = (locImFOVresc >> 8).astype('uint8')
+        return cls(files, sorted(unexpected))
 
-            # Invert the final image if imInv = True
-            if(imInv):
-                locIm8 = (~locIm8)
+    def missing(self, keys):
+        """Keys of the files that are not in the folder."""
+        return [key for key in keys if key not in self.files]
 
-            if (DEB):
-                locImMean, locImSD, locImMin, locImMax = locIm8.mean(), locIm8.std(), locIm8.min(), locIm8.max()
-                print("New mean=%.2f\tsd=%.2f\tmin=%d\tmax=%d" % (locImMean, locImSD, locImMin, locImMax))
 
-            locIm8fin = Image.fromarray(locIm8, imMode)
-
-        else:
-            if(DEB):
-                print("Either the file is missing or not readable; creating blank")
+def rescaleFOV(inImFOV, inIntMin, inIntMax):
+    # Rescaling factor based on image depth and upper clipping intensity
+    locRescFac = imDepthIn / (inIntMax - inIntMin)
+
+    # Clip intensities;
+    # has to be done before rescaling, to avoid overflow of uint16
+    locImFOVclip = np.clip(inImFOV, inIntMin, inIntMax)
+
+    # Rescale to max range of the input bit depth (working with integers!)
+    locImFOVresc = np.round((locImFOVclip - inIntMin) * locRescFac)
+    locImFOVresc = locImFOVresc.astype('uint16')
+
+    # convert to 8-bit
+    locIm8 = (locImFOVresc >> 8).astype('uint8')
+
+    # Invert the final image if imInv = True
+    if(imInv):
+        locIm8 = (~locIm8)
+
+    return(locIm8)
+
+def rescaleLUT(inIntMin, inIntMax):
+    # Lookup table with the 8-bit output of rescaleFOV for every 16-bit
+    # input intensity; np.take(LUT, image) gives the same pixels as
+    # rescaleFOV(image) for 16-bit images
+    return(rescaleFOV(np.arange(imDepthIn + 1, dtype='uint16'), inIntMin, inIntMax))
+
+def missingFOVImage(inFov):
+    # Image with a label that replaces a missing FOV;
+    # rendered once for every FOV index and shared, so it must not be modified
+    locKey = (inFov, imWidth, imHeight, bgEmptyFOV, labelFOVcol)
+    if locKey not in missingFOVImages:
+        locIm = Image.new(imMode, (imWidth, imHeight), bgEmptyFOV)
+        locImDraw = ImageDraw.Draw(locIm)
+
+        locMyLabel = "f%02d missing" % inFov
+
+        locImDraw.text((labelFOVposX, labelFOVposY), locMyLabel, labelFOVcol, font=myFontFOV)
+        missingFOVImages[locKey] = locIm
+
+    return missingFOVImages[locKey]
+
+def wellLabelMask(inText):
+    # Mask of a part of a well label, rendered once;
+    # returns the mask and its offset from the text position
+    if inText not in wellLabelMasks:
+        locBbox = myFontWell.getbbox(inText)
+        locMask = Image.new('L', (locBbox[2] - locBbox[0], locBbox[3] - locBbox[1]), 0)
+        ImageDraw.Draw(locMask).text((-locBbox[0], -locBbox[1]), inText, 255, font=myFontWell)
+        wellLabelMasks[inText] = (locMask, locBbox[:2])
+
+    return wellLabelMasks[inText]
+
+def wellLabelParts(inRow, inCol):
+    # Masks of the row letter and the column number of the well name, e.g. A01,
+    # with their positions in the well
+    locNumber = "%02d" % inCol
+
+    # advance of the letter, including kerning with the number
+    locAdvance = myFontWell.getlength(inRow + locNumber) - myFontWell.getlength(locNumber)
+
+    locParts = []
+    for locText, locPosX in ((inRow, labelWellPosX), (locNumber, labelWellPosX + locAdvance)):
+        locMask, locOffset = wellLabelMask(locText)
+        locParts.append((locMask, (int(locPosX + locOffset[0]), labelWellPosY + locOffset[1])))
+    return(locParts)
+
+def drawWellLabel(inImWell, inRow, inCol):
+    # Draws the well name from the masks of its parts into the 8-bit array
+    # of a well, clipped to the well; the label colour is blended through a
+    # mask with the arithmetic of PIL's paste, which gives the same pixels
+    # as drawing the whole name with ImageDraw.text
+    for locMask, locPos in wellLabelParts(inRow, inCol):
+        locMaskW = min(locMask.size[0], inImWell.shape[1] - locPos[0])
+        locMaskH = min(locMask.size[1], inImWell.shape[0] - locPos[1])
+        if locMaskW <= 0 or locMaskH <= 0:
+            continue
+        locAlpha = np.asarray(locMask)[:locMaskH, :locMaskW].astype(np.int32)
+        locRegion = inImWell[locPos[1]:locPos[1] + locMaskH, locPos[0]:locPos[0] + locMaskW]
+        locBlend = locRegion * (255 - locAlpha) + labelWellCol * locAlpha + 128
+        locRegion[...] = ((locBlend >> 8) + locBlend) >> 8
+
+# Rendered placeholders of missing FOVs and parts of well labels
+missingFOVImages = {}
+wellLabelMasks = {}
+
+class WellReader(object):
+    """Reads FOV images of upcoming wells ahead of time in a pool of threads.
+
+    Wells are read in the order given by wells; at most depth wells are
+    read ahead of the one being processed."""
+
+    def __init__(self, wells, depth=2, threads=8, stats=None):
+        self.wells = deque(wells) # wells not submitted yet
+        self.depth = max(1, int(depth))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(threads)))
+        self.pending = OrderedDict() # well -> futures of its FOV images for every channel
+        self.manifest = None # PlateManifest that gets records of all files read
+        self.checkpoint = None # log that gets the records of the files of every well read
+        self.stats = stats # PlateManifest that gets the intensity statistics of every well read
+        self.fill()
+
+    def submit(self, well):
+        inRow, inCol = well
+        return [[self.executor.submit(readFOVRecord, fovPath(inRow, inCol, locIfov, locCh), self.stats is not None)
+                 for locIfov in wellFOVs] for locCh in imChannels]
+
+    def fill(self):
+        while self.wells and len(self.pending) < self.depth:
+            well = self.wells.popleft()
+            self.pending[well] = self.submit(well)
+
+    def read(self, inRow, inCol):
+        """Returns lists of FOV images of a well, one per channel; None stands for a missing or corrupt file."""
+        well = (inRow, inCol)
+        futures = self.pending.pop(well, None)
+        if futures is None:
+            # well requested out of order
+            if well in self.wells:
+                self.wells.remove(well)
+            futures = self.submit(well)
+        self.fill()
+
+        locImFOVs = []
+        locHists = []
+        locRecords = {}
+        for locCh, locFutures in zip(imChannels, futures):
+            locImFOVs.append([])
+            locHists.append([])
+            for locIfov, future in zip(wellFOVs, locFutures):
+                locImFOV, locRecord, locHist = future.result()
+                locRecords[fovPath(inRow, inCol, locIfov, locCh)] = locRecord
+                locImFOVs[-1].append(locImFOV)
+                locHists[-1].append(locHist)
+
+        locEntry = {'well': [inRow, inCol], 'files': locRecords}
+        if self.stats is not None:
+            with imProfile.stage('stats'):
+                locEntry['stats'] = wellStats(locHists)
+            self.stats.record_well(wellName(inRow, inCol), locEntry['stats'])
+
+        if self.manifest is not None:
+            for locPath, locRecord in locRecords.items():
+                self.manifest.record(locPath, locRecord)
+        if self.checkpoint is not None:
+            _append_checkpoint(self.checkpoint, [locEntry])
+        return locImFOVs
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+# FOV reader shared by all wells; set up in main
+wellReader = None
+
+# Wells (row and column index) of an interrupted run whose tiles are all
+# kept; they are left out of the montage. Set up in main
+imSkipWells = set()
+
+def processWell(inRow, inCol, inImWells):
+    # Draws montages of the well, one per channel in imChannels, into the
+    # 8-bit arrays inImWells of the size of a well, e.g. views of the plate
+    # canvas at the bounding box of the well. Rescaled FOVs land in their
+    # place in a single write; the padding between them and the label are
+    # drawn into the arrays
 
-            # create an empty file
-            locIm8fin = Image.new(imMode, (imWidth, imHeight), bgEmptyFOV)
-            locImDraw = ImageDraw.Draw(locIm8fin)
+    locIrow = inRow
+    locIcol = inCol
 
-            locMyLabel = "f%02d missing" % locIfov
+    # Read images of FOVs of a single well
+    # Assumption: image files are named according to a convetion xxxx_A01f00d1
+    # A01 - well
+    # f00 - fov
+    # d1 - channel
+    if wellReader is not None:
+        locImFOVs = wellReader.read(locIrow, locIcol)
+    else:
+        locImFOVs = [[readFOV(fovPath(locIrow, locIcol, locIfov, locCh)) for locIfov in wellFOVs] for locCh in imChannels]
+
+    # padding between rows and columns of FOVs
+    with imProfile.stage('paste'):
+        for locImWell in inImWells:
+            for locWellRow in range(1, wellHeight):
+                locWellPosN = locWellRow * (imHeight + paddingFOV)
+                locImWell[locWellPosN - paddingFOV:locWellPosN, :] = bgEmptyWell
+            for locWellCol in range(1, wellWidth):
+                locWellPosW = locWellCol * (imWidth + paddingFOV)
+                locImWell[:, locWellPosW - paddingFOV:locWellPosW] = bgEmptyWell
 
-            locImDraw.text((labelFOVposX, labelFOVposY), locMyLabel, labelFOVcol, font=myFontFOV)
+    for locIfov in wellFOVs:
 
-        # Add image to montage canvas
+        # Position of the FOV in the well
 
         locWellCol = locIfov % wellWidth
         locWellRow = locIfov // wellWidth
@@ -484,17 +2742,639 @@ def processWell(inRow, inCol):
         locBbox = (locWellPosW, locWellPosN, locWellPosE, locWellPosS)
 
         if (DEB):
-            print('Bounding box for inserting FOV image into Well canvas:')
+            print('\nBounding box for inserting FOV image into Well canvas:')
             print(locBbox)
 
-        locImWell.paste(locIm8fin, locBbox)
+        for locIch, locCh in enumerate(imChannels):
+
+            if(DEB):
+                print("Checking:", fovPath(locIrow, locIcol, locIfov, locCh))
+
+            locImFOV = locImFOVs[locIch][locIfov]
+
+            # the FOV in the well
+            locIm8 = inImWells[locIch][locWellPosN:locWellPosS, locWellPosW:locWellPosE]
+
+            if locImFOV is not None:
+                if(DEB):
+                    print("File exists and is readable")
+
+                # Image stats
+                if (DEB):
+                    locImMean, locImSD, locImMin, locImMax = locImFOV.mean(), locImFOV.std(), locImFOV.min(), locImFOV.max()
+                    print("Raw mean=%.2f\tsd=%.2f\tmin=%d\tmax=%d" % (locImMean, locImSD, locImMin, locImMax))
+
+                # 16-bit images go through the lookup table in a single pass;
+                # indices of uint16 are within the table, and clipping them
+                # lets np.take write to the view without a temporary array
+                with imProfile.stage('rescale', locImFOV.nbytes):
+                    if locImFOV.dtype == np.uint16:
+                        np.take(imLUTs[locIch], locImFOV, out=locIm8, mode='clip')
+                    else:
+                        locIm8[...] = rescaleFOV(locImFOV, *imInts[locIch])
+
+                if (DEB):
+                    locImMean, locImSD, locImMin, locImMax = locIm8.mean(), locIm8.std(), locIm8.min(), locIm8.max()
+                    print("New mean=%.2f\tsd=%.2f\tmin=%d\tmax=%d" % (locImMean, locImSD, locImMin, locImMax))
+
+            else:
+                if(DEB):
+                    print("Either the file is missing or not readable; creating blank")
+
+                # use an empty image
+                with imProfile.stage('label'):
+                    locIm8[...] = np.asarray(missingFOVImage(locIfov))
 
     # Add well label to the montage
-    locImDrawWell = ImageDraw.Draw(locImWell)
-    locMyLabelWell = "%s%02d" % (locIrow, locIcol)
-    locImDrawWell.text(( labelWellPosX, labelWellPosY), locMyLabelWell, labelWellCol, font = myFontWell, align = 'left')
+    with imProfile.stage('label'):
+        for locImWell in inImWells:
+            drawWellLabel(locImWell, locIrow, locIcol)
+
+def processPlateRow(iRow):
+    # Returns montages of a row of wells, one per channel in imChannels
+
+    # create canvas for a row of wells, including the padding below it;
+    # wells are drawn straight into it
+    locStripHeight = imWellHeight
+    if iRow < plateHeight - 1:
+        locStripHeight += paddingWell
 
-    return(locImWell)
+    locImStrips = [np.full((locStripHeight, imPlateWidth), bgEmptyPlate, dtype=np.uint8) for locCh in imChannels]
+
+    for iCol in plateCol:
+        if (iRow, iCol) in imSkipWells:
+            continue
+
+        platePosW = iCol * (imWellWidth + paddingWell)
+        platePosE = platePosW + imWellWidth
+        bbox = (platePosW, 0, platePosE, imWellHeight)
+
+        if (DEB):
+            print('\nBounding box for inserting Well image into Plate row canvas:')
+            print(bbox)
+
+        processWell(plateRow[iRow], iCol+1, [locImStrip[bbox[1]:bbox[3], bbox[0]:bbox[2]] for locImStrip in locImStrips])
+
+    return([Image.fromarray(locImStrip, imMode) for locImStrip in locImStrips])
+
+def wellBbox(iRow, iCol):
+    # Bounding box of a well in the plate canvas
+    platePosW = iCol * (imWellWidth + paddingWell)
+    platePosE = platePosW + imWellWidth
+    platePosN = iRow * (imWellHeight + paddingWell)
+    platePosS = platePosN + imWellHeight
+    return (platePosW, platePosN, platePosE, platePosS)
+
+def plateMontage(inDir):
+    # Canvas for the montage of the entire plate, one channel: a uint8 array
+    # in memory, or, if inDir is given, mapped to a new file in inDir.
+    # Returns the canvas and the path of its file (None in memory)
+    if inDir is None:
+        return np.full((imPlateHeight, imPlateWidth), bgEmptyPlate, dtype=np.uint8), None
+
+    locFile, locPath = tempfile.mkstemp(prefix='.montage_', suffix='.u8', dir=_get_or_create_path(inDir))
+    os.close(locFile)
+    locImPlate = np.memmap(locPath, dtype=np.uint8, mode='w+', shape=(imPlateHeight, imPlateWidth))
+    locImPlate.fill(bgEmptyPlate)
+    return locImPlate, locPath
+
+def wellViews(inImPlates, iRow, iCol):
+    # Views of the plate canvases at the bounding box of a well
+    locX1, locY1, locX2, locY2 = wellBbox(iRow, iCol)
+    return([locImPlate[locY1:locY2, locX1:locX2] for locImPlate in inImPlates])
+
+def assembleWells(inWells, inPlateFiles, inCheckpoint, inReaders, inStats):
+    # Writes montages of wells (row and column index) into the plate
+    # canvases mapped to inPlateFiles; runs in a worker process forked from
+    # main, whose globals it uses, and reads the wells with reader threads of
+    # its own. Returns the manifest records of the files read, the intensity
+    # statistics of the wells if inStats is set, and the profile of the worker
+    global wellReader, imProfile
+    imProfile = StageProfile(imProfile.enabled)
+    locManifest = PlateManifest(None)
+
+    wellReader = WellReader([(plateRow[iRow], iCol+1) for iRow, iCol in inWells], threads = inReaders,
+                            stats = locManifest if inStats else None)
+    wellReader.manifest = locManifest
+    wellReader.checkpoint = inCheckpoint
+    try:
+        locImPlates = [np.memmap(locPath, dtype=np.uint8, mode='r+', shape=(imPlateHeight, imPlateWidth))
+                       for locPath in inPlateFiles]
+        for iRow, iCol in inWells:
+            processWell(plateRow[iRow], iCol+1, wellViews(locImPlates, iRow, iCol))
+    finally:
+        wellReader.close()
+        wellReader = None
+
+    return(locManifest.files, locManifest.wells, imProfile)
+
+def processPlateRegion(inBbox):
+    # Returns montages of a region of the plate, one per channel in imChannels
+    locX1, locY1, locX2, locY2 = inBbox
+    locImRegions = [np.full((locY2 - locY1, locX2 - locX1), bgEmptyPlate, dtype=np.uint8) for locCh in imChannels]
+
+    for iRow, iCol in regionWells(inBbox):
+        bbox = wellBbox(iRow, iCol)
+
+        if bbox[0] >= locX1 and bbox[1] >= locY1 and bbox[2] <= locX2 and bbox[3] <= locY2:
+            # the well is drawn straight into the region
+            processWell(plateRow[iRow], iCol+1, [locImRegion[bbox[1] - locY1:bbox[3] - locY1, bbox[0] - locX1:bbox[2] - locX1] for locImRegion in locImRegions])
+            continue
+
+        # a well cut by the edge of the region is drawn whole, and its part
+        # inside the region is copied
+        imWells = [np.empty((imWellHeight, imWellWidth), dtype=np.uint8) for locCh in imChannels]
+        processWell(plateRow[iRow], iCol+1, imWells)
+
+        locCutX1, locCutY1 = max(bbox[0], locX1), max(bbox[1], locY1)
+        locCutX2, locCutY2 = min(bbox[2], locX2), min(bbox[3], locY2)
+        with imProfile.stage('paste', (locCutX2 - locCutX1) * (locCutY2 - locCutY1) * len(imWells)):
+            for locImRegion, imWell in zip(locImRegions, imWells):
+                locImRegion[locCutY1 - locY1:locCutY2 - locY1, locCutX1 - locX1:locCutX2 - locX1] = \
+                    imWell[locCutY1 - bbox[1]:locCutY2 - bbox[1], locCutX1 - bbox[0]:locCutX2 - bbox[0]]
+
+    return(locImRegions)
+
+def regionWells(inBbox):
+    # Wells (row and column index) that overlap a region of the plate canvas
+    locWells = []
+    for iRow in range(0, plateHeight):
+        for iCol in plateCol:
+            bbox = wellBbox(iRow, iCol)
+            if bbox[0] < inBbox[2] and inBbox[0] < bbox[2] and bbox[1] < inBbox[3] and inBbox[1] < bbox[3]:
+                locWells.append((iRow, iCol))
+    return(locWells)
+
+def findChangedWells(inPrevious, inManifest):
+    # Compares files of every well with the manifest of the previous run.
+    # Files whose size or modification time differ are read again and
+    # compared by the hash of their pixels. Returns changed wells (row and
+    # column index); inManifest gets the current records of all files.
+    locChanged = []
+    for iRow in range(0, plateHeight):
+        for iCol in plateCol:
+            flagChanged = False
+            for locCh in imChannels:
+                for locIfov in wellFOVs:
+                    locPath = fovPath(plateRow[iRow], iCol+1, locIfov, locCh)
+                    locOld = inPrevious.files.get(locPath)
+                    locStat = statFOV(locPath)
+                    locRecord = None if locStat is None else [locStat.st_size, locStat.st_mtime_ns, None]
+
+                    if locRecord is not None and locOld is not None and locRecord[:2] == locOld[:2]:
+                        locRecord[2] = locOld[2]
+                    elif locRecord is not None or locOld is not None:
+                        locRecord = fovRecord(locPath, readFOV(locPath))
+                        if locRecord is None or locOld is None or locRecord[2] != locOld[2]:
+                            if(DEB):
+                                print("Changed:", locPath)
+                            flagChanged = True
+
+                    inManifest.record(locPath, locRecord)
+
+            if flagChanged:
+                locChanged.append((iRow, iCol))
+            elif wellName(plateRow[iRow], iCol+1) in inPrevious.wells:
+                inManifest.record_well(wellName(plateRow[iRow], iCol+1), inPrevious.wells[wellName(plateRow[iRow], iCol+1)])
+
+    return(locChanged)
+
+def stageOutputs(inPaths, inStagePaths):
+    # Chooses where every published DZI is updated; returns their paths.
+    # A pack is cloned to the staging folder where the file system clones
+    # files as reflinks, which copies no data, and the clone is published
+    # as usual. Otherwise the published DZI is updated in place, which
+    # writes only the new tiles: tile files replace the old ones atomically,
+    # and a pack gets the new tiles, index and footer appended
+    locPaths = []
+    for locPath, locStagePath in zip(inPaths, inStagePaths):
+        if os.path.isfile(_get_pack_path(locPath)) and _clone_file(_get_pack_path(locPath), _get_pack_path(locStagePath)):
+            shutil.copyfile(locPath, locStagePath)
+            locPaths.append(locStagePath)
+        else:
+            locPaths.append(locPath)
+    return(locPaths)
+
+def publishFiles(inStageFiles, inFiles, inOld):
+    # Moves a finished _files folder out of the staging folder, to a folder
+    # of its own version next to inFiles, .<name>_files.<version>, and makes
+    # inFiles a link to it. The link is swapped with a single rename, so a
+    # viewer always finds a _files folder; other versions are removed. A
+    # _files folder that is not a link is moved to inOld first. Without
+    # links, the folders are swapped with two renames
+    locDir, locName = os.path.split(inFiles)
+    locVersion = '.%s.%x' % (locName, time.time_ns())
+    os.rename(inStageFiles, os.path.join(locDir, locVersion))
+
+    locLink = os.path.join(locDir, '.%s.link' % locName)
+    _remove_file(locLink)
+    try:
+        os.symlink(locVersion, locLink)
+    except OSError:
+        os.rename(os.path.join(locDir, locVersion), inStageFiles)
+        if os.path.isdir(inFiles):
+            os.rename(inFiles, os.path.join(inOld, locName))
+        os.rename(inStageFiles, inFiles)
+        return
+
+    if os.path.isdir(inFiles) and not os.path.islink(inFiles):
+        os.rename(inFiles, os.path.join(inOld, locName))
+    os.replace(locLink, inFiles)
+
+    for locEntry in os.listdir(locDir or '.'):
+        if locEntry.startswith('.%s.' % locName) and locEntry != locVersion:
+            shutil.rmtree(os.path.join(locDir, locEntry), ignore_errors=True)
+
+def publishOutputs(inStageDir, inStagePaths, inPaths):
+    # Moves finished DZIs with their packs and _files folders from the
+    # staging folder to the output folder and removes the staging folder.
+    # Files replace the published ones atomically, and so do the links of
+    # _files folders, see publishFiles. The DZI goes last, so a viewer that
+    # reads a new DZI finds its tiles.
+    locOld = _get_or_create_path(os.path.join(inStageDir, '.old'))
+    for locStagePath, locPath in zip(inStagePaths, inPaths):
+        if os.path.isfile(_get_pack_path(locStagePath)):
+            os.replace(_get_pack_path(locStagePath), _get_pack_path(locPath))
+
+        if os.path.isdir(_get_files_path(locStagePath)):
+            publishFiles(_get_files_path(locStagePath), _get_files_path(locPath), locOld)
+
+        # DZIs updated in place are not in the staging folder
+        if os.path.isfile(locStagePath):
+            os.replace(locStagePath, locPath)
+
+    shutil.rmtree(inStageDir, ignore_errors=True)
+
+def wellTilesDone(iRow, iCol, inCreator, inDone):
+    # True if inDone has all tiles of a DZI that pixels of a well go into.
+    # Resized levels also mix in pixels around a tile, which resumeMargin
+    # covers; levels composed from tiles only depend on the full resolution
+    # tiles
+    locMaxLevel = inCreator.descriptor.num_levels - 1
+    if inCreator.pyramid == 'tiles':
+        locLevels = [locMaxLevel]
+    else:
+        locLevels = range(locMaxLevel + 1)
+
+    locX1, locY1, locX2, locY2 = wellBbox(iRow, iCol)
+    for locLevel in locLevels:
+        locScale = 2 ** (locMaxLevel - locLevel)
+        locRegion = (locX1 // locScale - resumeMargin, locY1 // locScale - resumeMargin,
+                     -(-locX2 // locScale) + resumeMargin, -(-locY2 // locScale) + resumeMargin)
+        for locTile in inCreator.get_region_tiles(locLevel, locRegion):
+            if (locLevel,) + locTile not in inDone:
+                return False
+    return True
+
+def findResumedWells(inLogPath, inCreators, inDones, inManifest):
+    # Wells of an interrupted run that need not be read again: all their
+    # tiles are kept in every DZI. Records of their files come from the
+    # well log of that run and go to inManifest. Returns the wells (row and
+    # column index), or None if an image file of a logged well changed
+    # since, which requires starting over
+    locLogged = {}
+    locStats = {}
+    for locEntry in _read_checkpoint(inLogPath):
+        locLogged[tuple(locEntry['well'])] = locEntry['files']
+        if 'stats' in locEntry:
+            locStats[tuple(locEntry['well'])] = locEntry['stats']
+
+    locWells = set()
+    for (locRow, locCol), locRecords in locLogged.items():
+        for locPath, locOld in locRecords.items():
+            locStat = statFOV(locPath)
+            locRecord = None if locStat is None else [locStat.st_size, locStat.st_mtime_ns]
+
+            if locRecord != (None if locOld is None else locOld[:2]):
+                if(DEB):
+                    print("Changed since the interrupted run:", locPath)
+                return None
+
+        iRow, iCol = plateRow.index(locRow), locCol - 1
+        if all(wellTilesDone(iRow, iCol, creator, done) for creator, done in zip(inCreators, inDones)):
+            locWells.add((iRow, iCol))
+            for locPath, locOld in locRecords.items():
+                inManifest.record(locPath, locOld)
+            if (locRow, locCol) in locStats:
+                inManifest.record_well(wellName(locRow, locCol), locStats[(locRow, locCol)])
+
+    return(locWells)
+
+def profileReport(inProfile, inCreators, inWall, inTimes):
+    # Report of a run timed with -T: wall and CPU time of the run, of this
+    # process and of the worker processes, and for every stage the number of
+    # calls, wall and CPU time and bytes. Stages overlap in reader threads,
+    # writer threads and worker processes, and montage and pyramid include
+    # the stages they consist of, so stage times add up to more than the run
+    locProfile = StageProfile(True)
+    locProfile.merge(inProfile)
+    for locCreator in inCreators:
+        locProfile.merge(locCreator.profile)
+        locStats = locCreator.write_stats
+        if locStats.files > 0:
+            locProfile.add('write', locStats.seconds, locStats.cpu_seconds, locStats.bytes, locStats.files)
+
+    locOrder = ['contrast', 'montage', 'stat', 'read', 'decode', 'hash', 'stats', 'rescale', 'paste', 'label',
+                'pyramid', 'resize', 'share', 'crop', 'compose', 'encode', 'write', 'publish']
+    def locKey(inName):
+        # resized levels from the top, after the stages in locOrder
+        locBase, _, locLevel = inName.partition(' level ')
+        locIndex = locOrder.index(locBase) if locBase in locOrder else len(locOrder)
+        return (locIndex, -int(locLevel or 0), inName)
+
+    locTimesNow = os.times()
+    return {
+        'wall': inWall,
+        'cpu': {
+            'main': (locTimesNow.user + locTimesNow.system) - (inTimes.user + inTimes.system),
+            'workers': (locTimesNow.children_user + locTimesNow.children_system) - (inTimes.children_user + inTimes.children_system),
+        },
+        'stages': [{'stage': locName, 'calls': locCalls, 'wall': locWall, 'cpu': locCPU, 'bytes': locBytes}
+                   for locName, (locCalls, locWall, locCPU, locBytes) in sorted(locProfile.stages.items(), key=lambda inItem: locKey(inItem[0]))],
+    }
+
+def printProfile(inReport):
+    # Summary table of a report made by profileReport
+    print("\n%-18s %8s %10s %10s %10s %8s %6s" % ('Stage', 'calls', 'wall s', 'CPU s', 'MB', 'MB/s', 'wall%'))
+    for locStage in inReport['stages']:
+        print("%-18s %8d %10.3f %10.3f %10.1f %8.1f %6.1f" % (
+            locStage['stage'], locStage['calls'], locStage['wall'], locStage['cpu'], locStage['bytes'] / 2**20,
+            locStage['bytes'] / 2**20 / max(locStage['wall'], 1e-9), 100 * locStage['wall'] / max(inReport['wall'], 1e-9)))
+    print("Run: %.2f s wall, %.2f s CPU in this process, %.2f s CPU in worker processes" % (
+        inReport['wall'], inReport['cpu']['main'], inReport['cpu']['workers']))
+    print("Stages in threads and worker processes overlap; montage and pyramid include their stages.")
+
+def saveCompletionMarker(inPath, inPaths):
+    # Marker of a run whose DZIs were published completely
+    locTmpPath = inPath + '.tmp'
+    with open(locTmpPath, 'w') as locFile:
+        json.dump({'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'dzi': [os.path.basename(locPath) for locPath in inPaths]}, locFile)
+    os.replace(locTmpPath, inPath)
+
+
+def blockSums(inArr, inPos, inScale):
+    # Sums of inScale x inScale blocks, aligned to the plate canvas, of an
+    # array placed at inPos of the canvas; pixels of the blocks outside the
+    # array count as 0. The first block is at inPos // inScale of the
+    # reduced canvas. The array is summed between the block edges that cross
+    # it, so memory does not grow with inScale
+    locEdgesX = np.arange(-(inPos[0] % inScale), inArr.shape[1], inScale)
+    locEdgesY = np.arange(-(inPos[1] % inScale), inArr.shape[0], inScale)
+    locEdgesX[0] = locEdgesY[0] = 0
+    locSums = np.add.reduceat(inArr, locEdgesX, axis=1, dtype=np.float64)
+    return(np.add.reduceat(locSums, locEdgesY, axis=0).astype(np.float32))
+
+def blockOverlap(inStart, inEnd, inFirst, inLast, inScale):
+    # Number of pixels of the span [inStart, inEnd) of the plate canvas in
+    # every block inFirst..inLast-1 of the canvas reduced by inScale
+    locEdges = np.arange(inFirst, inLast + 1) * inScale
+    return(np.clip(np.minimum(locEdges[1:], inEnd) - np.maximum(locEdges[:-1], inStart), 0, None))
+
+def addBlocks(inTile, inBlocks, inPos):
+    # Adds inBlocks placed at inPos of a tile to the part of it that lies in the tile
+    locX, locY = inPos
+    locX1, locY1 = max(0, locX), max(0, locY)
+    locX2 = min(inTile.shape[1], locX + inBlocks.shape[1])
+    locY2 = min(inTile.shape[0], locY + inBlocks.shape[0])
+    if locX1 < locX2 and locY1 < locY2:
+        inTile[locY1:locY2, locX1:locX2] += inBlocks[locY1 - locY:locY2 - locY, locX1 - locX:locX2 - locX]
+
+
+class PlateTileRenderer(object):
+    """Renders tiles of the DeepZoom image of a channel on request, straight from FOV images.
+
+    Only FOVs that intersect a tile are read. A pixel of a lower level is
+    the rounded mean of a block of the plate canvas; since the mean is
+    linear, the blocks of the plate background, of every well, of every FOV
+    and of the difference that every well label makes to the pixels under
+    it are summed separately and added up. Block sums of a tile that covers
+    more than a well are added up from 2x2 blocks of the tiles of the level
+    above instead, so low levels are made from the sums of the levels above
+    them. Tiles of the full resolution level are identical to those of a
+    made pyramid; a pyramid made with -P tiles rounds every level and
+    weighs the pixels of blocks cut off by the canvas unequally, so lower
+    levels differ from it by a grey level or two, and more at the edge.
+    Decoded FOVs, their block sums and the block sums of tiles are kept in
+    memory up to cacheBytes."""
+
+    def __init__(self, inCh, inCreator, cacheBytes=512 * 2**20):
+        self.ch = inCh
+        self.ich = imChannels.index(inCh)
+        self.creator = inCreator # encodes the tiles
+        self.descriptor = DeepZoomImageDescriptor(
+            width=imPlateWidth,
+            height=imPlateHeight,
+            tile_size=inCreator.tile_size,
+            tile_overlap=inCreator.tile_overlap,
+            tile_format=inCreator.tile_format,
+        )
+        inCreator.descriptor = self.descriptor
+        self.cacheBytes = cacheBytes
+        self.cacheSize = 0
+        self.sums = OrderedDict() # (row, column, fov, scale) -> FOV pixels or block sums;
+                                  # ('tile', level, column, row) -> block sums of a tile;
+                                  # ('label', row, column, scale) -> block sums of the difference made by a well label
+        self.lock = threading.Lock()
+
+    def read(self, level, column, row):
+        """Returns an encoded tile, or None if the image has no such tile."""
+        if level < 0 or level >= self.descriptor.num_levels:
+            return None
+        columns, rows = self.descriptor.get_num_tiles(level)
+        if column < 0 or column >= columns or row < 0 or row >= rows:
+            return None
+        return self.creator.encode_tile(self.renderTile(level, column, row))
+
+    def renderTile(self, level, column, row):
+        locScale = 2 ** (self.descriptor.num_levels - 1 - level)
+        x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+
+        # Number of canvas pixels in every block; fewer at the edge of the canvas
+        locCounts = np.outer(blockOverlap(0, imPlateHeight, y1, y2, locScale),
+                             blockOverlap(0, imPlateWidth, x1, x2, locScale))
+
+        locTile = self.tileSums(level, column, row)
+        return(Image.fromarray(np.clip(np.rint(locTile / locCounts), 0, imDepthOut).astype(np.uint8), imMode))
+
+    def tileSums(self, level, column, row):
+        # Block sums of the canvas of a tile; those of tiles that cover more
+        # than a well are added up from the cached sums of the tiles of the
+        # level above
+        locScale = 2 ** (self.descriptor.num_levels - 1 - level)
+        if locScale == 1 or locScale * self.descriptor.tile_size <= imWellWidth:
+            return(self.fovSums(level, column, row))
+
+        locKey = ('tile', level, column, row)
+        locSums = self.cached(locKey)
+        if locSums is not None:
+            return(locSums)
+
+        # Region of the tile in the level above, pasted from the parts of its
+        # tiles without their overlap
+        x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+        locChildWidth, locChildHeight = self.descriptor.get_dimensions(level + 1)
+        locChildColumns, locChildRows = self.descriptor.get_num_tiles(level + 1)
+        locRegion = (2 * x1, 2 * y1, min(2 * x2, locChildWidth), min(2 * y2, locChildHeight))
+        locSize = self.descriptor.tile_size
+        locTile = np.zeros((locRegion[3] - locRegion[1], locRegion[2] - locRegion[0]), dtype=np.float32)
+        for locRow in range(locRegion[1] // locSize, min((locRegion[3] - 1) // locSize + 1, locChildRows)):
+            for locColumn in range(locRegion[0] // locSize, min((locRegion[2] - 1) // locSize + 1, locChildColumns)):
+                locChildTile = self.tileSums(level + 1, locColumn, locRow)
+                locCore = (max(locColumn * locSize, locRegion[0]), max(locRow * locSize, locRegion[1]),
+                           min((locColumn + 1) * locSize, locRegion[2]), min((locRow + 1) * locSize, locRegion[3]))
+                cx, cy = self.descriptor.get_tile_bounds(level + 1, locColumn, locRow)[:2]
+                locTo = np.s_[locCore[1] - locRegion[1]:locCore[3] - locRegion[1], locCore[0] - locRegion[0]:locCore[2] - locRegion[0]]
+                locFrom = np.s_[locCore[1] - cy:locCore[3] - cy, locCore[0] - cx:locCore[2] - cx]
+                locTile[locTo] = locChildTile[locFrom]
+
+        locSums = blockSums(locTile, locRegion[:2], 2)
+        self.cache(locKey, locSums, locSums.nbytes)
+        return(locSums)
+
+    def fovSums(self, level, column, row):
+        # Block sums of the canvas of a tile, added up from the FOVs, wells
+        # and labels that it overlaps
+        locScale = 2 ** (self.descriptor.num_levels - 1 - level)
+        x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+
+        # Region of the tile in the full resolution plate canvas
+        locRegion = (x1 * locScale, y1 * locScale, min(x2 * locScale, imPlateWidth), min(y2 * locScale, imPlateHeight))
+
+        # Number of canvas pixels in every block; fewer at the edge of the canvas
+        locCountsX = blockOverlap(0, imPlateWidth, x1, x2, locScale)
+        locCountsY = blockOverlap(0, imPlateHeight, y1, y2, locScale)
+
+        # Block sums of the canvas
+        locTile = np.outer(locCountsY, locCountsX).astype(np.float32) * bgEmptyPlate
+
+        for iRow, iCol in regionWells(locRegion):
+            bbox = wellBbox(iRow, iCol)
+
+            # empty canvas of the well
+            locTile += (bgEmptyWell - bgEmptyPlate) * np.outer(
+                blockOverlap(bbox[1], bbox[3], y1, y2, locScale),
+                blockOverlap(bbox[0], bbox[2], x1, x2, locScale)).astype(np.float32)
+
+            # FOVs, as differences from the empty canvas of the well
+            for locIfov in wellFOVs:
+                locPosW, locPosN = self.fovPosition(iRow, iCol, locIfov)
+                if locPosW < locRegion[2] and locRegion[0] < locPosW + imWidth and locPosN < locRegion[3] and locRegion[1] < locPosN + imHeight:
+                    addBlocks(locTile, self.fovImage(iRow, iCol, locIfov, locScale), (locPosW // locScale - x1, locPosN // locScale - y1))
+
+            # well label, as the difference it makes to the pixels under it
+            locLabelH, locLabelW = self.labelShape(iRow, iCol)
+            if bbox[0] < locRegion[2] and locRegion[0] < bbox[0] + locLabelW and bbox[1] < locRegion[3] and locRegion[1] < bbox[1] + locLabelH:
+                addBlocks(locTile, self.labelImage(iRow, iCol, locScale), (bbox[0] // locScale - x1, bbox[1] // locScale - y1))
+
+        return(locTile)
+
+    def cached(self, inKey):
+        # Cached pixels or sums; None if they are not cached
+        with self.lock:
+            if inKey not in self.sums:
+                return(None)
+            self.sums.move_to_end(inKey)
+            return(self.sums[inKey][0])
+
+    def cache(self, inKey, inValue, inBytes):
+        # Caches pixels or sums of inBytes, dropping the least recently used
+        with self.lock:
+            if inKey not in self.sums:
+                self.sums[inKey] = (inValue, inBytes)
+                self.cacheSize += inBytes
+            while self.cacheSize > self.cacheBytes and len(self.sums) > 1:
+                self.cacheSize -= self.sums.popitem(last=False)[1][1]
+
+    def fovPosition(self, inRow, inCol, inFov):
+        # Top left corner of a FOV in the plate canvas
+        bbox = wellBbox(inRow, inCol)
+        return (bbox[0] + (inFov % wellWidth) * (imWidth + paddingFOV),
+                bbox[1] + (inFov // wellWidth) * (imHeight + paddingFOV))
+
+    def fovImage(self, inRow, inCol, inFov, inScale):
+        # Difference of a FOV and the empty canvas of the well, as block sums
+        # of inScale x inScale blocks. The 8-bit FOV (a placeholder if the
+        # file is missing) and the block sums of every scale are cached; sums
+        # are added up from the cached sums of half the scale, or else from
+        # the FOV, which is then not cached, so that FOVs read for low levels
+        # do not push the small sums of other FOVs out of the cache
+        locKey = (inRow, inCol, inFov, inScale)
+        locArr = self.cached(locKey)
+        if locArr is None:
+            locHalf = inScale // 2
+            locHalfArr = self.cached((inRow, inCol, inFov, locHalf)) if locHalf > 1 else None
+            locPosW, locPosN = self.fovPosition(inRow, inCol, inFov)
+            if inScale == 1:
+                locArr = self.fovPixels(inRow, inCol, inFov)
+            elif locHalfArr is not None:
+                locArr = blockSums(locHalfArr, (locPosW // locHalf, locPosN // locHalf), 2)
+            else:
+                locPixels = self.cached((inRow, inCol, inFov, 1))
+                if locPixels is None:
+                    locPixels = self.fovPixels(inRow, inCol, inFov)
+                locH, locW = locPixels.shape
+                locArr = blockSums(locPixels, (locPosW, locPosN), inScale) - np.float32(bgEmptyWell) * np.outer(
+                    blockOverlap(locPosN, locPosN + locH, locPosN // inScale, (locPosN + locH - 1) // inScale + 1, inScale),
+                    blockOverlap(locPosW, locPosW + locW, locPosW // inScale, (locPosW + locW - 1) // inScale + 1, inScale)).astype(np.float32)
+            self.cache(locKey, locArr, locArr.nbytes)
+        return(locArr - np.float32(bgEmptyWell) if inScale == 1 else locArr)
+
+    def labelShape(self, inRow, inCol):
+        # Size of the top left part of a well that its label covers,
+        # clipped to the well as in drawWellLabel
+        locParts = wellLabelParts(plateRow[inRow], inCol + 1)
+        return (min(imWellHeight, max(locPos[1] + locMask.size[1] for locMask, locPos in locParts)),
+                min(imWellWidth, max(locPos[0] + locMask.size[0] for locMask, locPos in locParts)))
+
+    def labelImage(self, inRow, inCol, inScale):
+        # Difference that the well label makes to the top left part of the
+        # well, as block sums of inScale x inScale blocks, so that the sums
+        # of the canvas include the blended label. The sums of every scale
+        # are cached, and added up from the cached sums of half the scale,
+        # or else from labelPixels
+        locKey = ('label', inRow, inCol, inScale)
+        locArr = self.cached(locKey)
+        if locArr is None:
+            bbox = wellBbox(inRow, inCol)
+            locHalf = inScale // 2
+            locHalfArr = self.cached(('label', inRow, inCol, locHalf)) if locHalf >= 1 else None
+            if inScale == 1:
+                locArr = self.labelPixels(inRow, inCol)
+            elif locHalfArr is not None:
+                locArr = blockSums(locHalfArr, (bbox[0] // locHalf, bbox[1] // locHalf), 2)
+            else:
+                locArr = blockSums(self.labelPixels(inRow, inCol), bbox[:2], inScale)
+            self.cache(locKey, locArr, locArr.nbytes)
+        return(locArr)
+
+    def labelPixels(self, inRow, inCol):
+        # Difference that the well label makes to the pixels of the top left
+        # part of the well, drawn with drawWellLabel over the FOVs as in
+        # processWell; FOVs read for it are not cached
+        locH, locW = self.labelShape(inRow, inCol)
+        locWell = np.full((locH, locW), bgEmptyWell, dtype=np.uint8)
+        for locIfov in wellFOVs:
+            locPosW = (locIfov % wellWidth) * (imWidth + paddingFOV)
+            locPosN = (locIfov // wellWidth) * (imHeight + paddingFOV)
+            if locPosW < locW and locPosN < locH:
+                locPixels = self.cached((inRow, inCol, locIfov, 1))
+                if locPixels is None:
+                    locPixels = self.fovPixels(inRow, inCol, locIfov)
+                locWell[locPosN:locPosN + imHeight, locPosW:locPosW + imWidth] = locPixels[:locH - locPosN, :locW - locPosW]
+        locArr = -locWell.astype(np.int16)
+        drawWellLabel(locWell, plateRow[inRow], inCol + 1)
+        locArr += locWell
+        return(locArr)
+
+    def fovPixels(self, inRow, inCol, inFov):
+        # 8-bit FOV of the channel, or the placeholder of a missing FOV
+        locImFOV = readFOV(fovPath(plateRow[inRow], inCol + 1, inFov, self.ch))
+        if locImFOV is None:
+            return(np.asarray(missingFOVImage(inFov)))
+        elif locImFOV.dtype == np.uint16:
+            return(np.take(imLUTs[self.ich], locImFOV))
+        return(rescaleFOV(locImFOV, *imInts[self.ich]))
 
 
 if __name__ == "__main__":
@@ -516,8 +3396,8 @@ if __name__ == "__main__":
     # dimensions of the blank image
     imWidth, imHeight = args.imdim
 
-    # channel: 0-2
-    imCh = args.imch
+    # channels: 0-2
+    imChannels = args.imch
 
     # extension of the image file
     imExt = args.imext
@@ -525,8 +3405,13 @@ if __name__ == "__main__":
     # directory with image files
     imDir = args.indir
 
-    # Values for clipping image intensities
-    imIntMin, imIntMax = args.imint
+    # names of image files; the convention A01f00d0.TIFF by default
+    imNames = args.names
+    if imNames is None:
+        imNames = r'(?P<row>[A-Z])(?P<col>\d{2})f(?P<fov>\d{2})d(?P<ch>\d)\.' + re.escape(imExt)
+
+    # Values for clipping image intensities, for every channel
+    imInts = args.imint
 
     # flag for image inversion
     imInv = args.inv
@@ -541,13 +3426,15 @@ if __name__ == "__main__":
 
     paddingFOV = 5 #pixels; padding between FOV in a well
     paddingWell = 30 #pixels; padding between wells in a plate
+    resumeMargin = 8 #pixels; around a well, where resizing lower levels mixes in its pixels
+
+    # Folders for the plate canvases shared with worker processes, unless -M
+    # gives one; the first with room for them is used
+    montageShmDirs = [locDir for locDir in ('/dev/shm', tempfile.gettempdir()) if os.path.isdir(locDir)]
 
     # Parameters of the input image
     imDepthIn  = 2**16-1
 
-    # Rescaling factor based on image depth and upper clipping intensity
-    imRescFac = imDepthIn / (imIntMax - imIntMin)
-
     # Parameters of the output image
     imDepthOut = 2**8-1
     imMode = 'L' # 8-bit pixels, black and white (https://pillow.readthedocs.io/en/stable/handbook/concepts.html#concept-modes)
@@ -584,49 +3471,385 @@ if __name__ == "__main__":
         bgEmptyWell = imDepthOut # color of empty canvas for well montage
         bgEmptyPlate = imDepthOut # color of empty canvas for plate montage
 
+    # Canvases in files are filled when they are made, and a file system
+    # without room for them would end the run with SIGBUS
+    imMontageBytes = imPlateWidth * imPlateHeight * len(imChannels)
+    if args.memmap is not None and not args.update and args.serve is None:
+        if _free_space(_get_or_create_path(args.memmap)) < imMontageBytes:
+            print("Not enough space in %s for the montage of %.1f MB (-M)" % (args.memmap, imMontageBytes / 2**20))
+            sys.exit(1)
+
     myFontFOV = ImageFont.truetype(font=font_path, size=200)
     myFontWell= ImageFont.truetype(font=font_path, size=300)
 
+    # Image files of the input folder, listed once; missing and unexpected
+    # files are reported before any work, all of them with -v
+    imIndex = PlateIndex.scan(imDir, imNames, plateRow, range(1, plateWidth + 1), wellFOVs)
+    imMissing = imIndex.missing([(locRow, iCol+1, locIfov, locCh)
+                                 for locRow in plateRow for iCol in plateCol for locIfov in wellFOVs for locCh in imChannels])
+    if imMissing or imIndex.unexpected:
+        print("Image files in %s: %d missing, %d unexpected" % (imDir, len(imMissing), len(imIndex.unexpected)))
+        for locTitle, locNames in (
+                ("Missing", ["well %s%02d, FOV %d, channel %d" % locKey for locKey in imMissing]),
+                ("Unexpected", imIndex.unexpected)):
+            locShown = locNames if DEB else locNames[:10]
+            for locName in locShown:
+                print("  %s: %s" % (locTitle, locName))
+            if len(locNames) > len(locShown):
+                print("  ... and %d more %s files; -v lists all" % (len(locNames) - len(locShown), locTitle.lower()))
+
+    # Stages of the run timed with -T, from the choice of intensities by -A on
+    imProfile = StageProfile(args.profile)
+    imRunStart = time.perf_counter()
+    imRunTimes = os.times()
+
+    # One DZI per channel; suffixed with the channel if there are more
+    if len(imChannels) == 1:
+        imPathDirs = ['%s/%s.dzi' % (args.outdir, args.outfile)]
+    else:
+        imPathDirs = ['%s/%s_c%d.dzi' % (args.outdir, args.outfile, locCh) for locCh in imChannels]
+
+    # DZIs are made in a staging folder next to the output, and published
+    # once they are complete; an interrupted run leaves the published DZIs
+    # and their completion marker as they were
+    imStageDir = '%s/.%s_staging' % (args.outdir, args.outfile)
+    imStagePaths = [os.path.join(imStageDir, os.path.basename(imPathDir)) for imPathDir in imPathDirs]
+    imMarkerPath = '%s/%s_complete.json' % (args.outdir, args.outfile)
+
+    # Intensities for rescaling chosen by -A from a histogram of the image
+    # files of every channel, built before the first FOV is rescaled; they
+    # are the -I of the run, which is part of its settings. Intensities
+    # saved by a previous run, or by the interrupted run with -z, are kept
+    # while the sampled files have the same names, sizes and modification
+    # times, so that -u and -z read no image files to choose them
+    imContrasts = None
+    if args.autocontrast is not None:
+        with imProfile.stage('contrast'):
+            imContrasts = []
+            for locIch, locCh in enumerate(imChannels):
+                locFingerprint = sampleFingerprint(sampleFiles(locCh, args.every))
+                for locSaved in [loadContrast(imStagePaths[locIch]) if args.resume else None,
+                                 loadContrast(imPathDirs[locIch])]:
+                    if (locSaved is not None and locSaved.get('files') == locFingerprint
+                            and locSaved.get('percentiles') == list(args.autocontrast) and locSaved.get('every') == args.every):
+                        imInts[locIch] = tuple(locSaved['imint'])
+                        print("Channel %d: intensities %d - %d at percentiles %g - %g, kept as the sampled images are unchanged" % (
+                            locCh, imInts[locIch][0], imInts[locIch][1], args.autocontrast[0], args.autocontrast[1]))
+                        imContrasts.append(locSaved)
+                        break
+                else:
+                    imContrasts.append({'channel': locCh, 'files': locFingerprint})
+
+            locSampled = [locIch for locIch, locContrast in enumerate(imContrasts) if 'imint' not in locContrast]
+            imContrastHists, imContrastImages = sampleHistograms([imChannels[locIch] for locIch in locSampled], args.every, args.readers)
+            for locHist, locImages, locIch in zip(imContrastHists, imContrastImages, locSampled):
+                locCh = imChannels[locIch]
+                if locImages > 0:
+                    imInts[locIch] = contrastLimits(locHist, *args.autocontrast)
+                    print("Channel %d: intensities %d - %d at percentiles %g - %g of %d images" % (
+                        locCh, imInts[locIch][0], imInts[locIch][1], args.autocontrast[0], args.autocontrast[1], locImages))
+                else:
+                    print("Channel %d: no images to choose intensities from; using %d - %d" % ((locCh,) + imInts[locIch]))
+
+                imContrasts[locIch].update({'imint': list(imInts[locIch]), 'percentiles': args.autocontrast,
+                                            'every': args.every, 'images': locImages, 'pixels': int(locHist.sum())})
+            del imContrastHists
+
+    # Lookup tables with the 8-bit output for every 16-bit input intensity;
+    # same arithmetic as rescaleFOV, done once for all intensities of a channel
+    imLUTs = [rescaleLUT(*locInt) for locInt in imInts]
+
+
+    creators = [ImageCreator(
+        tile_size = args.tilesz,
+        tile_format = args.format,
+        image_quality = args.imquality,
+        resize_filter = 'antialias',
+        pyramid = args.pyramid,
+        cores = args.cores,
+        dedup = not args.nodedup,
+        pack = args.pack,
+        encoder_effort = args.effort,
+        writers = args.writers,
+        sync = args.sync,
+        profile = args.profile,
+    ) for locCh in imChannels]
+
+    # Manifest of input files, saved next to the DZI files for later updates;
+    # a change of these settings requires tiling the entire plate
+    imManifestPath = '%s/%s_manifest.json' % (args.outdir, args.outfile)
+    imManifest = PlateManifest(json.loads(json.dumps({a: args.__dict__[a] for a in (
+        'indir', 'inv', 'platedim', 'welldim', 'imdim', 'imint', 'imch', 'imext', 'names',
+        'tilesz', 'imquality', 'format', 'effort', 'pyramid', 'stream', 'pack')})))
+
+    if args.serve is not None:
+        # Tiles are rendered from the image files when the viewer requests them
+        from serveDZI import DZIServer, DiskCache
+
+        # Rendered tiles are kept in a folder per rendering settings;
+        # tiles rendered with other settings are removed
+        imRenderSettings = {a: imManifest.settings[a] for a in (
+            'indir', 'inv', 'platedim', 'welldim', 'imdim', 'imint', 'imch', 'imext', 'names', 'tilesz', 'imquality', 'format', 'effort')}
+        imCacheKey = hashlib.blake2b(json.dumps(imRenderSettings, sort_keys=True).encode(), digest_size=8).hexdigest()
+        imCacheRoot = _get_or_create_path('%s/%s_cache' % (args.outdir, args.outfile))
+        for locDir in os.listdir(imCacheRoot):
+            if locDir != imCacheKey:
+                shutil.rmtree(os.path.join(imCacheRoot, locDir), ignore_errors=True)
+
+        server = DZIServer(
+            ('127.0.0.1', args.serve),
+            args.outdir,
+            threads = args.readers,
+            verbose = DEB,
+            renderers = {os.path.splitext(os.path.abspath(imPathDir))[0]: PlateTileRenderer(locCh, creator)
+                         for locCh, creator, imPathDir in zip(imChannels, creators, imPathDirs)},
+            disk_cache = DiskCache(os.path.join(imCacheRoot, imCacheKey), args.cachesize * 2**20),
+        )
+
+        if imContrasts is not None:
+            saveContrast(imContrasts, imPathDirs)
+
+        print("Serving %s at http://127.0.0.1:%d" % (server.directory, args.serve))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        sys.exit(0)
 
     # Work
 
-    if (DEB):
-        print("Making montage of individual FOVs\n")
+    # Checkpoints of the run in the staging folder: its settings, and the
+    # files of the wells it read; the tiles saved to every DZI are logged
+    # by its store. A resumed run keeps the intact tiles
+    imResumePath = os.path.join(imStageDir, '%s_resume.json' % args.outfile)
+    imWellLogPath = os.path.join(imStageDir, '%s_wells.log' % args.outfile)
 
-    # create canvas for montage of the entire plate
-    imPlate = Image.new(imMode, (imPlateWidth, imPlateHeight), bgEmptyPlate)
+    imResumed = False
+    if args.resume and not args.update:
+        try:
+            with open(imResumePath) as locFile:
+                imResumed = json.load(locFile) == imManifest.settings
+        except (IOError, ValueError):
+            pass
 
-    for iRow in range(0, plateHeight):
-        for iCol in plateCol:
-            # Add image to montage canvas
+        if not imResumed:
+            print("No interrupted run with the same settings; starting over")
+        else:
+            imDones = [creator.resume(imPlateWidth, imPlateHeight, imStagePath, args.resumecheck)
+                       for creator, imStagePath in zip(creators, imStagePaths)]
+            imSkipWells = findResumedWells(imWellLogPath, creators, imDones, imManifest)
+            imResumed = imSkipWells is not None
+            if not imResumed:
+                print("Image files changed since the interrupted run; starting over")
+                imSkipWells = set()
+                for creator in creators:
+                    creator.resumed = None
+            elif (DEB):
+                print("Resuming the interrupted run: %d tiles kept, %d wells skipped\n" % (
+                    sum(map(len, imDones)), len(imSkipWells)))
+
+    if not imResumed:
+        shutil.rmtree(imStageDir, ignore_errors=True)
+        _get_or_create_path(imStageDir)
+        if not args.update:
+            with open(imResumePath, 'w') as locFile:
+                json.dump(imManifest.settings, locFile)
+            if imContrasts is not None:
+                saveContrast(imContrasts, imStagePaths)
+
+    # Start tiling workers before reader threads exist, since they are forked;
+    # all channels share the same workers
+    creators[0].open_pool()
+    for creator in creators[1:]:
+        creator.pool = creators[0].pool
+
+    # Wells to tile again in the update mode; None for the entire plate
+    imChangedWells = None
+
+    if (args.update):
+        imPrevious = PlateManifest.load(imManifestPath)
+        imOutputs = imPathDirs + ([_get_pack_path(imPathDir) for imPathDir in imPathDirs] if args.pack else [])
+        if imPrevious is None or imPrevious.settings != imManifest.settings or not all(map(os.path.isfile, imOutputs)):
+            print("No manifest of a previous run with the same settings; tiling the entire plate")
+        else:
+            imChangedWells = findChangedWells(imPrevious, imManifest)
+            if (DEB):
+                print("Wells to tile again: %d\n" % len(imChangedWells))
 
-            platePosW = iCol * (imWellWidth + paddingWell)
-            platePosE = platePosW + imWellWidth
-            platePosN = iRow * (imWellHeight + paddingWell)
-            platePosS = platePosN + imWellHeight
-            bbox = (platePosW, platePosN, platePosE, platePosS)
+    if imChangedWells is not None:
+        imUpdatePaths = stageOutputs(imPathDirs, imStagePaths)
 
+        # DZIs updated in place are incomplete until the update is published
+        if imUpdatePaths != imStagePaths:
+            _remove_file(imMarkerPath)
+
+        # Regions of the plate with all tiles that overlap a changed well
+        for creator, imUpdatePath, imStagePath in zip(creators, imUpdatePaths, imStagePaths):
+            creator.start_update(imPlateWidth, imPlateHeight, imUpdatePath, streamed=args.stream,
+                                 in_place=imUpdatePath != imStagePath)
+
+        imRegions = [wellBbox(iRow, iCol) for iRow, iCol in imChangedWells]
+        imRegionBounds = [creators[0].get_update_bounds(region) for region in imRegions]
+        imWellOrder = [well for bounds in imRegionBounds for well in regionWells(bounds)]
+    else:
+        imWellOrder = [(iRow, iCol) for iRow in range(0, plateHeight) for iCol in plateCol
+                       if (iRow, iCol) not in imSkipWells]
+
+    # Wells of the entire plate are assembled by the worker processes, which
+    # write them into canvases in shared files; the workers must be forked
+    # from this process, as they use its globals
+    imParallelWells = (imChangedWells is None and not args.stream and creators[0].pool is not None
+                       and multiprocessing.get_start_method() == 'fork')
+
+    # Shared canvases go to the first folder with room for them, or the
+    # wells are assembled by this process in memory
+    imMontageDir = args.memmap
+    if imParallelWells and imMontageDir is None:
+        imMontageDir = next((locDir for locDir in montageShmDirs if _free_space(locDir) >= imMontageBytes), None)
+        if imMontageDir is None:
+            imParallelWells = False
+            print("Not enough space in %s for the shared montage of %.1f MB; assembling wells in memory" % (
+                ' or '.join(montageShmDirs), imMontageBytes / 2**20))
+
+    wellReader = WellReader(
+        [] if imParallelWells else [(plateRow[iRow], iCol+1) for iRow, iCol in imWellOrder],
+        depth = args.readahead,
+        threads = args.readers,
+        stats = imManifest if args.stats else None,
+    )
+
+    if imChangedWells is not None:
+        for region, bounds in zip(imRegions, imRegionBounds):
             if (DEB):
-                print('\nBounding box for inserting Well image into Plate canvas:')
-                print(bbox)
+                print("Updating tiles in:", bounds)
 
-            imWell = processWell(plateRow[iRow], iCol+1)
-            imPlate.paste(imWell, bbox)
+            with imProfile.stage('montage'):
+                imRegionImages = processPlateRegion(bounds)
+            with imProfile.stage('pyramid'):
+                for creator, imRegionImage in zip(creators, imRegionImages):
+                    creator.update_region(region, imRegionImage, bounds)
 
+        with imProfile.stage('pyramid'):
+            for creator in creators:
+                creator.finish_update()
 
-    imPathDir = '%s/%s.dzi' % (args.outdir, args.outfile)
-    if (DEB):
-        print("\nMaking DeepZoom tiling in:\n" + imPathDir)
+    elif (args.stream):
+        wellReader.manifest = imManifest
+        wellReader.checkpoint = imWellLogPath
 
+        for creator, imPathDir, imStagePath in zip(creators, imPathDirs, imStagePaths):
+            if (DEB):
+                print("Making montage and DeepZoom tiling row by row in:\n" + imPathDir)
 
-    creator = ImageCreator(
-        tile_size = args.tilesz,
-        tile_format = 'png',
-        image_quality = args.imquality,
-        resize_filter = 'antialias',
-    )
+            creator.start_streamed(imPlateWidth, imPlateHeight, imStagePath)
+
+        for iRow in range(0, plateHeight):
+            with imProfile.stage('montage'):
+                imStrips = processPlateRow(iRow)
+            with imProfile.stage('pyramid'):
+                for creator, imStrip in zip(creators, imStrips):
+                    creator.add_strip(imStrip)
+
+        with imProfile.stage('pyramid'):
+            for creator in creators:
+                creator.finish_streamed()
+
+    else:
+        wellReader.manifest = imManifest
+        wellReader.checkpoint = imWellLogPath
 
-    creator.create(imPlate, imPathDir)
+        if (DEB):
+            print("Making montage of individual FOVs\n")
+
+        # create canvas for montage of the entire plate; files of
+        # memory-mapped canvases are removed once the plate is tiled
+        imPlates, imPlateFiles = zip(*[plateMontage(imMontageDir) for locCh in imChannels])
+        imPlates = list(imPlates)
+
+        try:
+            with imProfile.stage('montage'):
+                if imParallelWells:
+                    imWellChunks = _balanced_chunks(imWellOrder, args.cores * CHUNKS_PER_CORE)
+                    for locFiles, locWells, locProfile in creators[0].pool.starmap(assembleWells, [
+                            (chunk, imPlateFiles, imWellLogPath, max(1, args.readers // args.cores), args.stats) for chunk in imWellChunks]):
+                        for locPath, locRecord in locFiles.items():
+                            imManifest.record(locPath, locRecord)
+                        for locWell, locStats in locWells.items():
+                            imManifest.record_well(locWell, locStats)
+                        imProfile.merge(locProfile)
+                else:
+                    for iRow in range(0, plateHeight):
+                        for iCol in plateCol:
+                            if (iRow, iCol) in imSkipWells:
+                                continue
+
+                            # Add image to montage canvas
+                            bbox = wellBbox(iRow, iCol)
+
+                            if (DEB):
+                                print('\nBounding box for inserting Well image into Plate canvas:')
+                                print(bbox)
+
+                            processWell(plateRow[iRow], iCol+1, wellViews(imPlates, iRow, iCol))
+
+            for creator, imPathDir, imStagePath in zip(creators, imPathDirs, imStagePaths):
+                if (DEB):
+                    print("\nMaking DeepZoom tiling in:\n" + imPathDir)
+
+                # the montage of a channel is released once it is tiled
+                with imProfile.stage('pyramid'):
+                    creator.create(imPlates.pop(0), imStagePath)
+        finally:
+            for imPlateFile in imPlateFiles:
+                if imPlateFile is not None:
+                    _remove_file(imPlateFile)
+
+    wellReader.close()
+    creators[0].close_pool()
+
+    if (DEB):
+        print("\nTile encoding (%s, %s):" % (args.format, args.effort))
+        for creator, imPathDir in zip(creators, imPathDirs):
+            stats = creator.encode_stats.summary()
+            if stats["tiles"] == 0:
+                continue
+            print("%s: %d tiles, %.1f MB in %.1f s; per tile %.2f ms (median %.2f, p95 %.2f), %.0f bytes (median %.0f, max %.0f)" % (
+                imPathDir, stats["tiles"], stats["bytes"] / 2**20, stats["seconds"],
+                stats["ms"]["mean"], stats["ms"]["median"], stats["ms"]["p95"],
+                stats["size"]["mean"], stats["size"]["median"], stats["size"]["max"]))
+
+        print("\nTile writing (%d threads per process, sync %s):" % (args.writers, args.sync))
+        for creator, imPathDir in zip(creators, imPathDirs):
+            stats = creator.write_stats
+            if stats.files == 0:
+                continue
+            print("%s: %d files and links, %.1f MB in %.2f s of writing, %.1f MB/s per thread" % (
+                imPathDir, stats.files, stats.bytes / 2**20, stats.seconds,
+                stats.bytes / 2**20 / max(stats.seconds, 1e-9)))
+
+    # Publish the DZIs, then their manifest, so that an interruption in
+    # between makes the next update tile too much rather than too little;
+    # the marker is absent meanwhile
+    _remove_file(imMarkerPath)
+    with imProfile.stage('publish'):
+        publishOutputs(imStageDir, imStagePaths, imPathDirs)
+        imManifest.save(imManifestPath)
+        if imContrasts is not None:
+            saveContrast(imContrasts, imPathDirs)
+        if (args.stats):
+            imStatsMissing = saveWellStats(imManifest.wells, imPathDirs)
+            if imStatsMissing:
+                print("No intensity statistics of %d wells, which were not read with -a by this run or the run it updates or resumes" % imStatsMissing)
+    saveCompletionMarker(imMarkerPath, imPathDirs)
+
+    if (args.profile):
+        imReport = profileReport(imProfile, creators, time.perf_counter() - imRunStart, imRunTimes)
+        imReport['settings'] = imManifest.settings
+        with open('%s/%s_profile.json' % (args.outdir, args.outfile), 'w') as locFile:
+            json.dump(imReport, locFile, indent=1)
+        printProfile(imReport)
 
     if(DEB):
         print("\nAnalysis finished!\n")
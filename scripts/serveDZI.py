@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+# Serves a folder with DeepZoom images and the web viewer, e.g. demosite2x2,
+# over HTTP; replaces an external static file server.
+#
+# Files are served as they are, with support for Range requests.
+# Tiles of a DZI, <name>_files/<level>/<column>_<row>.<format>, are read from
+# the _files folder or, if there is no such file, from the <name>.dzp pack made
+# with makePlateMontageDZI.py -k. Pages thus open packed and unpacked
+# pyramids alike.
+#
+# Packs are memory-mapped; their index is a view on the map, so only the
+# tiles that are requested are read from disk. makePlateMontageDZI.py -S runs
+# this server with DZIs whose tiles are rendered on request; those are kept
+# in a folder on disk as well. Recently served tiles are kept
+# in memory (-c). Responses carry ETag and Cache-Control headers, so browsers
+# revalidate tiles with a short request once they expire (-a).
+#
+# Example:
+# ./serveDZI.py -p 1313 ../demosite2x2
+
+
+import os, argparse, re, mmap, hashlib, threading
+import http.server
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from makePlateMontageDZI import DeepZoomImageDescriptor, PACK_ENTRY, PACK_FOOTER, read_pack_footer, _get_pack_path
+
+
+# Tile requests: <name>_files/<level>/<column>_<row>.<format>
+TILE_PATH = re.compile(r"^(.+)_files/(\d+)/(\d+)_(\d+)\.(\w+)$")
+
+# Single byte range of a Range header
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class PackReader(object):
+    """Tiles of a pack (.dzp) read through a memory map of the file."""
+
+    def __init__(self, path, descriptor):
+        self.path = path
+        self.descriptor = descriptor
+
+        pack_file = open(path, "rb")
+        self.stat = os.fstat(pack_file.fileno())
+        self.map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        pack_file.close()
+
+        size = len(self.map)
+        index_offset, num_entries = read_pack_footer(self.map[max(0, size - PACK_FOOTER.size):], size)
+        self.index = np.frombuffer(self.map, dtype=PACK_ENTRY, count=num_entries, offset=index_offset)
+
+        # first index entry of every level
+        self.level_start = []
+        start = 0
+        for level in range(descriptor.num_levels):
+            self.level_start.append(start)
+            columns, rows = descriptor.get_num_tiles(level)
+            start += columns * rows
+        if start != num_entries:
+            raise ValueError("Tile pack %s does not match its descriptor" % path)
+
+    def changed(self):
+        """True if the pack was written again since it was mapped."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino) != (self.stat.st_mtime_ns, self.stat.st_size, self.stat.st_ino)
+
+    def grown(self):
+        """True if only bytes were appended to the pack since it was mapped,
+        which leaves its mapped tiles where they were."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_ino == self.stat.st_ino and stat.st_size >= self.stat.st_size
+
+    def read(self, level, column, row):
+        """Returns an encoded tile, or None if the pack does not have it."""
+        if level >= self.descriptor.num_levels:
+            return None
+        columns, rows = self.descriptor.get_num_tiles(level)
+        if column >= columns or row >= rows:
+            return None
+        offset, length = self.index[self.level_start[level] + row * columns + column].tolist()
+        if length == 0:
+            return None
+        return self.map[offset:offset + length]
+
+
+class TileCache(object):
+    """Recently served tiles with their ETag, up to a total size in bytes.
+
+    Every tile is stored with the version of its source, i.e. the size and
+    modification time of its file or the reader of its pack."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.tiles = OrderedDict() # path -> (tile, etag, version)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.tiles.get(path)
+            if entry is not None:
+                self.tiles.move_to_end(path)
+            return entry
+
+    def put(self, path, tile, etag, version):
+        if len(tile) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.tiles.pop(path, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.tiles[path] = (tile, etag, version)
+            self.size += len(tile)
+            while self.size > self.max_bytes:
+                self.size -= len(self.tiles.popitem(last=False)[1][0])
+
+    def clear(self, prefix):
+        """Forgets the tiles whose path starts with prefix."""
+        with self.lock:
+            for path in [path for path in self.tiles if path.startswith(prefix)]:
+                self.size -= len(self.tiles.pop(path)[0])
+
+
+class DiskCache(object):
+    """Encoded tiles kept in a folder up to a total size in bytes.
+
+    The least recently used tiles are removed first; tiles found in the
+    folder at start are ordered by their access time."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.files = OrderedDict() # path relative to directory -> size
+        self.lock = threading.Lock()
+
+        found = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                found.append((stat.st_atime, os.path.relpath(os.path.join(root, name), self.directory), stat.st_size))
+        for atime, key, size in sorted(found):
+            self.files[key] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+        try:
+            with open(os.path.join(self.directory, key), "rb") as tile_file:
+                return tile_file.read()
+        except OSError:
+            return None
+
+    def put(self, key, tile):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # complete files only, also if another thread puts the same tile
+        temp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(temp_path, "wb") as tile_file:
+            tile_file.write(tile)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.size += len(tile) - self.files.pop(key, 0)
+            self.files[key] = len(tile)
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+
+class DZIServer(http.server.HTTPServer):
+    """HTTP server that answers requests in a bounded pool of threads.
+
+    renderers maps the path of a DZI without extension to an object with
+    the descriptor of the image and a read(level, column, row) method that
+    returns an encoded tile; such DZIs need no files. Rendered tiles are
+    kept in disk_cache, if given."""
+
+    def __init__(self, address, directory, threads=16, cache_bytes=256 * 2**20, max_age=3600, verbose=False,
+                 renderers=None, disk_cache=None):
+        self.directory = os.path.abspath(directory)
+        self.renderers = renderers if renderers is not None else {}
+        self.disk_cache = disk_cache
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(threads)))
+        self.tile_cache = TileCache(cache_bytes)
+        self.max_age = max_age
+        self.verbose = verbose
+        self.packs = {} # path of a pack -> PackReader
+        self.packs_lock = threading.Lock()
+        super().__init__(address, DZIRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    def get_pack(self, name):
+        """Returns the reader of the pack of DZI <name>.dzi, or None if there is none."""
+        path = _get_pack_path(name)
+        with self.packs_lock:
+            pack = self.packs.get(path)
+            if pack is not None and not pack.changed():
+                return pack
+            fresh = None
+            if os.path.isfile(path):
+                descriptor = DeepZoomImageDescriptor()
+                descriptor.open(name + ".dzi")
+                try:
+                    fresh = PackReader(path, descriptor)
+                except ValueError:
+                    # a pack updated in place has no footer at its end until
+                    # the update is finished; its old tiles are still valid
+                    if pack is not None and pack.grown():
+                        return pack
+                    raise
+            if pack is not None:
+                # tiles of the previous version must not be served any more
+                self.tile_cache.clear(name + "_files" + os.sep)
+                del self.packs[path]
+            if fresh is not None:
+                self.packs[path] = fresh
+            return fresh
+
+    def read_tile(self, path):
+        """Returns an encoded tile and its ETag for the path of a tile file, or None."""
+        name, level, column, row, format = TILE_PATH.match(path).groups()
+
+        if name in self.renderers:
+            if format != self.renderers[name].descriptor.tile_format:
+                return None
+            return self.render_tile(path, self.renderers[name], int(level), int(column), int(row))
+
+        # the file comes first, so that an unpacked pyramid is never shadowed by a pack
+        pack = None
+        try:
+            stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            try:
+                pack = self.get_pack(name)
+            except (OSError, ValueError) as e:
+                self.log_error("Cannot read the pack of %s: %s", name, e)
+                return None
+            if pack is None:
+                return None
+            version = pack
+
+        entry = self.tile_cache.get(path)
+        if entry is not None and entry[2] == version:
+            return entry[:2]
+
+        if pack is None:
+            try:
+                with open(path, "rb") as tile_file:
+                    tile = tile_file.read()
+            except OSError:
+                return None
+        else:
+            tile = pack.read(int(level), int(column), int(row))
+            if tile is None:
+                return None
+
+        etag = '"%s"' % hashlib.blake2b(tile, digest_size=8).hexdigest()
+        self.tile_cache.put(path, tile, etag, version)
+        return tile, etag
+
+    def render_tile(self, path, renderer, level, column, row):
+        """Returns a tile of a rendered DZI and its ETag, or None."""
+        entry = self.tile_cache.get(path)
+        if entry is not None:
+            return entry[:2]
+
+        key = os.path.relpath(path, self.directory)
+        tile = self.disk_cache.get(key) if self.disk_cache is not None else None
+        if tile is None:
+            tile = renderer.read(level, column, row)
+            if tile is None:
+                return None
+            if self.disk_cache is not None:
+                self.disk_cache.put(key, tile)
+
+        etag = '"%s"' % hashlib.blake2b(tile, digest_size=8).hexdigest()
+        self.tile_cache.put(path, tile, etag, None)
+        return tile, etag
+
+    def log_error(self, format, *args):
+        print(format % args)
+
+
+class DZIRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files of the server folder and tiles of DZIs, also from packs."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=args[2].directory, **kwargs)
+
+    def do_GET(self):
+        self.send_content(True)
+
+    def do_HEAD(self):
+        self.send_content(False)
+
+    def send_content(self, with_body):
+        path = self.translate_path(self.path)
+
+        name, extension = os.path.splitext(path)
+        if extension == ".dzi" and name in self.server.renderers:
+            self.send_descriptor(self.server.renderers[name].descriptor, with_body)
+            return
+
+        # folder listings and redirects as a static file server does them
+        if os.path.isdir(path):
+            if with_body:
+                super().do_GET()
+            else:
+                super().do_HEAD()
+            return
+
+        if TILE_PATH.match(path):
+            self.send_tile(path, with_body)
+        else:
+            self.send_file(path, with_body)
+
+    def send_tile(self, path, with_body):
+        entry = self.server.read_tile(path)
+        if entry is None:
+            self.send_error(404, "File not found")
+            return
+        tile, etag = entry
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age=%d" % self.server.max_age,
+        }
+        if self.not_modified(etag, headers):
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(len(tile)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if with_body:
+            self.wfile.write(tile)
+
+    def send_descriptor(self, descriptor, with_body):
+        content = descriptor.to_xml()
+        headers = {
+            "ETag": '"%s"' % hashlib.blake2b(content, digest_size=8).hexdigest(),
+            "Cache-Control": "no-cache",
+        }
+        if self.not_modified(headers["ETag"], headers):
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if with_body:
+            self.wfile.write(content)
+
+    def send_file(self, path, with_body):
+        try:
+            content_file = open(path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        with content_file:
+            stat = os.fstat(content_file.fileno())
+            size = stat.st_size
+            headers = {
+                "ETag": '"%x-%x"' % (stat.st_mtime_ns, size),
+                # descriptors and pages change with every run; check them every time
+                "Cache-Control": "no-cache",
+                "Accept-Ranges": "bytes",
+            }
+            if self.not_modified(headers["ETag"], headers):
+                return
+
+            start, end = 0, size - 1
+            status = 200
+            match = BYTE_RANGE.match(self.headers.get("Range", "").strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), size - 1)
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+                headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+
+            self.send_response(status)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(end - start + 1))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+
+            if with_body:
+                content_file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = content_file.read(min(remaining, 2**20))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    def not_modified(self, etag, headers):
+        """Answers with 304 if the client has the current version; returns True then."""
+        client_etags = self.headers.get("If-None-Match")
+        if client_etags is None:
+            return False
+        if client_etags.strip() != "*" and etag not in [e.strip() for e in client_etags.split(",")]:
+            return False
+        self.send_response(304)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        return True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def parseArguments():
+        # Create argument parser
+        parser = argparse.ArgumentParser()
+
+        # Positional arguments
+        parser.add_argument(
+                'dir',
+                help='Folder to serve, e.g. demosite2x2; default current folder',
+                type=str,
+                nargs='?',
+                default='.')
+
+        # Optional arguments
+        parser.add_argument(
+                '-v',
+                '--verbose',
+                help='Verbose, log every request.',
+                default=False,
+                action="store_true")
+
+        parser.add_argument(
+                '-p',
+                '--port',
+                help='Port to listen on, default 1313',
+                type=int,
+                default=1313)
+
+        parser.add_argument(
+                '-b',
+                '--bind',
+                help='Address to listen on, default 127.0.0.1; use 0.0.0.0 for all interfaces',
+                type=str,
+                default='127.0.0.1')
+
+        parser.add_argument(
+                '-t',
+                '--threads',
+                help='Number of threads answering requests, default 16',
+                type=int,
+                default=16)
+
+        parser.add_argument(
+                '-c',
+                '--cache',
+                help='Memory for recently served tiles in MB, default 256',
+                type=int,
+                default=256)
+
+        parser.add_argument(
+                '-a',
+                '--maxage',
+                help='Time in seconds for which browsers may use a tile without asking the server again, default 3600',
+                type=int,
+                default=3600)
+
+        return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = parseArguments()
+
+    server = DZIServer(
+        (args.bind, args.port),
+        args.dir,
+        threads = args.threads,
+        cache_bytes = args.cache * 2**20,
+        max_age = args.maxage,
+        verbose = args.verbose,
+    )
+
+    print("Serving %s at http://%s:%d" % (server.directory, args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
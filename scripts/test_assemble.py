@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+# Wells assembled by the worker processes into a shared canvas give the
+# tiles, the manifest and the statistics of wells assembled one after the
+# other by a single process, e.g. with:
+# python -m pytest -q test_assemble.py
+
+import json
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize('shared', [(), ('-M', '{memmap}')], ids=['shm', 'memmap'])
+def test_shared_canvas_matches_serial_assembly(tmp_path, plate, run_montage, different_files, shared):
+    serial, parallel = str(tmp_path / 'serial'), str(tmp_path / 'parallel')
+    os.makedirs(str(tmp_path / 'memmap'))
+    run_montage(plate.args('-c', '0,1', '-t', 64, '-a', '-r', 1, '-o', serial))
+    run_montage(plate.args('-c', '0,1', '-t', 64, '-a', '-r', 3, '-R', 4,
+                           *[arg.format(memmap=tmp_path / 'memmap') for arg in shared], '-o', parallel))
+
+    for name in ('dzi_c0_files', 'dzi_c1_files'):
+        assert different_files(os.path.join(serial, name), os.path.join(parallel, name)) == []
+    for name in ('dzi_c0_stats.csv', 'dzi_c1_stats.csv', 'dzi_c0_fov_stats.csv'):
+        assert open(os.path.join(serial, name)).read() == open(os.path.join(parallel, name)).read()
+    with open(os.path.join(serial, 'dzi_manifest.json')) as serialFile, open(os.path.join(parallel, 'dzi_manifest.json')) as parallelFile:
+        serialManifest, parallelManifest = json.load(serialFile), json.load(parallelFile)
+    assert serialManifest['files'] == parallelManifest['files']
+    # the memory-mapped canvases are removed
+    assert os.listdir(str(tmp_path / 'memmap')) == []
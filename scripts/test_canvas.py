@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# FOVs rescaled straight into the plate canvas are the rescaled images at
+# their place in the full resolution level, for every way of assembling
+# the plate, e.g. with:
+# python -m pytest -q test_canvas.py
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+from conftest import FOV, PLATE, WELL
+
+
+# Padding between FOVs and between wells, as set up in main of the script
+PADDING_FOV = 5
+PADDING_WELL = 30
+
+# The well label, drawn at the bottom right of the well, covers part of
+# the bottom right FOV and at most this many rows at the bottom of the FOV
+# above it
+LABEL_ROWS = 8
+
+
+def fullLevel(folder, name):
+    # The full resolution level of a pyramid pasted from its tiles
+    descriptor = montage.DeepZoomImageDescriptor()
+    descriptor.open(os.path.join(folder, name + '.dzi'))
+    level = descriptor.num_levels - 1
+    width, height = descriptor.get_dimensions(level)
+    image = np.zeros((height, width), dtype=np.uint8)
+    columns, rows = descriptor.get_num_tiles(level)
+    for column in range(columns):
+        for row in range(rows):
+            x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+            image[y1:y2, x1:x2] = Image.open(os.path.join(folder, name + '_files', str(level), '%d_%d.png' % (column, row)))
+    return image
+
+
+@pytest.mark.parametrize('assembly', [('-r', 1), ('-r', 3), ('-s',)], ids=['serial', 'shared', 'streamed'])
+@pytest.mark.parametrize('inverted', [False, True], ids=['plain', 'inverted'])
+def test_fovs_rescaled_into_place(tmp_path, monkeypatch, plate, run_montage, assembly, inverted):
+    # globals set up in main of the script
+    monkeypatch.setattr(montage, 'imDepthIn', 2**16 - 1, raising=False)
+    monkeypatch.setattr(montage, 'imInv', inverted, raising=False)
+    ranges = {0: (250, 3000), 1: (100, 1500)}
+    folder = str(tmp_path / 'out')
+    run_montage(plate.args('-c', '0,1', '-t', 64, '-I', 250, 3000, '-I', 100, 1500, *assembly,
+                           *(['-i'] if inverted else []), '-o', folder))
+
+    wellWidth = WELL[0] * (FOV[0] + PADDING_FOV) - PADDING_FOV
+    wellHeight = WELL[1] * (FOV[1] + PADDING_FOV) - PADDING_FOV
+    for ch in (0, 1):
+        canvas = fullLevel(folder, 'dzi_c%d' % ch)
+        for row in range(PLATE[1]):
+            for col in range(PLATE[0]):
+                for fov in range(WELL[0] * WELL[1]):
+                    path = os.path.join(plate.folder, '%s%02df%02dd%d.TIFF' % ('AB'[row], col + 1, fov, ch))
+                    if not os.path.isfile(path):
+                        continue
+                    x = col * (wellWidth + PADDING_WELL) + fov % WELL[0] * (FOV[0] + PADDING_FOV)
+                    y = row * (wellHeight + PADDING_WELL) + fov // WELL[0] * (FOV[1] + PADDING_FOV)
+                    if fov == WELL[0] * WELL[1] - 1:
+                        continue
+                    # FOVs of the right column are compared above the label
+                    height = FOV[1] - LABEL_ROWS if fov % WELL[0] == WELL[0] - 1 else FOV[1]
+                    expected = montage.rescaleFOV(np.asarray(Image.open(path)), *ranges[ch])
+                    np.testing.assert_array_equal(canvas[y:y + height, x:x + FOV[0]], expected[:height], err_msg=path)
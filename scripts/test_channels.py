@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Channels given to -c as a comma-separated list or by repeating -c,
+# also right before the input folder, are tiled together into the same
+# pyramids as single channel runs, e.g. with:
+# python -m pytest -q test_channels.py
+
+import filecmp
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize('channels', [('-c', '0,1'), ('-c', 0, '-c', 1)], ids=['list', 'repeated'])
+def test_channels_match_single_channel_runs(tmp_path, plate, run_montage, channels):
+    both = str(tmp_path / 'both')
+    run_montage(plate.args('-t', 64, '-o', both, *channels))
+
+    for ch in (0, 1):
+        single = str(tmp_path / ('c%d' % ch))
+        run_montage(plate.args('-t', 64, '-o', single, '-c', ch))
+        assert filecmp.cmp(os.path.join(single, 'dzi.dzi'), os.path.join(both, 'dzi_c%d.dzi' % ch), shallow=False)
+        for level in os.listdir(os.path.join(single, 'dzi_files')):
+            names = sorted(os.listdir(os.path.join(single, 'dzi_files', level)))
+            assert names == sorted(os.listdir(os.path.join(both, 'dzi_c%d_files' % ch, level)))
+            match, mismatch, errors = filecmp.cmpfiles(os.path.join(single, 'dzi_files', level),
+                                                       os.path.join(both, 'dzi_c%d_files' % ch, level), names, shallow=False)
+            assert not mismatch and not errors, (level, mismatch, errors)
+
+
+def test_channels_must_be_numbers(plate, run_montage):
+    result = run_montage(plate.args('-c', '0,x'), check=False)
+    assert result.returncode == 2 and '-c/--imch needs channel numbers' in result.stderr
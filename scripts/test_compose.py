@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Every level of a pyramid made with -P tiles is the level above reduced
+# with a 2x2 box filter, also across the edges and overlaps of the tiles
+# it was composed from, e.g. with:
+# python -m pytest -q test_compose.py
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+
+
+def levelImage(folder, descriptor, level):
+    # A level pasted from its tiles; the overlaps of neighbouring tiles
+    # must agree with the tiles they overlap
+    width, height = descriptor.get_dimensions(level)
+    image = np.full((height, width), -1, dtype=np.int16)
+    columns, rows = descriptor.get_num_tiles(level)
+    for column in range(columns):
+        for row in range(rows):
+            x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+            tile = np.asarray(Image.open(os.path.join(folder, 'dzi_files', str(level), '%d_%d.png' % (column, row))), dtype=np.int16)
+            pasted = image[y1:y2, x1:x2]
+            assert ((pasted == -1) | (pasted == tile)).all(), (level, column, row)
+            image[y1:y2, x1:x2] = tile
+    assert (image >= 0).all()
+    return image.astype(np.uint8)
+
+
+@pytest.mark.parametrize('tileSize', [62, 64, 254])
+def test_composed_levels_reduce_level_above(tmp_path, plate, run_montage, tileSize):
+    folder = str(tmp_path / 'composed')
+    run_montage(plate.args('-c', 0, '-t', tileSize, '-P', 'tiles', '-o', folder))
+    descriptor = montage.DeepZoomImageDescriptor()
+    descriptor.open(os.path.join(folder, 'dzi.dzi'))
+
+    above = levelImage(folder, descriptor, descriptor.num_levels - 1)
+    for level in reversed(range(descriptor.num_levels - 1)):
+        image = levelImage(folder, descriptor, level)
+        np.testing.assert_array_equal(image, np.asarray(Image.fromarray(above).reduce(2)), err_msg=str(level))
+        above = image
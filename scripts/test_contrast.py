@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Intensities chosen by -A at percentiles of the histogram of sampled
+# images are the nearest-rank percentiles of their pixels, as numpy gives
+# them, e.g. with:
+# python -m pytest -q test_contrast.py
+
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+
+
+@pytest.fixture
+def depth(monkeypatch):
+    # global set up in main of the script
+    monkeypatch.setattr(montage, 'imDepthIn', 2**16 - 1, raising=False)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_hist_percentiles_match_numpy(depth, seed):
+    rng = np.random.default_rng(seed)
+    pixels = np.clip(rng.lognormal(7, 1 + seed / 2, size=rng.integers(1, 50000)), 0, 65535).astype(np.uint16)
+    percentiles = [0, 0.1, 1, 25, 50, 99, 99.9, 100]
+
+    hist, _ = montage.fovHistogram(pixels)
+    expected = np.percentile(pixels, percentiles, method='inverted_cdf')
+    assert montage.histPercentiles(np.cumsum(hist), percentiles) == [int(value) for value in expected]
+    assert montage.contrastLimits(hist, 1, 99) == (int(expected[2]), max(int(expected[5]), int(expected[2]) + 1))
+
+
+def test_limits_are_apart(depth):
+    flat = np.full(1000, 700, dtype=np.uint16)
+    assert montage.contrastLimits(montage.fovHistogram(flat)[0], 1, 99) == (700, 701)
+    saturated = np.full(1000, 65535, dtype=np.uint16)
+    assert montage.contrastLimits(montage.fovHistogram(saturated)[0], 1, 99) == (65534, 65535)
+
+
+@pytest.mark.parametrize('every', [1, 3])
+def test_autocontrast_of_plate(tmp_path, plate, run_montage, every):
+    folder = str(tmp_path / 'out')
+    run_montage(plate.args('-c', '0,1', '-t', 64, '-A', 5, 95, '-e', every, '-o', folder))
+
+    for ch in (0, 1):
+        # every n-th image file of the channel, in the order of wells and FOVs
+        names = sorted(name for name in os.listdir(plate.folder) if name.endswith('d%d.TIFF' % ch))[::every]
+        pixels = np.concatenate([np.asarray(Image.open(os.path.join(plate.folder, name))).ravel() for name in names])
+        with open(os.path.join(folder, 'dzi_c%d_contrast.json' % ch)) as contrastFile:
+            contrast = json.load(contrastFile)
+        assert contrast['images'] == len(names) and contrast['pixels'] == pixels.size
+        assert contrast['imint'] == [int(value) for value in np.percentile(pixels, [5, 95], method='inverted_cdf')]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Tiles identical to a saved tile, e.g. of the padding between wells, are
+# hard links to its file in a _files folder and share its bytes in a pack;
+# the pyramid is the same as with every tile encoded (-N), e.g. with:
+# python -m pytest -q test_dedup.py
+
+import collections
+import os
+
+import numpy as np
+
+import makePlateMontageDZI as montage
+
+
+def tileFiles(folder):
+    return [os.path.join(root, name) for root, _, names in os.walk(os.path.join(folder, 'dzi_files')) for name in names]
+
+
+def test_identical_tiles_are_linked(tmp_path, plate, run_montage, different_files):
+    linked, encoded = str(tmp_path / 'linked'), str(tmp_path / 'encoded')
+    run_montage(plate.args('-c', 0, '-t', 16, '-o', linked))
+    run_montage(plate.args('-c', 0, '-t', 16, '-N', '-o', encoded))
+
+    assert different_files(os.path.join(encoded, 'dzi_files'), os.path.join(linked, 'dzi_files')) == []
+    assert different_files(os.path.join(linked, 'dzi_files'), os.path.join(encoded, 'dzi_files')) == []
+
+    links = collections.defaultdict(list)
+    for path in tileFiles(linked):
+        links[os.stat(path).st_ino].append(path)
+    shared = [paths for paths in links.values() if len(paths) > 1]
+    assert shared
+    # linked tiles are encoded alike
+    for paths in shared:
+        contents = set()
+        for path in paths:
+            with open(os.path.join(encoded, os.path.relpath(path, linked)), 'rb') as tileFile:
+                contents.add(tileFile.read())
+        assert len(contents) == 1, paths
+    assert all(os.stat(path).st_nlink == 1 for path in tileFiles(encoded))
+
+
+def test_identical_tiles_share_bytes_in_pack(tmp_path, plate, run_montage):
+    packed = str(tmp_path / 'packed')
+    run_montage(plate.args('-c', 0, '-t', 16, '-k', '-o', packed))
+    with open(os.path.join(packed, 'dzi.dzp'), 'rb') as packFile:
+        entries = montage.read_pack_index(packFile)[1]
+    tiles = entries[entries['length'] > 0]
+    assert len(np.unique(tiles)) < len(tiles)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Tiles encoded by makePlateMontageDZI.py decode with Pillow to the pixels
+# of the tile for every encoder effort: exactly as PNG and lossless WebP,
+# closely as JPEG and WebP, e.g. with:
+# python -m pytest -q test_encode.py
+
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+
+
+def noisyTile(mode, width=254, height=201):
+    # Noise on a gradient with flat padding, as tiles of a plate
+    rng = np.random.default_rng(0)
+    bands = len(mode)
+    pixels = np.clip(rng.normal(120, 60, (height, width, bands)) + np.arange(width)[:, None] / 4, 0, 255).astype(np.uint8)
+    pixels[:, 200:] = 7
+    return Image.fromarray(pixels[:, :, 0] if bands == 1 else pixels, mode)
+
+
+@pytest.mark.parametrize('effort', montage.ENCODER_EFFORTS)
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+def test_png_round_trip(mode, effort):
+    tile = noisyTile(mode)
+    data = montage._encode_png(tile, montage.PNG_PROFILES[effort])
+
+    decoded = Image.open(io.BytesIO(data))
+    assert decoded.mode == mode and decoded.size == tile.size
+    np.testing.assert_array_equal(np.asarray(decoded), np.asarray(tile))
+
+
+def test_png_up_filter_of_single_row():
+    tile = noisyTile('L', height=1)
+    decoded = Image.open(io.BytesIO(montage._encode_png(tile, montage.PNG_PROFILES['fastest'])))
+    np.testing.assert_array_equal(np.asarray(decoded), np.asarray(tile))
+
+
+def encodeTile(tile, tileFormat, quality, effort):
+    creator = montage.ImageCreator(tile_format=tileFormat, image_quality=quality, encoder_effort=effort)
+    creator.descriptor = montage.DeepZoomImageDescriptor(tile_format=tileFormat)
+    return creator.encode_tile(tile)
+
+
+def psnr(decoded, tile):
+    error = np.mean((np.asarray(decoded, dtype=np.float64) - np.asarray(tile, dtype=np.float64)) ** 2)
+    return 10 * np.log10(255 ** 2 / error)
+
+
+@pytest.mark.parametrize('effort', montage.ENCODER_EFFORTS)
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+def test_lossy_round_trip(mode, effort):
+    # grey tiles, as of a plate, which chroma subsampling leaves intact
+    tile = noisyTile('L').convert(mode)
+    for tileFormat, pillowFormat in (('jpg', 'JPEG'), ('webp', 'WEBP')):
+        decoded = Image.open(io.BytesIO(encodeTile(tile, tileFormat, 0.9, effort)))
+        assert decoded.format == pillowFormat and decoded.size == tile.size
+        assert psnr(decoded.convert(mode), tile) > 28, (tileFormat, effort)
+
+
+@pytest.mark.parametrize('effort', montage.ENCODER_EFFORTS)
+def test_lossless_webp_round_trip(effort):
+    # quality 1 stores WebP tiles losslessly
+    for mode in ('L', 'RGB'):
+        tile = noisyTile(mode)
+        decoded = Image.open(io.BytesIO(encodeTile(tile, 'webp', 1.0, effort)))
+        np.testing.assert_array_equal(np.asarray(decoded.convert(mode)), np.asarray(tile))
+
+
+def test_smallest_jpeg_not_larger():
+    tile = noisyTile('L')
+    assert len(encodeTile(tile, 'jpg', 0.8, 'smallest')) <= len(encodeTile(tile, 'jpg', 0.8, 'fastest'))
+
+
+def test_jpeg_pyramid(tmp_path, plate, run_montage):
+    folder = str(tmp_path / 'jpeg')
+    run_montage(plate.args('-c', 0, '-t', 64, '-F', 'jpg', '-E', 'smallest', '-o', folder))
+    assert 'Format="jpg"' in open(os.path.join(folder, 'dzi.dzi')).read()
+    tile = Image.open(os.path.join(folder, 'dzi_files', '0', '0_0.jpg'))
+    assert tile.format == 'JPEG' and tile.mode == 'L'
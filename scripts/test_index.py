@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# The input folder is indexed once by the regular expression of -n: rows
+# given as letters or numbers, files outside the plate reported, and a
+# plate with other names tiled as with the default names, e.g. with:
+# python -m pytest -q test_index.py
+
+import os
+import re
+import shutil
+
+import makePlateMontageDZI as montage
+
+
+DEFAULT_NAMES = r'(?P<row>[A-Z])(?P<col>\d{2})f(?P<fov>\d{2})d(?P<ch>\d)\.' + re.escape('TIFF')
+NUMBERED_NAMES = r'plate_r(?P<row>\d+)_c(?P<col>\d+)_f(?P<fov>\d+)_w(?P<ch>\d+)\.tif'
+
+
+def touch(folder, *names):
+    for name in names:
+        open(os.path.join(folder, name), 'w').close()
+
+
+def test_scan_default_names(tmp_path):
+    folder = str(tmp_path)
+    touch(folder, 'A01f00d0.TIFF', 'B03f03d1.TIFF', 'A01f00d0.tiff', 'C01f00d0.TIFF', 'A04f00d0.TIFF',
+          'A01f04d0.TIFF', 'notes.txt', '.A02f00d0.TIFF')
+    os.mkdir(os.path.join(folder, 'A02f00d0.TIFF'))
+
+    index = montage.PlateIndex.scan(folder, DEFAULT_NAMES, 'AB', range(1, 4), range(4))
+    assert index.files == {('A', 1, 0, 0): folder + '/A01f00d0.TIFF', ('B', 3, 3, 1): folder + '/B03f03d1.TIFF'}
+    # other extensions, wells and FOVs outside the plate, other files
+    assert index.unexpected == ['A01f00d0.tiff', 'A01f04d0.TIFF', 'A04f00d0.TIFF', 'C01f00d0.TIFF', 'notes.txt']
+    assert index.missing([('A', 1, 0, 0), ('A', 1, 1, 0)]) == [('A', 1, 1, 0)]
+
+
+def test_scan_numbered_rows(tmp_path):
+    folder = str(tmp_path)
+    touch(folder, 'plate_r1_c1_f0_w0.tif', 'plate_r2_c10_f3_w2.tif', 'plate_r3_c1_f0_w0.tif', 'plate_r02_c10_f03_w2.tif')
+
+    index = montage.PlateIndex.scan(folder, NUMBERED_NAMES, 'AB', range(1, 13), range(4))
+    assert set(index.files) == {('A', 1, 0, 0), ('B', 10, 3, 2)}
+    # row 3 is outside the plate; the same FOV given twice is reported once
+    assert len(index.unexpected) == 2 and 'plate_r3_c1_f0_w0.tif' in index.unexpected
+
+
+def test_names_give_same_pyramid(tmp_path, plate, run_montage, different_files):
+    renamed = str(tmp_path / 'renamed')
+    os.mkdir(renamed)
+    for name in os.listdir(plate.folder):
+        match = re.fullmatch(DEFAULT_NAMES, name)
+        shutil.copyfile(os.path.join(plate.folder, name), os.path.join(renamed, 'plate_r%d_c%d_f%d_w%s.tif' % (
+            ord(match.group('row')) - 64, int(match.group('col')), int(match.group('fov')), match.group('ch'))))
+
+    default, named = str(tmp_path / 'default'), str(tmp_path / 'named')
+    run_montage(plate.args('-c', 0, '-t', 64, '-o', default))
+    result = run_montage(plate.args('-c', 0, '-t', 64, '-n', NUMBERED_NAMES, '-o', named)[:-1] + [renamed])
+    assert different_files(os.path.join(default, 'dzi_files'), os.path.join(named, 'dzi_files')) == []
+    assert different_files(os.path.join(named, 'dzi_files'), os.path.join(default, 'dzi_files')) == []
+    assert 'Traceback' not in result.stderr
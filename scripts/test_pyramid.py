@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Levels of a pyramid resized from the level above, as ImageCreator does,
+# stay close to levels resized from the full resolution image, e.g. with:
+# python -m pytest -q test_pyramid.py
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+
+
+# Tolerance of a cascaded level against a LANCZOS resize of the full
+# resolution image, in grey levels: mean and RMS of the absolute
+# differences, and the largest difference of a pixel
+MAX_MEAN = 1.5
+MAX_RMS = 2.5
+MAX_DIFF = 12
+
+
+def plateImage(width, height, seed=1):
+    # Montage-like image: noisy FOVs of a well on the white padding
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), 255, dtype=np.uint8)
+    for y in range(0, height - 250 + 1, 260):
+        for x in range(0, width - 250 + 1, 260):
+            image[y:y + 250, x:x + 250] = np.clip(rng.normal(80, 40, (250, 250)), 0, 255)
+    return image
+
+
+def levelCreator(source, width, height):
+    creator = montage.ImageCreator(tile_size=254, resize_filter='antialias')
+    creator.image = source
+    creator.descriptor = montage.DeepZoomImageDescriptor(
+        width=width, height=height, tile_size=254, tile_overlap=1, tile_format='png')
+    return creator
+
+
+@pytest.mark.parametrize('asArray', [False, True], ids=['image', 'array'])
+@pytest.mark.parametrize('size', [(2080, 1560), (1301, 777)])
+def test_cascade_within_tolerance_of_full_resize(size, asArray):
+    width, height = size
+    pixels = plateImage(width, height)
+    image = Image.fromarray(pixels)
+    creator = levelCreator(pixels if asArray else image, width, height)
+
+    # from the top, as ImageCreator.create goes through the levels
+    for level in reversed(range(creator.descriptor.num_levels)):
+        levelWidth, levelHeight = creator.descriptor.get_dimensions(level)
+        cascaded = np.asarray(creator.get_image(level), dtype=np.float64)
+        direct = np.asarray(image.resize((levelWidth, levelHeight), Image.LANCZOS), dtype=np.float64)
+
+        assert cascaded.shape == (levelHeight, levelWidth)
+        diff = np.abs(cascaded - direct)
+        assert diff.mean() <= MAX_MEAN, "level %d" % level
+        assert np.sqrt((diff ** 2).mean()) <= MAX_RMS, "level %d" % level
+        assert diff.max() <= MAX_DIFF, "level %d" % level
+
+
+def test_first_level_below_full_resolution_is_exact():
+    # resized from the source itself, as nothing was cached before
+    pixels = plateImage(1040, 780)
+    creator = levelCreator(Image.fromarray(pixels), 1040, 780)
+    top = creator.descriptor.num_levels - 1
+
+    np.testing.assert_array_equal(np.asarray(creator.get_image(top)), pixels)
+    np.testing.assert_array_equal(
+        np.asarray(creator.get_image(top - 1)),
+        np.asarray(Image.fromarray(pixels).resize(creator.descriptor.get_dimensions(top - 1), Image.LANCZOS)))
+
+
+@pytest.mark.parametrize('pyramid, maxDiff', [('resize', 1), ('tiles', 0)])
+@pytest.mark.parametrize('size', [(1040, 780), (1301, 777)])
+def test_update_matches_full_pyramid(tmp_path, monkeypatch, size, pyramid, maxDiff):
+    # tiles of lower levels made again by finish_update for a changed
+    # region, as with -u, against those of a pyramid of the changed image;
+    # resized parts of odd level sizes may round differently
+    monkeypatch.setattr(montage, 'DEB', False, raising=False) # set up in main of the script
+    width, height = size
+    pixels = plateImage(width, height)
+    changed = pixels.copy()
+    changed[260:510, 520:770] = plateImage(250, 250, seed=2)
+    region = (520, 260, 770, 510)
+
+    montage.ImageCreator(tile_size=254, resize_filter='antialias', pyramid=pyramid).create(
+        Image.fromarray(pixels), str(tmp_path / 'updated.dzi'))
+    updated = montage.ImageCreator(tile_size=254, resize_filter='antialias', pyramid=pyramid)
+    updated.start_update(width, height, str(tmp_path / 'updated.dzi'))
+    bounds = updated.get_update_bounds(region)
+    updated.update_region(region, Image.fromarray(changed).crop(bounds), bounds)
+    updated.finish_update()
+
+    full = montage.ImageCreator(tile_size=254, resize_filter='antialias', pyramid=pyramid)
+    full.create(Image.fromarray(changed), str(tmp_path / 'full.dzi'))
+
+    tiles = sorted((tmp_path / 'full_files').glob('*/*.png'))
+    assert tiles
+    for tile in tiles:
+        expected = np.asarray(Image.open(tile), dtype=np.int16)
+        actual = np.asarray(Image.open(tmp_path / 'updated_files' / tile.parent.name / tile.name), dtype=np.int16)
+        assert np.abs(actual - expected).max() <= maxDiff, tile
+
+
+def paddedBlockSums(array, pos, scale):
+    # block sums of the array padded with zeros to whole blocks of the canvas
+    left, top = pos[0] % scale, pos[1] % scale
+    columns, rows = -(-(left + array.shape[1]) // scale), -(-(top + array.shape[0]) // scale)
+    padded = np.zeros((rows * scale, columns * scale))
+    padded[top:top + array.shape[0], left:left + array.shape[1]] = array
+    return padded.reshape(rows, scale, columns, scale).sum(axis=(1, 3))
+
+
+@pytest.mark.parametrize('scale', [1, 2, 8, 64, 2**13])
+@pytest.mark.parametrize('pos', [(0, 0), (333, 517), (8191, 1)])
+def test_block_sums_match_padded_blocks(scale, pos):
+    # as the tile renderer of -S sums FOVs and labels, also at scales far
+    # larger than the array, and from the sums of half the scale
+    array = np.random.default_rng(3).integers(0, 256, (37, 53)).astype(np.float32) - 180
+    expected = paddedBlockSums(array, pos, scale)
+
+    np.testing.assert_array_equal(montage.blockSums(array, pos, scale), expected)
+    if scale > 1:
+        half = scale // 2
+        np.testing.assert_array_equal(
+            montage.blockSums(montage.blockSums(array, pos, half), (pos[0] // half, pos[1] // half), 2), expected)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# FOV images of upcoming wells are read ahead, at most -d wells ahead of
+# the one being processed, and a plate read by many threads far ahead
+# gives the tiles of a plate read one FOV at a time, e.g. with:
+# python -m pytest -q test_readahead.py
+
+import os
+import threading
+
+import makePlateMontageDZI as montage
+
+
+def test_reader_reads_depth_wells_ahead(monkeypatch):
+    read = []
+    lock = threading.Lock()
+
+    def readFOVRecord(path, stats=False):
+        with lock:
+            read.append(path)
+        return 'image %s%d f%d c%d' % path, {'size': 1}, None
+
+    # globals set up in main of the script
+    monkeypatch.setattr(montage, 'readFOVRecord', readFOVRecord)
+    monkeypatch.setattr(montage, 'fovPath', lambda row, col, fov, ch: (row, col, fov, ch))
+    monkeypatch.setattr(montage, 'imChannels', [0, 1], raising=False)
+    monkeypatch.setattr(montage, 'wellFOVs', range(3), raising=False)
+
+    wells = [('A', col) for col in range(1, 7)]
+    reader = montage.WellReader(wells, depth=2, threads=3)
+    try:
+        assert list(reader.pending) == wells[:2]
+        for i, (row, col) in enumerate(wells[:3]):
+            fovs = reader.read(row, col)
+            assert fovs == [['image %s%d f%d c%d' % (row, col, fov, ch) for fov in range(3)] for ch in (0, 1)]
+            assert list(reader.pending) == wells[i + 1:i + 3]
+
+        # a well out of order is read at once and not again later
+        assert reader.read('A', 6)[0][0] == 'image A6 f0 c0'
+        assert list(reader.pending) == wells[3:5]
+        reader.read('A', 4)
+        reader.read('A', 5)
+    finally:
+        reader.close()
+    assert sorted(read) == sorted((row, col, fov, ch) for row, col in wells for fov in range(3) for ch in (0, 1))
+
+
+def test_readahead_matches_serial_reads(tmp_path, plate, run_montage, different_files):
+    serial, ahead = str(tmp_path / 'serial'), str(tmp_path / 'ahead')
+    run_montage(plate.args('-c', 0, '-c', 1, '-t', 64, '-R', 1, '-d', 1, '-o', serial))
+    run_montage(plate.args('-c', 0, '-c', 1, '-t', 64, '-R', 8, '-d', 6, '-o', ahead))
+    for name in ('dzi_c0_files', 'dzi_c1_files'):
+        assert different_files(os.path.join(serial, name), os.path.join(ahead, name)) == []
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Tiles rendered on request with -S match the tiles of a made pyramid at
+# every level, well labels included, e.g. with:
+# python -m pytest -q test_render.py
+
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+import makePlateMontageDZI as montage
+
+
+# Largest difference of a pixel of a lower level from a pyramid made with
+# -P tiles, which rounds every level; not in the last row and column of a
+# level, where blocks of the montage are cut off and a made pyramid weighs
+# their pixels unequally
+MAX_DIFF = 2
+
+
+def madeTile(folder, name, level, column, row):
+    return np.asarray(Image.open(os.path.join(folder, '%s_files' % name, str(level), '%d_%d.png' % (column, row))), dtype=np.int16)
+
+
+def levelImage(folder, name, descriptor, level):
+    # The level of a made pyramid pasted from its tiles
+    width, height = descriptor.get_dimensions(level)
+    image = np.zeros((height, width), dtype=np.int16)
+    columns, rows = descriptor.get_num_tiles(level)
+    for column in range(columns):
+        for row in range(rows):
+            x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+            image[y1:y2, x1:x2] = madeTile(folder, name, level, column, row)
+    return image
+
+
+def blockMeans(image, scale):
+    # Means of the scale x scale blocks of an image, rounded; blocks cut off
+    # by its edges are means of their pixels inside it
+    height, width = image.shape
+    sums = np.add.reduceat(np.add.reduceat(image.astype(np.float64), np.arange(0, height, scale), axis=0),
+                           np.arange(0, width, scale), axis=1)
+    counts = np.outer(np.diff(np.append(np.arange(0, height, scale), height)),
+                      np.diff(np.append(np.arange(0, width, scale), width)))
+    return np.rint(sums / counts).astype(np.int16)
+
+
+def test_rendered_tiles_match_made_pyramid(tmp_path, plate, run_montage, server, fetch):
+    made = str(tmp_path / 'made')
+    run_montage(plate.args('-c', 0, '-t', 64, '-P', 'tiles', '-o', made))
+    descriptor = montage.DeepZoomImageDescriptor()
+    descriptor.open(os.path.join(made, 'dzi.dzi'))
+
+    url = server('makePlateMontageDZI.py', plate.args('-c', 0, '-t', 64, '-S', '{port}', '-o', tmp_path / 'served'))
+    status, _, body = fetch(url + 'dzi.dzi')
+    assert status == 200 and body == open(os.path.join(made, 'dzi.dzi'), 'rb').read()
+
+    top = descriptor.num_levels - 1
+    full = levelImage(made, 'dzi', descriptor, top)
+    for level in range(descriptor.num_levels):
+        width, height = descriptor.get_dimensions(level)
+        columns, rows = descriptor.get_num_tiles(level)
+        means = blockMeans(full, 2 ** (top - level))
+        for column in range(columns):
+            for row in range(rows):
+                status, _, body = fetch(url + 'dzi_files/%d/%d_%d.png' % (level, column, row))
+                assert status == 200
+                rendered = np.asarray(Image.open(io.BytesIO(body)), dtype=np.int16)
+                expected = madeTile(made, 'dzi', level, column, row)
+                assert rendered.shape == expected.shape, (level, column, row)
+
+                if level == top:
+                    np.testing.assert_array_equal(rendered, expected)
+                    continue
+                # pixels are the rounded means of blocks of the montage
+                x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+                np.testing.assert_array_equal(rendered, means[y1:y2, x1:x2])
+                assert np.abs(rendered - expected)[:height - 1 - y1, :width - 1 - x1].max(initial=0) <= MAX_DIFF, (level, column, row)
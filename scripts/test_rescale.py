@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# The lookup tables of makePlateMontageDZI.py give the same 8-bit pixels
+# as rescaleFOV for every 16-bit intensity, e.g. with:
+# python -m pytest -q test_rescale.py
+
+import numpy as np
+import pytest
+
+import makePlateMontageDZI as montage
+
+
+# -I ranges: the default, the full range, the narrowest range and ranges
+# at both ends of the intensities, as -A may choose them
+RANGES = [(250, 3000), (0, 65535), (100, 101), (1000, 60000), (0, 1), (65534, 65535)]
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'inverted'])
+def inverted(request, monkeypatch):
+    # globals set up in main of the script
+    monkeypatch.setattr(montage, 'imDepthIn', 2**16 - 1, raising=False)
+    monkeypatch.setattr(montage, 'imInv', request.param, raising=False)
+    return request.param
+
+
+@pytest.mark.parametrize('intRange', RANGES)
+def test_lut_matches_rescale_for_all_values(inverted, intRange):
+    values = np.arange(2**16, dtype=np.uint16)
+    lut = montage.rescaleLUT(*intRange)
+
+    assert lut.dtype == np.uint8 and lut.shape == (2**16,)
+    np.testing.assert_array_equal(np.take(lut, values), montage.rescaleFOV(values, *intRange))
+
+
+@pytest.mark.parametrize('intRange', RANGES)
+def test_lut_into_view_matches_rescale(inverted, intRange):
+    # as processWell writes a FOV into its place in the well
+    image = np.random.default_rng(0).integers(0, 2**16, size=(37, 53), dtype=np.uint16)
+    well = np.zeros((50, 70), dtype=np.uint8)
+    view = well[5:42, 9:62]
+
+    np.take(montage.rescaleLUT(*intRange), image, out=view, mode='clip')
+
+    np.testing.assert_array_equal(view, montage.rescaleFOV(image, *intRange))
+    assert not well[:5].any() and not well[42:].any()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Tiles of a pack are in its checkpoint log once a batch of them is
+# written, so that an interrupted run keeps them, and -z may precede the
+# input folder, e.g. with:
+# python -m pytest -q test_resume.py
+
+import os
+
+import makePlateMontageDZI as montage
+
+
+def test_pack_logs_tiles_per_batch(tmp_path):
+    destination = str(tmp_path / 'dzi.dzi')
+    descriptor = montage.DeepZoomImageDescriptor(width=4096, height=4096, tile_size=62)
+    pack = montage.TilePack(destination, checkpoint=montage._get_checkpoint_path(destination))
+    pack.open(descriptor)
+    top = descriptor.num_levels - 1
+    for column in range(montage.WRITE_BATCH_SIZE + 3):
+        pack.write(top, column, 0, bytes([column]) * 100)
+
+    # a run killed now keeps the first batch, not yet the rest
+    resumed = montage.TilePack(destination, checkpoint=montage._get_checkpoint_path(destination)).load_checkpoint('hash')
+    assert sorted(resumed) == [(top, column, 0) for column in range(montage.WRITE_BATCH_SIZE)]
+
+    pack.close()
+    resumed = montage.TilePack(destination, checkpoint=montage._get_checkpoint_path(destination)).load_checkpoint('hash')
+    assert len(resumed) == montage.WRITE_BATCH_SIZE + 3
+
+
+def test_resume_before_input_folder(tmp_path, plate, run_montage):
+    result = run_montage(plate.args('-c', 0, '-t', 64, '-k', '-Z', 'hash', '-o', tmp_path / 'out', '-z'))
+    assert 'No interrupted run with the same settings' in result.stdout
+    assert os.path.isfile(tmp_path / 'out' / 'dzi.dzp')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# serveDZI.py serves the tiles of packs as the files of _files folders,
+# with ETags that answer revalidation with 304, and byte ranges of files,
+# e.g. with:
+# python -m pytest -q test_serve.py
+
+import os
+
+
+def test_pack_tiles_match_files(tmp_path, plate, run_montage, server, fetch):
+    site = str(tmp_path / 'site')
+    run_montage(plate.args('-c', 0, '-t', 64, '-f', 'folder', '-o', site))
+    run_montage(plate.args('-c', 0, '-t', 64, '-f', 'packed', '-k', '-o', site))
+    url = server('serveDZI.py', [site, '-p', '{port}', '-a', 60], path='folder.dzi')
+
+    files = os.path.join(site, 'folder_files')
+    for level in os.listdir(files):
+        for name in os.listdir(os.path.join(files, level)):
+            status, headers, body = fetch(url + 'packed_files/%s/%s' % (level, name))
+            assert status == 200 and headers['Content-Type'] == 'image/png'
+            with open(os.path.join(files, level, name), 'rb') as tileFile:
+                assert body == tileFile.read(), (level, name)
+    assert fetch(url + 'packed_files/0/1_0.png')[0] == 404
+    assert fetch(url + 'packed_files/99/0_0.png')[0] == 404
+
+
+def test_etags_and_ranges(tmp_path, plate, run_montage, server, fetch):
+    site = str(tmp_path / 'site')
+    run_montage(plate.args('-c', 0, '-t', 64, '-k', '-o', site))
+    url = server('serveDZI.py', [site, '-p', '{port}', '-a', 60], path='dzi.dzi')
+
+    # tiles: cached by browsers, revalidated with their ETag
+    status, headers, body = fetch(url + 'dzi_files/0/0_0.png')
+    assert status == 200 and headers['Cache-Control'] == 'public, max-age=60'
+    etag = headers['ETag']
+    status, headers, body = fetch(url + 'dzi_files/0/0_0.png', {'If-None-Match': etag})
+    assert status == 304 and body == b'' and headers['ETag'] == etag
+    assert fetch(url + 'dzi_files/0/0_0.png', {'If-None-Match': '"other"'})[0] == 200
+    status, headers, body = fetch(url + 'dzi_files/0/0_0.png', method='HEAD')
+    assert status == 200 and body == b'' and int(headers['Content-Length']) > 0
+
+    # files: byte ranges
+    with open(os.path.join(site, 'dzi.dzi'), 'rb') as dziFile:
+        content = dziFile.read()
+    status, headers, body = fetch(url + 'dzi.dzi')
+    assert status == 200 and body == content and headers['Accept-Ranges'] == 'bytes'
+    assert fetch(url + 'dzi.dzi', {'If-None-Match': headers['ETag']})[0] == 304
+    status, headers, body = fetch(url + 'dzi.dzi', {'Range': 'bytes=5-14'})
+    assert status == 206 and body == content[5:15]
+    assert headers['Content-Range'] == 'bytes 5-14/%d' % len(content)
+    status, headers, body = fetch(url + 'dzi.dzi', {'Range': 'bytes=-7'})
+    assert status == 206 and body == content[-7:]
+    status, headers, body = fetch(url + 'dzi.dzi', {'Range': 'bytes=%d-' % (len(content) + 3)})
+    assert status == 416 and headers['Content-Range'] == 'bytes */%d' % len(content)
+
+    # a pack made again gets new ETags for its tiles
+    run_montage(plate.args('-c', 0, '-t', 64, '-k', '-I', 100, 2000, '-o', site))
+    status, headers, body = fetch(url + 'dzi_files/0/0_0.png', {'If-None-Match': etag})
+    assert status == 200 and headers['ETag'] != etag
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+# A plate tiled one row of wells at a time with -s gives the tiles of a
+# plate tiled in memory: the same full resolution level, and lower levels
+# reduced with a 2x2 box filter as with -P tiles, e.g. with:
+# python -m pytest -q test_stream.py
+
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize('tileSize', [64, 254])
+def test_streamed_matches_in_memory(tmp_path, plate, run_montage, different_files, tileSize):
+    streamed, composed, resized = (str(tmp_path / name) for name in ('streamed', 'composed', 'resized'))
+    run_montage(plate.args('-c', 0, '-t', tileSize, '-s', '-o', streamed))
+    run_montage(plate.args('-c', 0, '-t', tileSize, '-P', 'tiles', '-o', composed))
+    run_montage(plate.args('-c', 0, '-t', tileSize, '-o', resized))
+
+    files = os.path.join(streamed, 'dzi_files')
+    assert different_files(os.path.join(composed, 'dzi_files'), files) == []
+    assert different_files(files, os.path.join(composed, 'dzi_files')) == []
+    top = str(max(map(int, os.listdir(files))))
+    assert different_files(os.path.join(resized, 'dzi_files', top), os.path.join(files, top)) == []
+    assert open(os.path.join(streamed, 'dzi.dzi')).read() == open(os.path.join(resized, 'dzi.dzi')).read()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# An update with -u after a FOV changed gives the tiles of a full run of
+# the changed plate, writing only the new tiles into the published
+# pyramid, also after an interrupted update, e.g. with:
+# python -m pytest -q test_update.py
+
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import makePlateMontageDZI as montage
+import serveDZI
+
+
+def changeFov(folder):
+    # FOV 0 of well A01 gets the pixels of another FOV
+    shutil.copyfile(os.path.join(folder, 'B03f01d0.TIFF'), os.path.join(folder, 'A01f00d0.TIFF'))
+
+
+def readTiles(folder, name='dzi'):
+    # Decoded tiles of a pyramid by (level, column, row), from its _files
+    # folder or its pack
+    descriptor = montage.DeepZoomImageDescriptor()
+    descriptor.open(os.path.join(folder, name + '.dzi'))
+    pack = os.path.join(folder, name + '.dzp')
+    reader = serveDZI.PackReader(pack, descriptor) if os.path.isfile(pack) else None
+    tiles = {}
+    for level in range(descriptor.num_levels):
+        columns, rows = descriptor.get_num_tiles(level)
+        for column in range(columns):
+            for row in range(rows):
+                if reader is not None:
+                    data = reader.read(level, column, row)
+                else:
+                    with open(os.path.join(folder, name + '_files', str(level), '%d_%d.png' % (column, row)), 'rb') as tileFile:
+                        data = tileFile.read()
+                tiles[level, column, row] = np.asarray(Image.open(io.BytesIO(data)))
+    return tiles
+
+
+def assertSameTiles(actual, expected):
+    assert actual.keys() == expected.keys()
+    for tile in expected:
+        np.testing.assert_array_equal(actual[tile], expected[tile], err_msg=str(tile))
+
+
+@pytest.mark.parametrize('options', [('-P', 'tiles'), ('-P', 'tiles', '-k')])
+def test_update_matches_full_run(tmp_path, plate, run_montage, options):
+    updated = str(tmp_path / 'updated')
+    run_montage(plate.args('-c', 0, '-t', 64, *options, '-o', updated))
+    descriptor = montage.DeepZoomImageDescriptor()
+    descriptor.open(os.path.join(updated, 'dzi.dzi'))
+    top = descriptor.num_levels - 1
+    columns, rows = descriptor.get_num_tiles(top)
+    # a tile far from the changed FOV, and one that depends on it
+    far = os.path.join(updated, 'dzi_files', str(top), '%d_%d.png' % (columns - 1, rows - 1))
+    near = os.path.join(updated, 'dzi_files', '0', '0_0.png')
+    inodes = {path: os.stat(path).st_ino for path in [far, near] if os.path.isfile(path)}
+
+    changeFov(plate.folder)
+    result = run_montage(plate.args('-c', 0, '-t', 64, *options, '-u', '-v', '-o', updated))
+    assert 'Wells to tile again: 1' in result.stdout
+    full = str(tmp_path / 'full')
+    run_montage(plate.args('-c', 0, '-t', 64, *options, '-o', full))
+
+    assertSameTiles(readTiles(updated), readTiles(full))
+    assert os.path.isfile(os.path.join(updated, 'dzi_complete.json'))
+    assert not os.path.exists(os.path.join(updated, '.dzi_staging'))
+    if inodes:
+        # published tile files are replaced only where tiles changed
+        assert os.stat(far).st_ino == inodes[far]
+        assert os.stat(near).st_ino != inodes[near]
+
+
+def test_update_after_interrupted_update(tmp_path, plate, run_montage):
+    # tiles appended to a pack by an update that did not finish are cut off
+    updated = str(tmp_path / 'updated')
+    run_montage(plate.args('-c', 0, '-t', 64, '-P', 'tiles', '-k', '-o', updated))
+    pack = os.path.join(updated, 'dzi.dzp')
+    size = os.path.getsize(pack)
+    with open(pack, 'ab') as packFile:
+        packFile.write(b'\x89PNG' + bytes(1000))
+
+    changeFov(plate.folder)
+    run_montage(plate.args('-c', 0, '-t', 64, '-P', 'tiles', '-k', '-u', '-o', updated))
+    full = str(tmp_path / 'full')
+    run_montage(plate.args('-c', 0, '-t', 64, '-P', 'tiles', '-k', '-o', full))
+
+    assertSameTiles(readTiles(updated), readTiles(full))
+    with open(pack, 'rb') as packFile:
+        packFile.seek(size)
+        assert b'\x89PNG' + bytes(1000) not in packFile.read()
+
+
+def test_server_keeps_pack_while_updated(tmp_path, plate, run_montage, server, fetch):
+    # a pack with tiles appended but no new footer yet is served as it was
+    updated = str(tmp_path / 'updated')
+    run_montage(plate.args('-c', 0, '-t', 64, '-k', '-o', updated))
+    url = server('serveDZI.py', [updated, '-p', '{port}'], path='dzi.dzi')
+    status, _, before = fetch(url + 'dzi_files/0/0_0.png')
+    assert status == 200
+
+    with open(os.path.join(updated, 'dzi.dzp'), 'ab') as packFile:
+        packFile.write(b'\x89PNG' + bytes(1000))
+    status, _, during = fetch(url + 'dzi_files/0/0_0.png')
+    assert status == 200 and during == before
+
+
+def test_compacted_pack_keeps_tiles_and_shared_entries(tmp_path, monkeypatch):
+    # a pack whose replaced tiles are more than PACK_COMPACT_FRACTION of it
+    # is rewritten when closed; tiles that shared bytes still share them
+    monkeypatch.setattr(montage, 'PACK_COMPACT_FRACTION', 0.25)
+    destination = str(tmp_path / 'dzi.dzi')
+    descriptor = montage.DeepZoomImageDescriptor(width=512, height=512, tile_size=62)
+    top = descriptor.num_levels - 1
+    pack = montage.TilePack(destination)
+    pack.open(descriptor)
+    shared = pack.write(top, 0, 0, b'shared' * 100)
+    pack.link(shared, top, 1, 0)
+    for column in range(2, 8):
+        pack.write(top, column, 0, bytes([column]) * 1000)
+    pack.close()
+
+    pack = montage.TilePack(destination)
+    pack.open(descriptor, append=True)
+    for column in range(2, 7):
+        pack.write(top, column, 0, bytes([column + 100]) * 1000)
+    pack.close()
+
+    path = montage._get_pack_path(destination)
+    reader = serveDZI.PackReader(path, descriptor)
+    expected = {(0, 0): b'shared' * 100, (1, 0): b'shared' * 100, (7, 0): bytes([7]) * 1000}
+    expected.update({(column, 0): bytes([column + 100]) * 1000 for column in range(2, 7)})
+    for (column, row), data in expected.items():
+        assert reader.read(top, column, row) == data
+    with open(path, 'rb') as packFile:
+        entries = montage.read_pack_index(packFile)[1]
+    tiles = entries[entries['length'] > 0]
+    assert tiles[0]['offset'] == tiles[1]['offset']
+    assert os.path.getsize(path) == (len(montage.PACK_MAGIC) + 600 + 6000 + entries.nbytes + montage.PACK_FOOTER.size)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# The writer threads of a TileWriter write every queued file, links after
+# the batch that writes their source, also when that batch is slow, and
+# log every written batch in the checkpoint log, e.g. with:
+# python -m pytest -q test_writer.py
+
+import os
+import time
+
+import pytest
+
+import makePlateMontageDZI as montage
+
+
+@pytest.mark.parametrize('atomic', [False, True], ids=['plain', 'atomic'])
+def test_links_wait_for_their_source(tmp_path, monkeypatch, atomic):
+    slow = str(tmp_path / 'slow.png')
+    removeFile = montage._remove_file
+
+    def slowRemove(path):
+        # the batch that writes slow.png finishes after the batches queued after it
+        if path.startswith(slow):
+            time.sleep(0.5)
+        removeFile(path)
+    monkeypatch.setattr(montage, '_remove_file', slowRemove)
+
+    checkpoint = str(tmp_path / 'dzi_checkpoint.log')
+    writer = montage.TileWriter(threads=4, checkpoint=checkpoint, atomic=atomic)
+    writer.write(slow, b'slow')
+    writer.submit()
+    contents = {slow: b'slow'}
+    for i in range(3 * montage.WRITE_BATCH_SIZE):
+        path = str(tmp_path / ('%d.png' % i))
+        if i % 10 == 0:
+            # links to the slow file and to a file of the same batch
+            writer.link(slow if i % 20 == 0 else str(tmp_path / ('%d.png' % (i - 1))), path)
+            contents[path] = contents[slow] if i % 20 == 0 else contents[str(tmp_path / ('%d.png' % (i - 1)))]
+        else:
+            writer.write(path, b'%d' % i)
+            contents[path] = b'%d' % i
+    writer.close()
+
+    for path, content in contents.items():
+        with open(path, 'rb') as tileFile:
+            assert tileFile.read() == content, path
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    assert os.stat(str(tmp_path / '20.png')).st_ino == os.stat(slow).st_ino
+
+    records = montage._read_checkpoint(checkpoint)
+    assert sorted(os.path.join(str(tmp_path), record['path']) for record in records) == sorted(contents)
+    assert writer.stats.files == len(contents)
+
+
+def test_errors_of_threads_are_raised(tmp_path):
+    writer = montage.TileWriter(threads=2)
+    writer.link(str(tmp_path / 'missing.png'), str(tmp_path / 'link.png'))
+    with pytest.raises(OSError):
+        writer.close()